@@ -0,0 +1,50 @@
+"""
+Template: generate the train and test splits as JSONL shards (see harness.py).
+
+Copy it to ``generate_data.py`` and replace ``make_example`` with the task's
+own generator; everything else (process pool, per-shard seeds, streaming to
+disk) is handled by the harness. Train on the shards by pointing
+``data.train_file`` / ``data.test_file`` at the globs printed at the end.
+"""
+import random
+
+import hydra
+from omegaconf import DictConfig
+
+from harness import generate_shards
+
+
+def make_example(rng: random.Random) -> dict:
+    """
+    One example of the task. Placeholder: sort a list of numbers.
+
+    Tokens are whitespace separated, as the WordLevel tokenizer expects.
+    """
+    numbers = [rng.randrange(100) for _ in range(rng.randint(2, 10))]
+    return {
+        "input": " ".join(map(str, numbers)),
+        "output": " ".join(map(str, sorted(numbers))),
+    }
+
+
+@hydra.main(config_path="../config", config_name="base", version_base=None)
+def main(cfg: DictConfig) -> None:
+    gen_cfg = cfg.data_generation
+    # Splits are seeded by name as well, so they never share a random stream
+    for name, num_examples in (("train", gen_cfg.num_train), ("test", gen_cfg.num_test)):
+        generate_shards(
+            make_example,
+            gen_cfg.out_dir,
+            name,
+            int(num_examples),
+            examples_per_shard=int(gen_cfg.examples_per_shard),
+            num_proc=int(gen_cfg.num_proc),
+            seed=int(gen_cfg.seed),
+        )
+    # The data files default to data/train.json and data/test.json, the shards are opt-in
+    print(f"Shards written to {gen_cfg.out_dir}, use them with "
+          f"data.train_file='{gen_cfg.out_dir}/train-*.jsonl' data.test_file='{gen_cfg.out_dir}/test-*.jsonl'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Parallel, sharded data generation.
+
+A task only has to provide a function that builds one example from a random
+number generator::
+
+    def make_example(rng: random.Random) -> dict:
+        numbers = [rng.randrange(100) for _ in range(rng.randint(2, 10))]
+        return {"input": " ".join(map(str, numbers)), "output": " ".join(map(str, sorted(numbers)))}
+
+    generate_shards(make_example, "data/shards", "train", num_examples=10_000_000, num_proc=16)
+
+``generate_shards`` splits the examples into shards of ``examples_per_shard``
+and generates the shards across a process pool. Every shard streams its
+examples straight to its own JSONL file (``train-00003-of-00100.jsonl``), so
+memory stays flat however big the split is. Every shard is seeded from
+``(seed, name, shard index)``: the output does not depend on the number of
+processes or the order shards finish in, and the train and test splits never
+share a random stream. Point ``data.train_file`` / ``data.test_file`` at the
+shards with a glob (``data/shards/train-*.jsonl``) to train on them.
+"""
+import glob
+import json
+import math
+import os
+import random
+import time
+from multiprocessing import Pool
+from typing import Callable, Dict, List, Tuple
+
+
+def shard_path(out_dir: str, name: str, shard: int, num_shards: int) -> str:
+    return os.path.join(out_dir, f"{name}-{shard:05d}-of-{num_shards:05d}.jsonl")
+
+
+def _write_shard(job: Tuple) -> Tuple[str, int, float]:
+    generate_example, path, name, shard, num_examples, seed = job
+    start = time.time()
+    # String seeds are hashed with SHA-512, so they are the same in every process and run
+    rng = random.Random(f"{seed}-{name}-{shard}")
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        for _ in range(num_examples):
+            example = generate_example(rng)
+            if not isinstance(example.get("input"), str) or not isinstance(example.get("output"), str):
+                raise ValueError(f"Examples need string 'input' and 'output' fields, got {example!r}")
+            f.write(json.dumps(example) + "\n")
+    # Shards appear complete or not at all
+    os.replace(tmp_path, path)
+    return path, num_examples, time.time() - start
+
+
+def generate_shards(
+    generate_example: Callable[[random.Random], Dict],
+    out_dir: str,
+    name: str,
+    num_examples: int,
+    examples_per_shard: int = 100_000,
+    num_proc: int = 16,
+    seed: int = 0,
+) -> List[str]:
+    """
+    Generate a split as JSONL shards across a process pool.
+
+    Args:
+        generate_example: Builds one ``{"input": ..., "output": ...}`` example from the
+            shard's ``random.Random``. Must be a module-level function so workers can load it.
+        out_dir: Directory of the shards. Earlier shards of ``name`` in it are removed.
+        name: Split name, the prefix of the shard files.
+        num_examples: Examples in the split.
+        examples_per_shard: Examples per shard; the last shard holds the rest.
+        num_proc: Worker processes.
+        seed: Base seed of the split.
+
+    Returns:
+        The shard paths, in shard order.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(out_dir, f"{name}-*-of-*.jsonl")):
+        os.remove(old)
+
+    num_shards = max(1, math.ceil(num_examples / examples_per_shard))
+    paths = [shard_path(out_dir, name, shard, num_shards) for shard in range(num_shards)]
+    jobs = [
+        (
+            generate_example,
+            paths[shard],
+            name,
+            shard,
+            min(examples_per_shard, num_examples - shard * examples_per_shard),
+            seed,
+        )
+        for shard in range(num_shards)
+    ]
+
+    num_proc = max(1, min(num_proc, num_shards))
+    print(f"Generating {num_examples} {name} examples in {num_shards} shards on {num_proc} processes")
+    start = time.time()
+    done = 0
+    with Pool(num_proc) as pool:
+        for path, count, seconds in pool.imap_unordered(_write_shard, jobs):
+            done += count
+            print(f"  {os.path.basename(path)}: {count} examples in {seconds:.1f}s ({done}/{num_examples})")
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"Generated {num_examples} {name} examples in {elapsed:.1f}s ({num_examples / elapsed:.0f} examples/s)")
+    return paths
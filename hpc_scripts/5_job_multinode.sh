@@ -0,0 +1,28 @@
+#!/bin/bash
+#SBATCH --job-name=training-multinode                 # Job name
+#SBATCH --output=logs/train/training_%j.out           # Standard output and error log (%j expands to jobID)
+#SBATCH --error=logs/train/training_%j.err            # Error log
+#SBATCH --time=24:00:00                               # Time limit hrs:min:sec
+#SBATCH --account=project_465001424
+#SBATCH --nodes=2                                     # Number of nodes requested
+#SBATCH --ntasks-per-node=8                           # One task (process) per GPU
+#SBATCH --gpus-per-node=8                             # Number of GPUs per node
+#SBATCH --cpus-per-task=7                             # Number of CPU cores per task
+#SBATCH --mem=480GB                                   # Memory limit per node
+#SBATCH --partition=standard-g                        # Partition name
+
+# export SINGULARITY_BIND="$SINGULARITY_BIND,/usr/bin/sacct,/usr/bin/sacctmgr,/usr/bin/salloc,/usr/bin/sattach,/usr/bin/sbatch,/usr/bin/sbcast,/usr/bin/scancel,/usr/bin/scontrol,/usr/bin/scrontab,/usr/bin/sdiag,/usr/bin/sinfo,/usr/bin/sprio,/usr/bin/squeue,/usr/bin/sreport,/usr/bin/srun,/usr/bin/sshare,/usr/bin/sstat,/usr/bin/strigger,/usr/bin/sview,/usr/bin/sgather,/usr/lib64/slurm/,/etc/slurm,/etc/passwd,/usr/lib64/libmunge.so.2,/run/munge,/var/lib/misc,/etc/nsswitch.conf"
+
+# Lightning picks up rank and world size from SLURM, so trainer.devices / trainer.num_nodes
+# have to match --ntasks-per-node / --nodes. Use trainer.strategy=fsdp for the large configs.
+# data.num_workers is per rank: keep it at or below --cpus-per-task.
+# Global rank 0 builds the token stores while the other ranks wait for them, so a failure
+# on any rank has to end the whole step (--kill-on-bad-exit).
+
+srun --kill-on-bad-exit=1 singularity exec \
+    $SIF \
+    python train.py \
+        trainer.devices=$SLURM_NTASKS_PER_NODE \
+        trainer.num_nodes=$SLURM_JOB_NUM_NODES \
+        trainer.strategy=ddp \
+        data.num_workers=$((SLURM_CPUS_PER_TASK - 1))
@@ -10,6 +10,10 @@
 #SBATCH --cpus-per-task=16                              # Number of CPU cores per task
 #SBATCH --mem=64GB                                      # Memory limit
 #SBATCH --partition=small-g                             # Partition name
+#SBATCH --requeue                                        # Rerun after preemption; inference resumes from its journal
+
+# A timed-out run continues where it stopped when the job is submitted again
+# (inference.resume, temp/inference_results/journal.jsonl)
 
 # export SINGULARITY_BIND="$SINGULARITY_BIND,/usr/bin/sacct,/usr/bin/sacctmgr,/usr/bin/salloc,/usr/bin/sattach,/usr/bin/sbatch,/usr/bin/sbcast,/usr/bin/scancel,/usr/bin/scontrol,/usr/bin/scrontab,/usr/bin/sdiag,/usr/bin/sinfo,/usr/bin/sprio,/usr/bin/squeue,/usr/bin/sreport,/usr/bin/srun,/usr/bin/sshare,/usr/bin/sstat,/usr/bin/strigger,/usr/bin/sview,/usr/bin/sgather,/usr/lib64/slurm/,/etc/slurm,/etc/passwd,/usr/lib64/libmunge.so.2,/run/munge,/var/lib/misc,/etc/nsswitch.conf"
 
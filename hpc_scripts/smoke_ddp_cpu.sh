@@ -0,0 +1,28 @@
+#!/bin/bash
+# Multi-process smoke test on CPU: DDP over gloo with two processes, a tiny model and small
+# subsets of the data. Checks sampler sharding, rank-0-only side effects and the sharded
+# evaluation end to end without GPUs. Needs the tokenizer and data files of base.yaml.
+# Pass trainer.devices=N or data.sampler.mode=bucketed etc. to vary it.
+
+WANDB_MODE=offline python train.py \
+    trainer.accelerator=cpu \
+    trainer.devices=2 \
+    trainer.strategy=ddp \
+    trainer.precision=32-true \
+    model.epochs=1 \
+    model.n_layer=2 \
+    model.n_head=2 \
+    model.n_embd=64 \
+    model.batch_size=16 \
+    data.num_workers=0 \
+    data.sampling.sample_train_set=True \
+    data.sampling.num_train=256 \
+    data.sampling.sample_val_set=True \
+    data.sampling.num_val=64 \
+    data.sampling.sample_test_set=True \
+    data.sampling.num_test=32 \
+    eval.num_examples=32 \
+    eval.batch_size=8 \
+    eval.results_dir=temp/smoke_ddp_cpu \
+    wandb.model_name=smoke-ddp-cpu \
+    "$@"
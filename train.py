@@ -10,10 +10,16 @@ from config import hf_config
 from lightning.pytorch.loggers import WandbLogger
 from omegaconf import DictConfig, OmegaConf
 from lightning.pytorch.callbacks import ModelCheckpoint, LearningRateMonitor
-from utils.evaluator import Evaluator
+from lightning.pytorch.strategies import FSDPStrategy
+from lightning.pytorch.utilities import rank_zero_only
+from torch.distributed.fsdp import FullStateDictConfig, FullyShardedDataParallel, StateDictType
+from utils.evaluator import Evaluator, save_hf_checkpoint
+from utils.async_eval import AsyncEvaluator
+from utils.modeling import packed_forward
 from litgpt.config import configs, Config, name_to_config
-from litgpt.model import GPT
+from litgpt.model import GPT, Block
 from litgpt.api import Preprocessor
+from litgpt.utils import chunked_cross_entropy
 import json
 import os
 import wandb
@@ -29,7 +35,7 @@ logging.info("Starting training...")
 
 
 class LitLLM(L.LightningModule):
-    def __init__(self, cfg, model, preprocessor, train_batches, delimiter_token_id, trainer_ckpt_path=None):
+    def __init__(self, cfg, model, preprocessor, train_batches, trainer_ckpt_path=None):
         super().__init__()
 
         self.llm = model
@@ -37,7 +43,10 @@ class LitLLM(L.LightningModule):
         self.preprocessor = preprocessor
         self.trainer_ckpt_path = trainer_ckpt_path
         self.train_batches = train_batches
-        self.delimiter_token_id = delimiter_token_id
+        # Prompts of the test set, extracted by the first Evaluator and reused every epoch
+        self.eval_prompts = None
+        # Background evaluation worker, started at the first validation epoch if eval.async_eval.enabled
+        self.async_evaluator = None
         _, self.hf_conf = hf_config.get_configs(cfg)
 
     def setup(self, stage):
@@ -46,33 +55,52 @@ class LitLLM(L.LightningModule):
         self.hf_conf["eos_token_id"] = self.preprocessor.tokenizer.convert_tokens_to_ids("[EOS]")
         self.hf_conf["vocab_size"] = len(self.preprocessor.tokenizer.get_vocab())
 
-        self.preprocessor.tokenizer.save_pretrained(self.cfg.convert_hf.in_path)
-        with open(os.path.join(self.cfg.convert_hf.in_path, "config.json"), "w") as f:
-            json.dump(self.hf_conf, f, indent=2)
-
-    def mask_targets(self, input_ids, target_ids):
-        # Find positions with delimiter tokens
-        delimiter_positions = (input_ids == self.delimiter_token_id)
-        
-        # Create a shifted version where positions after delimiter are marked
-        # This will include the delimiter itself as True
-        first_search_pos = torch.zeros_like(input_ids, dtype=torch.bool)
-        first_search_pos[:, 1:] = delimiter_positions.cumsum(dim=1)[:, :-1].bool()
-        
-        # Create the mask - True for delimiter and positions before it
-        mask = ~first_search_pos.cumsum(dim=1).bool()
-        
-        # Apply the mask to targets, setting masked positions to -100
-        return torch.where(mask, torch.tensor(-100, device=target_ids.device), target_ids)
+        # Every rank runs setup, but the files only need writing once
+        if self.trainer.is_global_zero:
+            self.preprocessor.tokenizer.save_pretrained(self.cfg.convert_hf.in_path)
+            with open(os.path.join(self.cfg.convert_hf.in_path, "config.json"), "w") as f:
+                json.dump(self.hf_conf, f, indent=2)
+
+    def full_model(self, rank0_only=False):
+        """
+        The GPT with all of its weights.
+
+        FSDP only keeps a shard of the weights per rank, so under FSDP every
+        rank has to call this to gather a full copy, which is built on the CPU.
+        With ``rank0_only`` only rank 0 gets the copy and the other ranks None.
+        Without FSDP this is the live model.
+        """
+        if not isinstance(self.trainer.strategy, FSDPStrategy):
+            return self.llm.model
+
+        root = self.trainer.strategy.model
+        state_dict_config = FullStateDictConfig(offload_to_cpu=True, rank0_only=rank0_only)
+        with FullyShardedDataParallel.state_dict_type(root, StateDictType.FULL_STATE_DICT, state_dict_config):
+            state_dict = root.state_dict()
+        if rank0_only and not self.trainer.is_global_zero:
+            return None
+        # LLM.state_dict hands its prefix straight to the GPT, so the keys are "llm.<GPT key>"
+        state_dict = {name[len("llm.") :]: tensor for name, tensor in state_dict.items() if name.startswith("llm.")}
+
+        model = GPT(self.llm.model.config)
+        model.load_state_dict(state_dict)
+        return model.to(dtype=next(iter(state_dict.values())).dtype)
+
+    def save_llm(self, out_dir):
+        """Write the LitGPT checkpoint from rank 0 (all ranks have to call this under FSDP)."""
+        model = self.full_model(rank0_only=True)
+        if self.trainer.is_global_zero:
+            llm = self.llm if model is self.llm.model else LLM(model, preprocessor=self.preprocessor, config=self.llm.config)
+            llm.save(out_dir)
 
     def training_step(self, batch: torch.Tensor, batch_idx: int) -> torch.Tensor:
-        idx, targets_no_mask, att_mask = (
+        # Labels come from PadCollator with the prompt and padding already set to -100
+        idx, targets, att_mask = (
             batch["input_ids"],
             batch["labels"],
             batch["attention_mask"],
         )
-        targets = self.mask_targets(idx, targets_no_mask)
-        _, loss = self(idx, targets)
+        _, loss = self(idx, targets, position_ids=batch.get("position_ids"))
         self.log("train_loss", loss, sync_dist=True)
         return loss
 
@@ -82,7 +110,6 @@ class LitLLM(L.LightningModule):
             batch["labels"],
             batch["attention_mask"],
         )
-        targets = self.mask_targets(idx, targets)
         out, loss = self(idx, targets)
         
         # Compute accuracy only on non-masked tokens
@@ -108,20 +135,45 @@ class LitLLM(L.LightningModule):
     def on_validation_epoch_end(self):
         test = self.trainer.datamodule.dataset["test"]
 
-        save_path = self.cfg.convert_hf.in_path
-        self.llm.model.to(self.llm.preprocessor.device)
-        self.llm.save(save_path)
-
-        self.llm.model.to(self.device)
+        if self.cfg.eval.async_eval.enabled:
+            # Hand a snapshot of the weights to the worker and keep training; results are logged as they arrive.
+            # One worker on rank 0 is enough.
+            model = self.full_model(rank0_only=True)
+            if not self.trainer.is_global_zero:
+                return
+            if self.async_evaluator is None:
+                self.async_evaluator = AsyncEvaluator(
+                    self.cfg,
+                    self.llm.model.config,
+                    test,
+                    self.preprocessor.tokenizer,
+                    device=self.cfg.eval.async_eval.device,
+                    max_pending=self.cfg.eval.async_eval.max_pending,
+                    num_reported=self.cfg.wandb.num_examples_reported,
+                )
+            self.async_evaluator.submit(self.global_step, model)
+            self.log_async_eval_results(self.async_evaluator.poll())
+            return
+
+        # The hf backend converts the saved checkpoint; the lit backend generates on the live model
+        if self.cfg.eval.backend == "hf":
+            self.save_llm(self.cfg.convert_hf.in_path)
+            model = None
+        else:
+            # Every rank generates with the full model (gathered under FSDP)
+            model = self.full_model().to(self.device)
 
+        # Each rank generates for its share of the test prompts
         evaluator = Evaluator(
             self.cfg,
             test,
             self.preprocessor.tokenizer,
             self.cfg.data.split_str,
             self.global_step,
-            self.llm.model,
+            model,
+            prompts=self.eval_prompts,
         )
+        self.eval_prompts = evaluator.prompt_set
         
         # Get metrics dictionary from evaluator
         metrics = evaluator.evaluate()
@@ -145,7 +197,7 @@ class LitLLM(L.LightningModule):
             indices = np.random.choice(len(evaluator.prompts), num_examples, replace=False)
             
             for i in indices:
-                prompt = self.preprocessor.tokenizer.decode(evaluator.prompts[i], skip_special_tokens=True)
+                prompt = evaluator.codec.decode(evaluator.prompts[i], skip_special_tokens=True)
                 pred = evaluator.predictions_after_delimiter[i]
                 gt = evaluator.gts[i]
                 exact_match = pred == gt
@@ -154,6 +206,29 @@ class LitLLM(L.LightningModule):
             
             wandb.log({"evaluation_examples": examples_table}, step=self.global_step)
 
+    def on_train_batch_end(self, outputs, batch, batch_idx):
+        if self.async_evaluator is not None:
+            self.log_async_eval_results(self.async_evaluator.poll())
+
+    def log_async_eval_results(self, results):
+        """Log results of the background evaluator against the step their snapshot was taken at."""
+        if wandb.run is None:
+            return
+        for result in results:
+            step = result["step"]
+            examples_table = wandb.Table(columns=["Prompt", "Prediction", "Ground Truth", "Exact Match"])
+            for prompt, pred, gt in result["examples"]:
+                examples_table.add_data(prompt, pred, gt, pred == gt)
+
+            # WandbLogger plots everything against "trainer/global_step", so tag the results with the snapshot's step
+            wandb.log(
+                {
+                    **{f"Evaluation/{name}": value for name, value in result["metrics"].items()},
+                    "evaluation_examples": examples_table,
+                    "trainer/global_step": step,
+                }
+            )
+
     def configure_optimizers(self):
 
         if self.cfg.optim.lr_type == "linear":
@@ -190,9 +265,31 @@ class LitLLM(L.LightningModule):
             return [optimizer], [scheduler]
 
     def forward(
-        self, idx: torch.Tensor, targets: Optional[torch.Tensor] = None
+        self,
+        idx: torch.Tensor,
+        targets: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-        return self.llm(idx, targets)
+        if position_ids is None:
+            return self.llm(idx, targets)
+
+        # Packed rows: reset positions and attention at every example boundary
+        logits = packed_forward(self.llm.model, idx, position_ids)
+        if targets is None:
+            return logits
+        return logits, chunked_cross_entropy(logits[..., :-1, :], targets[..., 1:])
+
+
+def get_strategy(cfg):
+    """Lightning strategy for cfg.trainer.strategy: "auto", "ddp" or "fsdp"."""
+    if cfg.trainer.strategy == "fsdp":
+        # One FSDP unit per transformer block; "full" state dicts keep checkpoints loadable without FSDP
+        return FSDPStrategy(
+            auto_wrap_policy={Block},
+            sharding_strategy=cfg.trainer.fsdp_sharding,
+            state_dict_type="full",
+        )
+    return cfg.trainer.strategy
 
 
 @hydra.main(
@@ -222,20 +319,34 @@ def main(cfg: DictConfig):
     conf.padded_vocab_size = len(tokenizer.get_vocab())
     model = LLM(GPT(conf), preprocessor=preprocessor, config=conf)
     datasets = get_data(cfg, tokenizer)
-    data = Datamodule(datasets, batch_size, num_workers, tokenizer)
+    data = Datamodule(
+        datasets,
+        batch_size,
+        num_workers,
+        tokenizer,
+        sampler=cfg.data.sampler.mode,
+        max_tokens=cfg.data.sampler.max_tokens,
+        bucket_size=cfg.data.sampler.bucket_size,
+        seed=cfg.data.sampler.seed,
+        packing=cfg.data.packing,
+    )
     data.connect(max_seq_length=cfg.model.block_size)
     data.setup()
 
+    padding_stats = data.padding_report()
+    print(f"Padding efficiency ({cfg.data.sampler.mode} sampler): {padding_stats['padding_efficiency']:.2%}")
+    print(f"Padding efficiency (plain shuffle): {padding_stats['padding_efficiency_random']:.2%}")
+    print(f"Padded tokens saved per epoch: {padding_stats['padded_tokens_saved']:.2%}")
+
     train_size = len(data.train_dataloader())
-    trace_start_token_id = tokenizer.encode(cfg.data.split_str, add_special_tokens=True)[0]
-    # print(trace_start_token_id)
 
-    lit_model = LitLLM(model=model, cfg=cfg, train_batches=train_size, preprocessor=preprocessor,
-                       delimiter_token_id=trace_start_token_id)
+    lit_model = LitLLM(model=model, cfg=cfg, train_batches=train_size, preprocessor=preprocessor)
 
     logger = WandbLogger(
         project=cfg.wandb.proj_name, name=f"{cfg.model.name}", config=wandb_config
     )
+    if rank_zero_only.rank == 0:
+        logger.experiment.summary.update({f"data/{k}": v for k, v in padding_stats.items()})
 
     checkpoint_callback = ModelCheckpoint(
         monitor="acc",  # what metric to track
@@ -249,19 +360,30 @@ def main(cfg: DictConfig):
     print("Total number of params:", total_params)
 
     trainer = L.Trainer(
-        devices=1,
-        accelerator="cuda",
+        devices=cfg.trainer.devices,
+        num_nodes=cfg.trainer.num_nodes,
+        accelerator=cfg.trainer.accelerator,
+        strategy=get_strategy(cfg),
+        # Datamodule shards its samplers itself, bucketed batches included
+        use_distributed_sampler=False,
         max_epochs=cfg.model.epochs,
         accumulate_grad_batches=accumulate_grad_batches,
-        precision="bf16-true",
+        precision=cfg.trainer.precision,
         val_check_interval=1.0,
         callbacks=[LearningRateMonitor(), checkpoint_callback],
         logger=logger,
     )
     trainer.fit(lit_model, data)
 
-    lit_model.llm.model.to(lit_model.llm.preprocessor.device)
-    lit_model.llm.save(cfg.convert_hf.in_path)
+    if lit_model.async_evaluator is not None:
+        # Wait for the evaluations still running in the background
+        lit_model.log_async_eval_results(lit_model.async_evaluator.close())
+
+    lit_model.save_llm(cfg.convert_hf.in_path)
+
+    # Evaluation during training ran on the LitGPT model, so convert for utils/inference.py once here
+    if cfg.eval.backend == "lit" and trainer.is_global_zero:
+        save_hf_checkpoint(cfg)
 
 
 if __name__ == "__main__":
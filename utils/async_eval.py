@@ -0,0 +1,174 @@
+"""
+Generation-based evaluation in a background process.
+
+``Evaluator.evaluate`` decodes the whole test set and writes its results, which
+stalls training for as long as it runs when called from
+``on_validation_epoch_end``. ``AsyncEvaluator`` instead copies the weights to
+CPU and hands the snapshot to a worker process that keeps its own LitGPT model
+(on a spare GPU, the training GPU, or the CPU) and runs the ``Evaluator`` there.
+Results come back tagged with the step the snapshot was taken at, so they can
+be logged against the right ``global_step`` whenever they arrive.
+
+Pending snapshots are bounded by ``max_pending``: while the worker is behind,
+new snapshots are skipped instead of piling up in memory.
+"""
+import queue
+import traceback
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from litgpt.model import GPT
+
+try:
+    from utils.evaluator import Evaluator
+except ImportError:
+    from evaluator import Evaluator
+
+
+def snapshot_state_dict(model: torch.nn.Module) -> Dict[str, torch.Tensor]:
+    """CPU copy of the weights that training can keep updating under."""
+    return {name: tensor.detach().to("cpu", copy=True) for name, tensor in model.state_dict().items()}
+
+
+def _worker(cfg, model_config, test_set, tokenizer, prompts, device, num_reported, jobs, results):
+    dtype = torch.bfloat16 if torch.device(device).type == "cuda" else torch.float32
+    model = GPT(model_config).to(device=device, dtype=dtype)
+    model.eval()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        step, state_dict = job
+        try:
+            model.load_state_dict(state_dict)
+            del state_dict
+            evaluator = Evaluator(
+                cfg,
+                test_set,
+                tokenizer,
+                cfg.data.split_str,
+                step,
+                model,
+                prompts=prompts,
+                backend="lit",
+            )
+            prompts = evaluator.prompt_set
+            metrics = evaluator.evaluate()
+
+            # A few examples for the wandb table, decoded here so only strings cross the process boundary
+            indices = np.random.choice(len(evaluator.prompts), min(num_reported, len(evaluator.prompts)), replace=False)
+            examples = [
+                (
+                    evaluator.codec.decode(evaluator.prompts[i], skip_special_tokens=True),
+                    evaluator.predictions_after_delimiter[i],
+                    evaluator.gts[i],
+                )
+                for i in indices
+            ]
+            results.put(
+                {
+                    "step": step,
+                    "metrics": {name: float(value) for name, value in metrics.items()},
+                    "examples": examples,
+                }
+            )
+        except Exception:
+            results.put({"step": step, "error": traceback.format_exc()})
+        finally:
+            if device != "cpu" and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+class AsyncEvaluator:
+    """
+    Runs ``Evaluator`` on weight snapshots in a spawned worker process.
+
+    Args:
+        cfg: The run config (``cfg.eval`` settings apply as for ``Evaluator``).
+        model_config: LitGPT ``Config`` of the trained model.
+        test_set: Tokenized test split.
+        tokenizer: The run's tokenizer.
+        prompts: ``PromptSet`` of the test set, if already extracted.
+        device: Device of the worker's model, e.g. a spare GPU ("cuda:1") or "cpu".
+        max_pending: Snapshots that may wait for the worker; ``submit`` skips snapshots beyond that.
+        num_reported: Examples returned for the wandb table.
+    """
+
+    def __init__(
+        self,
+        cfg,
+        model_config,
+        test_set,
+        tokenizer,
+        prompts=None,
+        device: str = "cuda",
+        max_pending: int = 1,
+        num_reported: int = 100,
+    ):
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue(maxsize=max_pending)
+        self.results = ctx.Queue()
+        self.process = ctx.Process(
+            target=_worker,
+            args=(cfg, model_config, test_set, tokenizer, prompts, device, num_reported, self.jobs, self.results),
+            daemon=True,
+        )
+        self.process.start()
+        self.submitted = 0
+        self.skipped = 0
+        self.received = 0
+
+    def submit(self, step: int, model: torch.nn.Module) -> bool:
+        """
+        Queue an evaluation of ``model``'s current weights at ``step``.
+
+        Returns:
+            False if the snapshot was skipped because ``max_pending`` snapshots are already waiting.
+        """
+        if self.jobs.full():
+            self.skipped += 1
+            print(f"Async eval: worker is busy, skipping the evaluation at step {step}")
+            return False
+        try:
+            self.jobs.put_nowait((step, snapshot_state_dict(model)))
+        except queue.Full:
+            self.skipped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def poll(self, block: bool = False, timeout: Optional[float] = None) -> List[Dict]:
+        """
+        Results that arrived so far, oldest first.
+
+        With ``block`` the call waits for at least one result (or ``timeout`` seconds).
+        """
+        results = []
+        while True:
+            try:
+                if block and not results:
+                    result = self.results.get(timeout=timeout)
+                else:
+                    result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.received += 1
+            if "error" in result:
+                print(f"Async eval at step {result['step']} failed:\n{result['error']}")
+                continue
+            results.append(result)
+        return results
+
+    def close(self) -> List[Dict]:
+        """Wait for all submitted evaluations to finish, stop the worker and return the remaining results."""
+        results = []
+        while self.received < self.submitted and self.process.is_alive():
+            results.extend(self.poll(block=True, timeout=10))
+        if self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join()
+        results.extend(self.poll())
+        return results
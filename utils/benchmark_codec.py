@@ -0,0 +1,36 @@
+import itertools
+
+import hydra
+from omegaconf import DictConfig
+
+from codec import benchmark
+from data import expand_data_files, format_example, get_tokenizer, iter_examples
+
+
+@hydra.main(
+    config_path="../config",
+    config_name="base",
+    version_base=None,
+)
+def main(cfg: DictConfig):
+    """Compare WordLevelCodec with the HF tokenizer on a 100k-example eval set."""
+    num_examples = 100_000
+    tokenizer = get_tokenizer(cfg)
+
+    # Cycle the test set up to num_examples examples
+    test_examples = itertools.chain.from_iterable(map(iter_examples, expand_data_files(cfg.data.test_file)))
+    examples = list(itertools.islice(test_examples, num_examples))
+    texts = [
+        format_example(tokenizer, cfg.data.split_str, example["input"], example["output"])
+        for example in itertools.islice(itertools.cycle(examples), num_examples)
+    ]
+
+    timings = benchmark(tokenizer, texts)
+    print(f"Outputs identical to the HF tokenizer on {len(texts)} examples")
+    for step in ("encode", "decode_keep_special", "decode_skip_special"):
+        hf, codec = timings[f"hf_{step}"], timings[f"codec_{step}"]
+        print(f"{step}: HF {hf:.3f}s, codec {codec:.3f}s ({hf / max(codec, 1e-9):.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Check that a sharded ``Evaluator`` run matches a single-process run.
+
+Evaluates a random tiny ``GPT`` on a small sorting test set once in this
+process and once on N gloo ranks (CPU only), then checks that every rank got
+the same predictions and metrics as the single process and that the saved
+results tables are identical. Covers example budgets and speculative
+decoding. Re-run it after touching the sharding or gathering in
+``evaluator.py``::
+
+    python utils/check_distributed_eval.py      # 3 ranks
+    python utils/check_distributed_eval.py 4
+"""
+import json
+import os
+import socket
+import sys
+import tempfile
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from litgpt.config import Config
+from litgpt.model import GPT
+from omegaconf import OmegaConf
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import WhitespaceSplit
+from transformers import PreTrainedTokenizerFast
+
+from create_tokenizer import SPECIAL_TOKENS
+from evaluator import Evaluator
+from results_io import ResultsReader
+
+SPLIT_STR = "[OUT]"
+NUM_EXAMPLES = 37
+BLOCK_SIZE = 48
+STEP = 0
+# (generation.budget, generation.num_draft_tokens) of every compared evaluation
+SETTINGS = [("example", 0), ("none", 4)]
+
+
+def make_tokenizer():
+    vocab = {token: idx for idx, token in enumerate([f"E{i}" for i in range(20)] + [SPLIT_STR])}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = WhitespaceSplit()
+    tokenizer.add_special_tokens(SPECIAL_TOKENS)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="[BOS]",
+        eos_token="[EOS]",
+        pad_token="[PAD]",
+        unk_token="[UNK]",
+        mask_token="[MASK]",
+    )
+
+
+def make_inputs():
+    """Tokenizer, test set and model; the same in every process."""
+    tokenizer = make_tokenizer()
+    rng = np.random.default_rng(0)
+    rows = []
+    for _ in range(NUM_EXAMPLES):
+        numbers = rng.integers(0, 20, rng.integers(2, 12))
+        text = f"[BOS] {' '.join(f'E{n}' for n in numbers)} {SPLIT_STR} {' '.join(f'E{n}' for n in sorted(numbers))} [EOS]"
+        rows.append(tokenizer.encode(text))
+    torch.manual_seed(0)
+    vocab_size = len(tokenizer.get_vocab())
+    config = Config(
+        block_size=BLOCK_SIZE, vocab_size=vocab_size, padded_vocab_size=vocab_size, n_layer=2, n_head=4, n_embd=32
+    )
+    # float64, so the shard's batch shapes cannot change a greedy choice
+    model = GPT(config).double()
+    return tokenizer, {"input_ids": rows}, model
+
+
+def eval_config(results_dir, budget, num_draft_tokens):
+    return OmegaConf.create(
+        {
+            "eval": {"num_examples": NUM_EXAMPLES, "batch_size": 4, "backend": "lit", "results_dir": results_dir},
+            "generation": {
+                "budget": budget,
+                "budget_margin": 4,
+                "num_draft_tokens": num_draft_tokens,
+                "draft_ngram_size": 3,
+            },
+            "model": {"block_size": BLOCK_SIZE},
+            "data": {"split_str": SPLIT_STR},
+        }
+    )
+
+
+def evaluate_all(root):
+    """Metrics and predictions of every setting, with results saved under ``root``."""
+    tokenizer, test_set, model = make_inputs()
+    runs = []
+    for budget, num_draft_tokens in SETTINGS:
+        results_dir = os.path.join(root, f"{budget}-{num_draft_tokens}")
+        evaluator = Evaluator(eval_config(results_dir, budget, num_draft_tokens), test_set, tokenizer, SPLIT_STR, STEP, model)
+        metrics = evaluator.evaluate()
+        runs.append(
+            {
+                "metrics": {key: float(value) for key, value in metrics.items()},
+                "predictions": evaluator.predictions_after_delimiter,
+            }
+        )
+    return runs
+
+
+def _rank(rank, world_size, port, root):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        runs = evaluate_all(os.path.join(root, "distributed"))
+        with open(os.path.join(root, f"rank{rank}.json"), "w") as f:
+            json.dump(runs, f)
+    finally:
+        dist.destroy_process_group()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    world_size = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    with tempfile.TemporaryDirectory() as root:
+        expected = evaluate_all(os.path.join(root, "single"))
+        mp.spawn(_rank, args=(world_size, _free_port(), root), nprocs=world_size)
+
+        for rank in range(world_size):
+            with open(os.path.join(root, f"rank{rank}.json")) as f:
+                runs = json.load(f)
+            for (budget, num_draft_tokens), run, reference in zip(SETTINGS, runs, expected):
+                name = f"rank {rank}, budget={budget}, num_draft_tokens={num_draft_tokens}"
+                assert run["predictions"] == reference["predictions"], f"{name}: predictions differ"
+                assert run["metrics"] == reference["metrics"], f"{name}: {run['metrics']} != {reference['metrics']}"
+
+        for budget, num_draft_tokens in SETTINGS:
+            path = os.path.join(f"{budget}-{num_draft_tokens}", f"step_{STEP}", f"results_{NUM_EXAMPLES}")
+            single = ResultsReader(os.path.join(root, "single", path))
+            distributed = ResultsReader(os.path.join(root, "distributed", path))
+            assert single.to_table().equals(distributed.to_table()), f"{path}: results tables differ"
+            single_stats = single.summary["generation_stats"]
+            distributed_stats = distributed.summary["generation_stats"]
+            for key in ("generated_tokens", "budget_hits", "accepted_tokens"):
+                assert single_stats[key] == distributed_stats[key], f"{path}: {key} differs"
+            print(
+                f"budget={budget}, num_draft_tokens={num_draft_tokens}: {NUM_EXAMPLES} predictions, metrics "
+                f"and results identical on {world_size} ranks ({distributed_stats['generated_tokens']} tokens, "
+                f"acceptance_rate={distributed_stats['acceptance_rate']:.3g})"
+            )
+    print(f"Evaluator on {world_size} gloo ranks matches a single process")
+
+
+if __name__ == "__main__":
+    main()
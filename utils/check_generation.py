@@ -0,0 +1,113 @@
+"""
+Check that ``GenerationEngine`` returns exactly what ``generate_greedy`` returns.
+
+A random tiny ``GPT`` (float64, so batch shapes cannot change a greedy
+choice) continues prompts of mixed lengths, with an EOS token it emits early
+for some of them and not at all for others. The engine is compared with one
+``generate_greedy`` call per prompt with fewer slots than prompts (so slots
+are freed and refilled), with per-prompt budgets, with speculative decoding
+and with the prefix cache. Re-run it after touching ``generation.py`` or
+``prefix_cache.py``::
+
+    python utils/check_generation.py
+"""
+import random
+from collections import Counter
+
+import torch
+from litgpt.config import Config
+from litgpt.model import GPT
+
+from generation import GenerationEngine, generate_greedy
+from prefix_cache import PrefixKVCache
+
+MAX_LENGTH = 64
+NUM_SLOTS = 5
+PAD = 0
+
+
+def tiny_model(seed: int = 0) -> GPT:
+    torch.manual_seed(seed)
+    config = Config(
+        block_size=MAX_LENGTH,
+        vocab_size=32,
+        padded_vocab_size=32,
+        n_layer=2,
+        n_head=4,
+        n_query_groups=2,
+        n_embd=32,
+        rotary_percentage=0.5,
+    )
+    return GPT(config).double().eval()
+
+
+def greedy_reference(model, prompts, eos_token_id, max_new_tokens=None):
+    """One ``generate_greedy`` call per prompt, cut after EOS and at the prompt's budget."""
+    if max_new_tokens is None or isinstance(max_new_tokens, int):
+        max_new_tokens = [max_new_tokens] * len(prompts)
+    outputs = []
+    for prompt, budget in zip(prompts, max_new_tokens):
+        max_length = MAX_LENGTH if budget is None else min(MAX_LENGTH, len(prompt) + budget)
+        ids = torch.tensor([prompt])
+        sequence = generate_greedy(model, ids, torch.ones_like(ids), max_length, eos_token_id, PAD)[0].tolist()
+        if eos_token_id in sequence[len(prompt) :]:
+            sequence = sequence[: sequence.index(eos_token_id, len(prompt)) + 1]
+        outputs.append(sequence)
+    return outputs
+
+
+def check(name, outputs, expected, stats):
+    mismatches = [i for i, (output, reference) in enumerate(zip(outputs, expected)) if output != reference]
+    if mismatches:
+        i = mismatches[0]
+        raise AssertionError(f"{name}: {len(mismatches)} outputs differ, e.g. prompt {i}: {outputs[i]} != {expected[i]}")
+    summary = ", ".join(f"{key}={stats[key]:.3g}" for key in ("acceptance_rate", "prefix_hit_rate", "tokens_per_decode_step"))
+    print(f"{name}: {len(outputs)} outputs identical ({summary})")
+
+
+def main():
+    rng = random.Random(0)
+    model = tiny_model()
+    # A small token range repeats n-grams, so speculative decoding gets drafts accepted
+    prompts = [[1] + [rng.randint(4, 15) for _ in range(rng.randint(0, 24))] for _ in range(40)]
+
+    # EOS is the generated token closest to appearing in half of the answers: those stop early,
+    # the others run to max_length
+    no_eos = GenerationEngine(model, NUM_SLOTS, MAX_LENGTH, -1, PAD).generate(prompts)
+    answers_with = Counter(token for prompt, output in zip(prompts, no_eos) for token in set(output[len(prompt) :]))
+    eos = max(answers_with, key=lambda token: (min(answers_with[token], len(prompts) - answers_with[token]), -token))
+    expected = greedy_reference(model, prompts, eos)
+    stopped = sum(output[-1] == eos for output in expected)
+    assert 0 < stopped < len(prompts), f"EOS {eos} should stop some but not all prompts, stops {stopped}"
+    print(f"EOS token {eos} stops {stopped}/{len(prompts)} prompts early")
+
+    engine = GenerationEngine(model, NUM_SLOTS, MAX_LENGTH, eos, PAD)
+    check("continuous batching", engine.generate(prompts), expected, engine.stats)
+
+    budgets = [rng.randint(1, 12) for _ in prompts]
+    engine = GenerationEngine(model, NUM_SLOTS, MAX_LENGTH, eos, PAD)
+    outputs = engine.generate(prompts, max_new_tokens=budgets)
+    check("per-prompt budgets", outputs, greedy_reference(model, prompts, eos, budgets), engine.stats)
+
+    for num_draft_tokens in (1, 4):
+        engine = GenerationEngine(model, NUM_SLOTS, MAX_LENGTH, eos, PAD, num_draft_tokens=num_draft_tokens)
+        check(f"speculative decoding ({num_draft_tokens} draft tokens)", engine.generate(prompts), expected, engine.stats)
+
+    # Prompts built from a few shared headers, so the prefix cache gets hits
+    headers = [[1] + [rng.randint(4, 15) for _ in range(rng.randint(8, 30))] for _ in range(3)]
+    shared = [rng.choice(headers) + [rng.randint(4, 15) for _ in range(rng.randint(0, 8))] for _ in range(30)]
+    expected = greedy_reference(model, shared, eos)
+    # A tiny budget also exercises eviction
+    for page_size, max_size_mb in ((4, 100), (8, 0.01)):
+        engine = GenerationEngine(
+            model, NUM_SLOTS, MAX_LENGTH, eos, PAD, num_draft_tokens=2, prefix_cache=PrefixKVCache(page_size, max_size_mb)
+        )
+        for run in ("cold", "warm"):
+            name = f"prefix cache (page_size={page_size}, max_size_mb={max_size_mb}, {run})"
+            check(name, engine.generate(shared), expected, engine.stats)
+
+    print("GenerationEngine matches generate_greedy")
+
+
+if __name__ == "__main__":
+    main()
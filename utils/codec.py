@@ -0,0 +1,196 @@
+"""
+Vectorized encoder/decoder for the framework's WordLevel tokenizers.
+
+Tokenizers built by ``create_tokenizer.py`` are a ``WordLevel`` model with a
+``WhitespaceSplit`` pre-tokenizer and no decoder, so encoding is "split on
+whitespace and look every word up" and decoding is "look every id up and join
+with spaces". ``WordLevelCodec`` does exactly that with a dict and a numpy
+id -> token array instead of a round trip through ``PreTrainedTokenizerFast``
+per sequence, and gives the same results as the HF tokenizer as long as
+special tokens in the text are separated by whitespace (which is how
+``data.format_example`` writes them).
+
+Run ``python utils/benchmark_codec.py`` to check it against the HF tokenizer
+and time both on a 100k-example set built from ``data.test_file``.
+"""
+import json
+import time
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+# Replacements applied by ``transformers`` when ``clean_up_tokenization_spaces`` is set
+_CLEAN_UP_REPLACEMENTS = [
+    (" .", "."),
+    (" ?", "?"),
+    (" !", "!"),
+    (" ,", ","),
+    (" ' ", "'"),
+    (" n't", "n't"),
+    (" 'm", "'m"),
+    (" 's", "'s"),
+    (" 've", "'ve"),
+    (" 're", "'re"),
+]
+
+
+class WordLevelCodec:
+    """
+    Args:
+        vocab: Token -> id, including the added (special) tokens.
+        special_tokens: Tokens dropped by ``skip_special_tokens``.
+        unk_token: Token used for words missing from the vocabulary. If it is
+            None (or not in ``vocab``) unknown words raise a ValueError, like
+            the tokenizers library does when the WordLevel model lacks its unk token.
+        clean_up_tokenization_spaces: Mirror the HF tokenizer's flag of the same name.
+    """
+
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        special_tokens: Iterable[str],
+        unk_token: Optional[str] = "[UNK]",
+        clean_up_tokenization_spaces: bool = False,
+    ):
+        self.vocab = dict(vocab)
+        self.unk_token_id = None if unk_token is None else self.vocab.get(unk_token)
+        self.clean_up_tokenization_spaces = clean_up_tokenization_spaces
+
+        # Ids without a token decode to nothing, like in `tokenizers`
+        self.id_to_token = np.full(max(self.vocab.values()) + 1, None, dtype=object)
+        for token, idx in self.vocab.items():
+            self.id_to_token[idx] = token
+
+        self.is_missing = np.array([token is None for token in self.id_to_token], dtype=bool)
+        self.special_ids = np.array(sorted(self.vocab[t] for t in special_tokens if t in self.vocab), dtype=np.int64)
+        self.is_special = self.is_missing.copy()
+        self.is_special[self.special_ids] = True
+
+    @classmethod
+    def from_json(cls, tokenizer_json: Dict, clean_up_tokenization_spaces: bool = False) -> "WordLevelCodec":
+        model = tokenizer_json["model"]
+        if model["type"] != "WordLevel":
+            raise ValueError(f"WordLevelCodec only supports WordLevel tokenizers, got {model['type']}")
+
+        vocab = dict(model["vocab"])
+        # The WordLevel model only falls back to its unk token if the token is part of the model vocab
+        unk_token = model.get("unk_token")
+        if unk_token not in vocab:
+            unk_token = None
+
+        special_tokens = []
+        for added in tokenizer_json.get("added_tokens", []):
+            vocab[added["content"]] = added["id"]
+            if added.get("special", False):
+                special_tokens.append(added["content"])
+        return cls(vocab, special_tokens, unk_token, clean_up_tokenization_spaces)
+
+    @classmethod
+    def from_file(cls, tokenizer_path: str, clean_up_tokenization_spaces: bool = False) -> "WordLevelCodec":
+        """Build the codec from a ``tokenizer.json`` file."""
+        with open(tokenizer_path, "r") as f:
+            return cls.from_json(json.load(f), clean_up_tokenization_spaces)
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer) -> "WordLevelCodec":
+        """Build the codec from a ``PreTrainedTokenizerFast``, keeping its decoding settings."""
+        return cls.from_json(
+            json.loads(tokenizer.backend_tokenizer.to_str()),
+            bool(getattr(tokenizer, "clean_up_tokenization_spaces", False)),
+        )
+
+    def encode(self, text: str) -> List[int]:
+        if self.unk_token_id is not None:
+            vocab_get = self.vocab.get
+            unk = self.unk_token_id
+            return [vocab_get(word, unk) for word in text.split()]
+
+        vocab = self.vocab
+        try:
+            return [vocab[word] for word in text.split()]
+        except KeyError as e:
+            raise ValueError(f"Token {e.args[0]!r} is missing from the vocabulary") from None
+
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        return [self.encode(text) for text in texts]
+
+    def _join(self, tokens: np.ndarray) -> str:
+        text = " ".join(tokens.tolist())
+        if self.clean_up_tokenization_spaces:
+            for old, new in _CLEAN_UP_REPLACEMENTS:
+                text = text.replace(old, new)
+        return text
+
+    def decode(self, ids: Sequence[int], skip_special_tokens: bool = False) -> str:
+        return self.decode_batch([ids], skip_special_tokens)[0]
+
+    def decode_batch(self, batch_ids: Sequence[Sequence[int]], skip_special_tokens: bool = False) -> List[str]:
+        """Decode ragged sequences of ids with one vectorized lookup for the whole batch."""
+        lengths = np.fromiter((len(ids) for ids in batch_ids), dtype=np.int64, count=len(batch_ids))
+        flat = np.fromiter((i for ids in batch_ids for i in ids), dtype=np.int64, count=int(lengths.sum()))
+        return self.decode_flat(flat, lengths, skip_special_tokens)
+
+    def decode_padded(self, ids, lengths, skip_special_tokens: bool = False) -> List[str]:
+        """
+        Decode the first ``lengths[i]`` ids of every row of a padded 2D array or tensor.
+        """
+        ids = np.asarray(ids.cpu() if hasattr(ids, "cpu") else ids, dtype=np.int64)
+        lengths = np.asarray(lengths.cpu() if hasattr(lengths, "cpu") else lengths, dtype=np.int64)
+        keep = np.arange(ids.shape[1])[None, :] < lengths[:, None]
+        return self.decode_flat(ids[keep], lengths, skip_special_tokens)
+
+    def decode_flat(self, flat, lengths, skip_special_tokens: bool = False) -> List[str]:
+        """Decode rows stored back to back in ``flat``, row ``i`` being ``lengths[i]`` ids long."""
+        flat = np.asarray(flat, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        in_vocab = (flat >= 0) & (flat < len(self.id_to_token))
+        drop = ~in_vocab
+        drop[in_vocab] = (self.is_special if skip_special_tokens else self.is_missing)[flat[in_vocab]]
+
+        tokens = self.id_to_token[np.where(in_vocab, flat, 0)]
+        # Count what survives per row, then split the kept tokens back into rows
+        row_ids = np.repeat(np.arange(len(lengths)), lengths)
+        kept_lengths = np.bincount(row_ids[~drop], minlength=len(lengths))
+        kept_tokens = tokens[~drop]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(kept_lengths, out=offsets[1:])
+        return [self._join(kept_tokens[offsets[i] : offsets[i + 1]]) for i in range(len(lengths))]
+
+
+def benchmark(tokenizer, texts: List[str]) -> Dict[str, float]:
+    """
+    Check the codec against the HF tokenizer on ``texts`` and time both.
+
+    Returns:
+        Seconds taken by each implementation for batch encoding and for batch
+        decoding with special tokens kept and skipped.
+    """
+    codec = WordLevelCodec.from_tokenizer(tokenizer)
+
+    start = time.perf_counter()
+    hf_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+    hf_encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    codec_ids = codec.encode_batch(texts)
+    codec_encode = time.perf_counter() - start
+    if hf_ids != codec_ids:
+        raise AssertionError("WordLevelCodec.encode_batch differs from the HF tokenizer")
+
+    timings = {"hf_encode": hf_encode, "codec_encode": codec_encode}
+    for skip_special_tokens in (False, True):
+        step = "decode_skip_special" if skip_special_tokens else "decode_keep_special"
+        start = time.perf_counter()
+        hf_texts = tokenizer.batch_decode(hf_ids, skip_special_tokens=skip_special_tokens)
+        timings[f"hf_{step}"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        codec_texts = codec.decode_batch(hf_ids, skip_special_tokens=skip_special_tokens)
+        timings[f"codec_{step}"] = time.perf_counter() - start
+        if hf_texts != codec_texts:
+            raise AssertionError(
+                f"WordLevelCodec.decode_batch differs from the HF tokenizer (skip_special_tokens={skip_special_tokens})"
+            )
+
+    return timings
+
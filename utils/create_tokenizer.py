@@ -1,9 +1,13 @@
 """
 Tokenizer creation and vocabulary building module.
 """
+import collections
+import itertools
 import json
 import os
-from typing import Dict, List, Set
+import time
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Tuple, Union
 
 import hydra
 from omegaconf import DictConfig
@@ -11,8 +15,11 @@ from tokenizers import Tokenizer
 from tokenizers.models import WordLevel
 from tokenizers.pre_tokenizers import WhitespaceSplit
 
+from data import expand_data_files, is_jsonl, iter_examples
+
 
 SPECIAL_TOKENS = ["[BOS]", "[PAD]", "[MASK]", "[UNK]", "[EOS]"]
+VOCAB_COUNTS_FILE = "vocab_counts.json"
 
 
 @hydra.main(config_path="../config", config_name="base", version_base=None)
@@ -23,17 +30,23 @@ def main(cfg: DictConfig) -> None:
     Args:
         cfg: Configuration object from Hydra.
     """
-    vocab = get_vocab(cfg)
+    vocab, counts = get_vocab(cfg)
     tokenizer = create_tokenizer(vocab, cfg)
     print(f"Tokenizer saved to: {cfg.data.tokenizer_path}")
 
+    # Saved next to the tokenizer, in id order
+    counts_path = os.path.join(os.path.dirname(cfg.data.tokenizer_path), VOCAB_COUNTS_FILE)
+    with open(counts_path, "w") as f:
+        json.dump({token: counts[token] for token in vocab}, f, indent=2)
+    print(f"Token counts saved to: {counts_path}")
+
 
-def create_tokenizer(vocab: Set[str], cfg: DictConfig) -> Tokenizer:
+def create_tokenizer(vocab: List[str], cfg: DictConfig) -> Tokenizer:
     """
     Create and save a WordLevel tokenizer with the given vocabulary.
     
     Args:
-        vocab: Set of vocabulary tokens.
+        vocab: Vocabulary tokens in id order; special tokens get the ids after them.
         cfg: Configuration object from Hydra.
         
     Returns:
@@ -71,48 +84,94 @@ def create_tokenizer(vocab: Set[str], cfg: DictConfig) -> Tokenizer:
     return tokenizer
 
 
-def get_vocab(cfg: DictConfig) -> Set[str]:
+def _count_tokens(examples: List[Union[str, Dict]]) -> collections.Counter:
+    """Whitespace token counts of the inputs and outputs of a batch of examples (runs in a worker)."""
+    counts = collections.Counter()
+    for example in examples:
+        # JSONL lines arrive unparsed, so parsing is spread over the workers too
+        if isinstance(example, str):
+            example = json.loads(example)
+        counts.update(example["input"].split())
+        counts.update(example["output"].split())
+    return counts
+
+
+def _examples(path: str) -> Iterator[Union[str, Dict]]:
+    """Raw lines of a JSONL file, or the parsed examples of a JSON array."""
+    if not is_jsonl(path):
+        yield from iter_examples(path)
+        return
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def _example_batches(paths: List[str], batch_size: int) -> Iterator[List[Union[str, Dict]]]:
+    examples = itertools.chain.from_iterable(_examples(path) for path in paths)
+    while True:
+        batch = list(itertools.islice(examples, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def count_tokens(paths: List[str], num_proc: int = 1, batch_size: int = 10000) -> collections.Counter:
     """
-    Build vocabulary from training and validation files.
-    
-    Args:
-        cfg: Configuration object containing file paths.
-        
-    Returns:
-        Set of unique tokens for vocabulary.
+    Count whitespace-separated tokens over data files without loading them.
+
+    Examples are streamed from the files and counted in batches across
+    ``num_proc`` processes, with a bounded number of batches in flight, so
+    memory stays flat no matter how big the corpus is.
     """
-    train_data = _load_json_file(cfg.data.train_file)
-    val_data = _load_json_file(cfg.data.test_file)
-    
-    combined_data = train_data + val_data
-    
-    # Extract both input and output text from the new data format
-    all_text = []
-    for item in combined_data:
-        all_text.append(item["input"])
-        all_text.append(item["output"])
-    
-    # Join all text and split into tokens
-    combined_text = " ".join(all_text)
-    vocab = set(combined_text.split())
+    counts = collections.Counter()
+    batches = _example_batches(paths, batch_size)
+    if num_proc <= 1:
+        for examples in batches:
+            counts.update(_count_tokens(examples))
+        return counts
 
-    vocab.add(cfg.data.split_str)
-    
-    return vocab
+    with Pool(num_proc) as pool:
+        pending = collections.deque()
+        for examples in batches:
+            pending.append(pool.apply_async(_count_tokens, (examples,)))
+            if len(pending) >= 2 * num_proc:
+                counts.update(pending.popleft().get())
+        while pending:
+            counts.update(pending.popleft().get())
+    return counts
 
 
-def _load_json_file(file_path: str) -> List[Dict]:
+def get_vocab(cfg: DictConfig) -> Tuple[List[str], collections.Counter]:
     """
-    Helper function to load and parse JSON files.
+    Build vocabulary from training and validation files.
     
     Args:
-        file_path: Path to the JSON file.
+        cfg: Configuration object containing file paths.
         
     Returns:
-        Parsed JSON content.
+        Unique tokens, most frequent first and ties in lexical order, and
+        their counts. The order only depends on the data, so token ids are
+        the same in every build.
     """
-    with open(file_path, "rb") as f:
-        return json.load(f)
+    start = time.time()
+    counts = count_tokens(
+        expand_data_files(cfg.data.train_file) + expand_data_files(cfg.data.test_file),
+        num_proc=int(cfg.data.vocab.num_proc),
+        batch_size=int(cfg.data.vocab.batch_size),
+    )
+    if cfg.data.split_str not in counts:
+        counts[cfg.data.split_str] = 0
+    vocab = sorted(counts, key=lambda token: (-counts[token], token))
+
+    total = sum(counts.values())
+    print(f"Counted {total} tokens ({len(vocab)} unique) in {time.time() - start:.1f}s")
+    print(f"Tokens seen only once: {sum(1 for count in counts.values() if count == 1)}")
+    print("Most frequent tokens:")
+    for token in vocab[:10]:
+        print(f"  {token!r}: {counts[token]} ({counts[token] / max(total, 1):.2%})")
+
+    return vocab, counts
 
 
 if __name__ == "__main__":
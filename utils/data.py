@@ -1,44 +1,248 @@
+import glob
+import json
 import pickle
+import time
+import numpy as np
 import torch
 import os
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, DistributedSampler
 from lightning import LightningDataModule
-from transformers import DataCollatorForLanguageModeling
+from lightning.pytorch.utilities import rank_zero_only
 from torch.nn.utils.rnn import pad_sequence
 from datasets import load_dataset
 from omegaconf import DictConfig, OmegaConf
 from transformers import PreTrainedTokenizerFast
 from hydra.utils import get_original_cwd, to_absolute_path
-from typing import Optional, Union
+from typing import List, Optional, Union
 from litgpt.tokenizer import Tokenizer
 from collections import defaultdict
 import os
 from datasets import Dataset, DatasetDict
 
+try:
+    from utils.samplers import LengthGroupedBatchSampler, padding_report
+    from utils.token_cache import POLL_SECONDS, TokenCache
+    from utils.token_store import STORE_VERSION, TokenStore, TokenStoreWriter
+except ImportError:
+    from samplers import LengthGroupedBatchSampler, padding_report
+    from token_cache import POLL_SECONDS, TokenCache
+    from token_store import STORE_VERSION, TokenStore, TokenStoreWriter
+
+# Truncation length of get_data(for_info=True), long enough to see how long examples really are
+INFO_MAX_LENGTH = 6144
+
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
+class PadCollator:
+    """
+    Pad a batch of ragged rows to the longest row of the batch.
+
+    Rows are stored unpadded, so this is the only place padding happens.
+    Padding goes on the right. Labels are final: -100 on the prompt (taken
+    from the row's precomputed ``prompt_length``, or ready-made ``labels`` for
+    packed rows) and on padding. Packed rows also carry per-document
+    ``position_ids``, which are padded with 0.
+    """
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, examples):
+        lengths = [len(example["input_ids"]) for example in examples]
+        width = max(lengths)
+        packed = "position_ids" in examples[0]
+
+        input_ids = torch.full((len(examples), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(examples), width), dtype=torch.long)
+        labels = torch.full((len(examples), width), -100, dtype=torch.long)
+        if packed:
+            position_ids = torch.zeros((len(examples), width), dtype=torch.long)
+        for i, (example, length) in enumerate(zip(examples, lengths)):
+            row = torch.as_tensor(example["input_ids"], dtype=torch.long)
+            input_ids[i, :length] = row
+            attention_mask[i, :length] = 1
+            if packed:
+                labels[i, :length] = torch.as_tensor(example["labels"], dtype=torch.long)
+                position_ids[i, :length] = torch.as_tensor(example["position_ids"], dtype=torch.long)
+            else:
+                prompt_length = example["prompt_length"]
+                labels[i, prompt_length:length] = row[prompt_length:]
+
+        batch = {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+        if packed:
+            batch["position_ids"] = position_ids
+        return batch
+
+
+class PackedDataset:
+    """
+    Pack several short examples into rows of at most ``block_size`` tokens.
+
+    Examples are shuffled once with ``seed`` and greedily appended to the
+    current row until the next one does not fit. Every row carries
+    ``position_ids`` that restart at 0 for each example, which the model uses
+    to reset positions and attention per document, and ``labels`` with the
+    prompt of every example masked.
+    """
+
+    def __init__(self, dataset, block_size, seed=0):
+        self.dataset = dataset
+        self.block_size = block_size
+
+        lengths = get_lengths(dataset)
+        order = np.random.default_rng(seed).permutation(len(lengths))
+
+        self.packs = []
+        pack_lengths = []
+        current, current_length = [], 0
+        for idx, length in zip(order.tolist(), lengths[order].tolist()):
+            if current and current_length + length > block_size:
+                self.packs.append(current)
+                pack_lengths.append(current_length)
+                current, current_length = [], 0
+            current.append(idx)
+            current_length += length
+        if current:
+            self.packs.append(current)
+            pack_lengths.append(current_length)
+        self.lengths = np.asarray(pack_lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, idx):
+        input_ids = []
+        position_ids = []
+        labels = []
+        for example_idx in self.packs[idx]:
+            example = self.dataset[example_idx]
+            example_ids = example["input_ids"]
+            prompt_length = example["prompt_length"]
+            input_ids.extend(example_ids)
+            position_ids.extend(range(len(example_ids)))
+            labels.extend([-100] * prompt_length)
+            labels.extend(example_ids[prompt_length:])
+        return {
+            "input_ids": input_ids,
+            "position_ids": position_ids,
+            "labels": labels,
+            "length": len(input_ids),
+        }
+
+
+def get_lengths(dataset):
+    """Token count of every row of a tokenized split (TokenStore, PackedDataset or HF dataset)."""
+    if isinstance(dataset, (TokenStore, PackedDataset)):
+        return dataset.lengths
+    return np.asarray(dataset["length"], dtype=np.int64)
+
+
+def split_lengths(dataset):
+    """
+    Row and prompt lengths of a tokenized split (TokenStore or HF dataset) as int64 arrays.
+
+    Read from the stored length columns, without touching the token ids.
+    """
+    if isinstance(dataset, TokenStore):
+        return dataset.lengths.astype(np.int64), np.asarray(dataset.prompt_lengths, dtype=np.int64)
+    columns = dataset.with_format("numpy", columns=["length", "prompt_length"])
+    return np.asarray(columns["length"], dtype=np.int64), np.asarray(columns["prompt_length"], dtype=np.int64)
+
+
 class Datamodule(LightningDataModule):
-    def __init__(self, dataset, batch_size, num_workers, tokenizer):
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        num_workers,
+        tokenizer,
+        sampler="random",
+        max_tokens=None,
+        bucket_size=100,
+        seed=0,
+        packing=False,
+    ):
         super(Datamodule, self).__init__()
         self.dataset = dataset
         self.batch_size = batch_size
         self.num_workers = num_workers
-        self.collate_fn_pad = DataCollatorForLanguageModeling(tokenizer, mlm=False)
+        self.collate_fn_pad = PadCollator(tokenizer.pad_token_id)
+
+        # "random" shuffles examples, "bucketed" groups examples of similar length
+        if sampler not in ("random", "bucketed"):
+            raise ValueError(f"Unknown sampler: {sampler}")
+        self.sampler = sampler
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.seed = seed
+
+        # Packed rows are already close to block_size long, so length bucketing does not apply
+        if packing and sampler != "random":
+            raise ValueError("Sequence packing only supports the random sampler")
+        self.packing = packing
 
     def setup(self, stage=None):
-        self.train_dataset = self.dataset["train"]
-        self.val_dataset = self.dataset["val"]
-        self.test_dataset = self.dataset["test"]
+        # Inference only provides a test split
+        self.train_dataset = self.dataset.get("train")
+        self.val_dataset = self.dataset.get("val")
+        self.test_dataset = self.dataset.get("test")
+        if self.packing:
+            if self.max_seq_length <= 0:
+                raise ValueError("Sequence packing needs a block size, call connect(max_seq_length=...) first")
+            self.train_dataset = PackedDataset(self.train_dataset, self.max_seq_length, seed=self.seed)
 
     def connect(self, max_seq_length: Optional[int] = None) -> None:
         self.max_seq_length = -1 if max_seq_length is None else max_seq_length
 
+    def replicas(self):
+        """(number of ranks, this rank) of the attached trainer; (1, 0) without one or on a single device."""
+        if self.trainer is None or self.trainer.world_size <= 1:
+            return 1, 0
+        return self.trainer.world_size, self.trainer.global_rank
+
+    def distributed_sampler(self, dataset, shuffle):
+        """Per-rank sampler for multi-device runs, None otherwise (the trainer runs with use_distributed_sampler=False)."""
+        num_replicas, rank = self.replicas()
+        if num_replicas == 1:
+            return None
+        return DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=self.seed)
+
+    def train_batch_sampler(self):
+        num_replicas, rank = self.replicas()
+        return LengthGroupedBatchSampler(
+            get_lengths(self.train_dataset),
+            batch_size=self.batch_size,
+            max_tokens=self.max_tokens,
+            bucket_size=self.bucket_size,
+            seed=self.seed,
+            num_replicas=num_replicas,
+            rank=rank,
+        )
+
+    def padding_report(self):
+        """Padding efficiency of the training batches compared to plain shuffling."""
+        if self.sampler == "bucketed":
+            batches = self.train_batch_sampler().batches(epoch=0)
+        else:
+            order = np.random.default_rng(self.seed).permutation(len(self.train_dataset))
+            batches = [order[i : i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        return padding_report(get_lengths(self.train_dataset), batches, self.batch_size, seed=self.seed)
+
     def train_dataloader(self):
+        if self.sampler == "bucketed":
+            return DataLoader(
+                self.train_dataset,
+                batch_sampler=self.train_batch_sampler(),
+                num_workers=self.num_workers,
+                collate_fn=self.collate_fn_pad,
+            )
+        sampler = self.distributed_sampler(self.train_dataset, shuffle=True)
         return DataLoader(
             self.train_dataset,
             batch_size=self.batch_size,
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             num_workers=self.num_workers,
             drop_last=False,
             collate_fn=self.collate_fn_pad,
@@ -49,6 +253,7 @@ class Datamodule(LightningDataModule):
             self.val_dataset,
             batch_size=self.batch_size,
             shuffle=False,
+            sampler=self.distributed_sampler(self.val_dataset, shuffle=False),
             num_workers=self.num_workers,
             drop_last=False,
             collate_fn=self.collate_fn_pad,
@@ -59,15 +264,232 @@ class Datamodule(LightningDataModule):
             self.test_dataset,
             batch_size=self.batch_size,
             shuffle=False,
+            sampler=self.distributed_sampler(self.test_dataset, shuffle=False),
             num_workers=self.num_workers,
             drop_last=False,
             collate_fn=self.collate_fn_pad,
         )
 
 
+def expand_data_files(pattern) -> List[str]:
+    """
+    Absolute paths of a data file setting: a single file, or a glob of shards
+    (e.g. ``data/shards/train-*.jsonl``) in sorted order.
+    """
+    path = to_absolute_path(pattern)
+    if not any(char in path for char in "*?["):
+        return [path]
+    paths = sorted(glob.glob(path))
+    if not paths:
+        raise FileNotFoundError(f"No data files match {pattern}")
+    return paths
+
+
+def is_jsonl(path, chunk_size=1 << 16):
+    """Whether a data file is JSONL rather than a JSON array, from its first non-blank character."""
+    with open(path, "r") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return False
+            chunk = chunk.lstrip()
+            if chunk:
+                return chunk[0] != "["
+
+
+def iter_examples(path, chunk_size=1 << 20):
+    """
+    Yield the examples of a data file one at a time.
+
+    Handles both a JSON array (``[{...}, {...}]``) and JSONL (one object per
+    line), reading ``chunk_size`` characters at a time so the whole file is
+    never in memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer = f.read(chunk_size)
+        pos = len(buffer) - len(buffer.lstrip())
+        if pos == len(buffer):
+            return
+
+        if buffer[pos] != "[":
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        pos += 1
+        while True:
+            # Skip separators, refilling the buffer when it runs out
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                buffer = f.read(chunk_size)
+                pos = 0
+                if not buffer:
+                    raise ValueError(f"Unterminated JSON array in {path}")
+                continue
+            if buffer[pos] == "]":
+                return
+
+            try:
+                example, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The example continues in the next chunk
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+
+            yield example
+            pos = end
+            if pos > chunk_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+def format_example(tokenizer, split_str, input_text, output_text):
+    # Use the split_str as a delimiter between input and output
+    # This will be used for masking during training
+    return tokenizer.bos_token + " " + input_text + " " + split_str + " " + output_text + " " + tokenizer.eos_token
+
+
+def get_prompt_lengths(batch_ids, delimiter_token_id):
+    """
+    Number of prompt tokens (up to and including the delimiter) of every row.
+
+    Rows without a delimiter (truncated before it) are all prompt, so none of
+    their tokens are trained on.
+    """
+    prompt_lengths = []
+    for ids in batch_ids:
+        try:
+            prompt_lengths.append(ids.index(delimiter_token_id) + 1)
+        except ValueError:
+            prompt_lengths.append(len(ids))
+    return prompt_lengths
+
+
+def get_delimiter_token_id(cfg: DictConfig, tokenizer):
+    return tokenizer.encode(cfg.data.split_str, add_special_tokens=False)[0]
+
+
+def build_token_store(cfg: DictConfig, tokenizer, data_file, store_path, max_length, metadata=None):
+    """Tokenize a JSON split (one file or a list of shards, in order) once and write it to a memory-mapped token store."""
+    hf_dataset = load_dataset("json", data_files={"data": data_file})["data"]
+    delimiter_token_id = get_delimiter_token_id(cfg, tokenizer)
+
+    source = data_file if isinstance(data_file, str) else f"{len(data_file)} shards ({data_file[0]}, ...)"
+    print(f"Building token store {store_path} from {source}...")
+    with TokenStoreWriter(store_path, len(tokenizer), metadata=metadata) as writer:
+        for examples in hf_dataset.iter(batch_size=1000):
+            texts = [
+                format_example(tokenizer, cfg.data.split_str, input_text, output_text)
+                for input_text, output_text in zip(examples["input"], examples["output"])
+            ]
+            outputs = tokenizer(
+                texts,
+                truncation=max_length is not None,
+                max_length=max_length,
+                return_overflowing_tokens=False,
+            )
+            writer.add_batch(
+                outputs["input_ids"], get_prompt_lengths(outputs["input_ids"], delimiter_token_id)
+            )
+
+    return TokenStore(store_path)
+
+
+def get_token_store(cfg: DictConfig, tokenizer, data_file, max_length, build=True):
+    """
+    Tokenized view of a JSON file (or a list of shards), served from the shared token cache.
+
+    The cache key covers the content of the data file(s) and of tokenizer.json,
+    split_str, the truncation length (None: no truncation) and the store
+    format, so train.py, get_data_info.py, filter_data.py and inference.py
+    all reuse each other's stores.
+
+    With ``build=False`` nothing is hashed, built or evicted: the call waits
+    for another process (global rank 0 of a multi-process run) to record the
+    digests and build the store, then opens it.
+    """
+    cache = TokenCache(
+        to_absolute_path(cfg.data.token_store.path),
+        cfg.data.token_store.max_size_gb,
+        cfg.data.token_store.min_idle_hours,
+    )
+    tokenizer_file = to_absolute_path(cfg.data.tokenizer_path)
+    wait = not build
+    if isinstance(data_file, str):
+        data_digest = cache.file_digest(data_file, wait=wait)
+    elif len(data_file) == 1:
+        data_file = data_file[0]
+        data_digest = cache.file_digest(data_file, wait=wait)
+    else:
+        data_file = list(data_file)
+        data_digest = [cache.file_digest(path, wait=wait) for path in data_file]
+    key = cache.key(
+        data=data_digest,
+        tokenizer=cache.file_digest(tokenizer_file, wait=wait),
+        split_str=cfg.data.split_str,
+        max_length=max_length,
+        version=STORE_VERSION,
+    )
+    store_path = cache.entry_path(key)
+
+    if not build:
+        waiting = False
+        while True:
+            try:
+                return TokenStore(store_path)
+            except FileNotFoundError:
+                if not waiting:
+                    print(f"Rank {rank_zero_only.rank} waiting for global rank 0 to build token store {store_path}")
+                    waiting = True
+                time.sleep(POLL_SECONDS)
+
+    try:
+        store = TokenStore(store_path)
+        cache.touch(key)
+    except FileNotFoundError:
+        metadata = {"source_file": data_file, "split_str": cfg.data.split_str, "max_length": max_length}
+        store = build_token_store(cfg, tokenizer, data_file, store_path, max_length, metadata=metadata)
+        # The new entry is opened (and locked) before anything is evicted
+        cache.touch(key)
+        cache.evict()
+    return store
+
+
+def get_token_store_data(cfg: DictConfig, tokenizer, for_info=False):
+    train_file = expand_data_files(cfg.data.train_file)
+    test_file = expand_data_files(cfg.data.test_file)
+    max_length = cfg.model.block_size if not for_info else INFO_MAX_LENGTH
+
+    # Under srun every rank runs this at once: global rank 0 tokenizes, the others open its stores
+    build = rank_zero_only.rank == 0
+    train_store = get_token_store(cfg, tokenizer, train_file, max_length, build=build)
+    test_store = get_token_store(cfg, tokenizer, test_file, max_length, build=build)
+    datasets = {"train": train_store, "val": test_store, "test": test_store}
+
+    if cfg.data.sampling.sample_train_set:
+        datasets["train"] = datasets["train"].select(range(int(cfg.data.sampling.num_train)))
+    if cfg.data.sampling.sample_test_set:
+        datasets["test"] = datasets["test"].select(range(int(cfg.data.sampling.num_test)))
+    if cfg.data.sampling.sample_val_set:
+        datasets["val"] = datasets["val"].select(range(int(cfg.data.sampling.num_val)))
+
+    return datasets
+
+
 def get_data(cfg: DictConfig, tokenizer, for_info=False):
-    train_file = to_absolute_path(cfg.data.train_file)
-    test_file = to_absolute_path(cfg.data.test_file)
+    if cfg.data.token_store.enabled:
+        return get_token_store_data(cfg, tokenizer, for_info)
+
+    train_file = expand_data_files(cfg.data.train_file)
+    test_file = expand_data_files(cfg.data.test_file)
 
     hf_dataset = load_dataset(
         "json",
@@ -84,26 +506,29 @@ def get_data(cfg: DictConfig, tokenizer, for_info=False):
     if cfg.data.sampling.sample_val_set:
         hf_dataset["val"] = hf_dataset["val"].select(range(int(cfg.data.sampling.num_val)))
 
+    delimiter_token_id = get_delimiter_token_id(cfg, tokenizer)
+
     def tokenize(examples):
         # Format input and output with delimiter between them
         texts = []
         for i in range(len(examples["input"])):
             input_text = examples["input"][i]
             output_text = examples["output"][i]
-            
-            # Use the split_str as a delimiter between input and output
-            # This will be used for masking during training
-            full_text = tokenizer.bos_token + " " + input_text + " " + cfg.data.split_str + " " + output_text + " " + tokenizer.eos_token
-            texts.append(full_text)
+            texts.append(format_example(tokenizer, cfg.data.split_str, input_text, output_text))
         
+        # Rows are stored unpadded; PadCollator pads each batch to its longest row
         outputs = tokenizer(
             texts,
             truncation=True,
-            max_length=cfg.model.block_size if not for_info else 6144,
-            padding='longest',
+            max_length=cfg.model.block_size if not for_info else INFO_MAX_LENGTH,
             return_overflowing_tokens=False,
         )
-        return {"input_ids": outputs["input_ids"]}
+        # The prompt length fixes the loss mask, so PadCollator can build final labels without searching for [OUT]
+        return {
+            "input_ids": outputs["input_ids"],
+            "length": [len(ids) for ids in outputs["input_ids"]],
+            "prompt_length": get_prompt_lengths(outputs["input_ids"], delimiter_token_id),
+        }
 
     # Remove both "input" and "output" columns after tokenization
     tokenized_dataset = hf_dataset.map(
@@ -114,8 +539,18 @@ def get_data(cfg: DictConfig, tokenizer, for_info=False):
 
 
 def get_data_for_inference(cfg, datapaths, tokenizer):
+    if cfg.data.token_store.enabled:
+        tokenized_datasets = []
+        for test_path in datapaths:
+            store = get_token_store(cfg, tokenizer, os.path.abspath(test_path), cfg.model.block_size)
+            if cfg.inference.sampling.sample_test_set:
+                store = store.select(range(int(cfg.inference.sampling.num_test)))
+            tokenized_datasets.append({"test": store})
+        return tokenized_datasets
+
     tokenized_datasets = []
     empty_dataset = Dataset.from_dict({"input": [], "output": []})
+    delimiter_token_id = get_delimiter_token_id(cfg, tokenizer)
     
     for test_path in datapaths:
         hf_dataset = load_dataset(
@@ -137,19 +572,20 @@ def get_data_for_inference(cfg, datapaths, tokenizer):
             for i in range(len(examples["input"])):
                 input_text = examples["input"][i]
                 output_text = examples["output"][i]
-            
-                full_text = tokenizer.bos_token + " " + input_text + " " + cfg.data.split_str + " " + output_text + " " + tokenizer.eos_token
-                texts.append(full_text)
+                texts.append(format_example(tokenizer, cfg.data.split_str, input_text, output_text))
             
             try:
                 outputs = tokenizer(
                     texts,
                     truncation=True,
                     max_length=cfg.model.block_size,
-                    padding='longest',
                     return_overflowing_tokens=False,
                 )
-                return {"input_ids": outputs["input_ids"]}
+                return {
+                    "input_ids": outputs["input_ids"],
+                    "length": [len(ids) for ids in outputs["input_ids"]],
+                    "prompt_length": get_prompt_lengths(outputs["input_ids"], delimiter_token_id),
+                }
             except Exception as e:
                 # Print the failing examples
                 for i, text in enumerate(texts):
@@ -20,9 +20,22 @@ import torch
 from pathlib import Path
 from datetime import datetime
 
+try:
+    from utils.codec import WordLevelCodec
+    from utils.generation import GenerationEngine, combine_stats, generation_budgets, hf_generate
+    from utils.prompts import PromptSet
+    from utils.metrics import accuracy_curves, drop_ids, flatten_rows, sequence_metrics, summarize
+    from utils.results_io import ResultsWriter, id_lists
+except ImportError:
+    from codec import WordLevelCodec
+    from generation import GenerationEngine, combine_stats, generation_budgets, hf_generate
+    from prompts import PromptSet
+    from metrics import accuracy_curves, drop_ids, flatten_rows, sequence_metrics, summarize
+    from results_io import ResultsWriter, id_lists
 
-def convert_litgpt_to_hf(cfg):
 
+def save_hf_checkpoint(cfg):
+    """Convert the LitGPT checkpoint in convert_hf.in_path to a HF checkpoint in convert_hf.out_path."""
     out_dir = Path(cfg.convert_hf.out_path)
     out_dir.mkdir(parents=True, exist_ok=True)
     source_dir = Path(cfg.convert_hf.in_path)
@@ -32,201 +45,255 @@ def convert_litgpt_to_hf(cfg):
     copy_config_files(source_dir=source_dir, out_dir=out_dir)
     convert_lit_checkpoint(checkpoint_dir=source_dir, output_dir=out_dir)
 
-    state_dict = torch.load(out_dir / "model.pth")
+    # Written by convert_lit_checkpoint just above; its lazy format needs the full unpickler on torch >= 2.6
+    state_dict = torch.load(out_dir / "model.pth", weights_only=False)
     torch.save(state_dict, model_path)
-    hf_model = AutoModelForCausalLM.from_pretrained(
+    return out_dir
+
+
+def load_hf_checkpoint(out_dir):
+    return AutoModelForCausalLM.from_pretrained(
         out_dir,
         torch_dtype=torch.bfloat16,
         local_files_only=True,
         # state_dict=state_dict,
         attn_implementation="flash_attention_2",
     )
-    return hf_model
+
+
+def convert_litgpt_to_hf(cfg):
+    return load_hf_checkpoint(save_hf_checkpoint(cfg))
+
+
+def dist_info():
+    """(rank, world size) of the default process group, (0, 1) without one."""
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
 
 
 class Evaluator:
-    def __init__(self, config, test_set, tokenizer, split_str, step=None, model=None):
+    def __init__(self, config, test_set, tokenizer, split_str, step=None, model=None, prompts=None, backend=None):
         self.config = config
         self.num_examples = config.eval.num_examples
         self.batch_size = config.eval.batch_size
         self.global_step = step
         self.tokenizer = tokenizer
+        self.codec = WordLevelCodec.from_tokenizer(tokenizer)
         self.results_dir = config.eval.results_dir
         self.model = model
-        self.hf_model = convert_litgpt_to_hf(config)
+        # "lit": greedy decoding on the live LitGPT model with its KV cache
+        # "hf": convert the saved checkpoint to HF and use `generate`
+        self.backend = backend if backend is not None else config.eval.backend
+        if self.backend not in ("lit", "hf"):
+            raise ValueError(f"Unknown eval backend {self.backend}, expected 'lit' or 'hf'")
+        # Under torch.distributed every rank generates for its share of the prompts
+        self.rank, self.world_size = dist_info()
+        self.hf_model = None
+        if self.backend == "hf":
+            # Rank 0 converts, the others wait for the checkpoint and load it
+            if self.rank == 0:
+                save_hf_checkpoint(config)
+            if self.world_size > 1:
+                torch.distributed.barrier()
+            self.hf_model = load_hf_checkpoint(config.convert_hf.out_path)
         self.test_set = test_set
         self.step = step
         self.split_str = split_str
-        os.makedirs(self.results_dir, exist_ok=True)
+        if self.rank == 0:
+            os.makedirs(self.results_dir, exist_ok=True)
 
-        self.prompts, self.gts = self.get_prompts()
-        self.full_predictions = None
+        # Prompts only depend on the test set, so callers can pass in the set from an earlier Evaluator
+        self.prompt_set = prompts if prompts is not None else self.get_prompts()
+        self.prompts, self.gts = self.prompt_set, self.prompt_set.gts
+        self.output_ids = None
         self.predictions_after_delimiter = None
+        self.prediction_ids = None
+        self.example_metrics = None
+        self.metric_curves = None
+        self.generation_stats = None
 
     def get_prompts(self):
+        """Prompts ([BOS] ... [OUT]) and ground truths of the test set, extracted on token ids."""
         search_token_id = self.tokenizer.encode(self.split_str, add_special_tokens=False)[0]
-
-        gts = []
-        prompts = []
-        for sample in self.test_set:
-            input_ids = sample["input_ids"]
-            try:
-                split_index = input_ids.index(search_token_id)
-                # Find the EOS token
-                end_index = input_ids.index(self.tokenizer.eos_token_id) if self.tokenizer.eos_token_id in input_ids else len(input_ids)
-            except:
-                print("ERROR")
-                print(input_ids)
-                print(sample)
-                print(self.tokenizer.decode(input_ids, skip_special_tokens=True))
-                continue
-                
-            # Take everything up to Search: token
-            prompt_ids = input_ids[: split_index + 1]
-
-            # Decode to text, add BOS token at start
-            prompt_text = self.tokenizer.decode(prompt_ids, skip_special_tokens=True)
-            full_prompt = self.tokenizer.bos_token + " " + prompt_text
-            
-            # Ground truth is everything AFTER the delimiter up to EOS
-            gt_ids = input_ids[split_index+1:end_index]
-            gt = self.tokenizer.decode(gt_ids, skip_special_tokens=True)
-            # print("FULL_PROMPT: ", full_prompt, "\n\n")
-            # print("GT: ", gt, "\n\n")
-
-            # Re-encode with BOS token
-            prompt_with_bos = self.tokenizer.encode(
-                full_prompt, add_special_tokens=False
-            )
-            prompts.append(prompt_with_bos)
-            gts.append(gt)
-
-        return prompts, gts
+        return PromptSet.from_dataset(
+            self.test_set,
+            self.codec,
+            search_token_id,
+            self.tokenizer.bos_token_id,
+            self.tokenizer.eos_token_id,
+        )
 
     def get_preds(self):
         batch_size = self.batch_size
-        data = self.prompts
         tokenizer = self.tokenizer
-        output_texts_concat = []
-        predictions_after_delimiter = []
-        
+
         search_token_id = self.tokenizer.encode(self.split_str, add_special_tokens=False)[0]
 
-        self.hf_model.cuda()
-        self.hf_model.eval()
-
-        for b in trange(0, len(data), batch_size):
-            batch = data[b : min(b + batch_size, len(data))]
-            batch_text = [tokenizer.decode(x, skip_special_tokens=False) for x in batch]
-            tokenizer.padding_side = "left"
-            inputs = tokenizer(batch_text, return_tensors="pt", padding=True).to("cuda")
-            input_prompt = inputs["input_ids"]
-            # print("INPUT PROMPT: ", input_prompt, "\n\n")
-
-            outputs = self.hf_model.generate(
-                input_ids=input_prompt,
-                pad_token_id=tokenizer.pad_token_id,
-                attention_mask=inputs["attention_mask"].to("cuda"),
-                max_length=self.config.model.block_size,
-                num_beams=1,
-                do_sample=False,
-                eos_token_id=tokenizer.eos_token_id,
+        # Optional cap on new tokens, derived from the ground truth lengths of the whole set
+        budgets = generation_budgets(
+            self.prompt_set.gt_lengths,
+            self.config.generation.budget,
+            self.config.generation.budget_margin,
+        )
+
+        # Generate for this rank's share only; the shards are gathered again below
+        data, indices = self.prompt_set.shard(self.rank, self.world_size)
+        if isinstance(budgets, list):
+            budgets = [budgets[i] for i in indices]
+
+        if self.backend == "hf":
+            self.hf_model.cuda()
+            self.hf_model.eval()
+
+            sequences = []
+            budget_hits = 0
+            for b in trange(0, len(data), batch_size):
+                end = min(b + batch_size, len(data))
+                input_prompt, attention_mask = data.padded_batch(b, end, tokenizer.pad_token_id)
+                batch_sequences, batch_hits = hf_generate(
+                    self.hf_model,
+                    input_prompt.to("cuda"),
+                    attention_mask.to("cuda"),
+                    self.config.model.block_size,
+                    tokenizer.eos_token_id,
+                    tokenizer.pad_token_id,
+                    max_new_tokens=budgets[b:end] if isinstance(budgets, list) else budgets,
+                )
+                sequences.extend(batch_sequences)
+                budget_hits += batch_hits
+            self.generation_stats = {"budget_hits": budget_hits}
+        else:
+            # Continuous batching with eval.batch_size slots on the live model
+            engine = GenerationEngine(
+                self.model,
+                batch_size,
+                self.config.model.block_size,
+                tokenizer.eos_token_id,
+                tokenizer.pad_token_id,
+                num_draft_tokens=self.config.generation.num_draft_tokens,
+                draft_ngram_size=self.config.generation.draft_ngram_size,
             )
+            sequences = engine.generate(data, max_new_tokens=budgets)
+            self.generation_stats = engine.stats
 
-            # Process each generated sequence
-            for output_ids in outputs.tolist():
-                # Find the delimiter token in the output
-                try:
-                    split_index = output_ids.index(search_token_id)
-                    # Find the EOS token
-                    end_index = output_ids.index(tokenizer.eos_token_id) if tokenizer.eos_token_id in output_ids else len(output_ids)
-                    
-                    # Get full generated text
-                    full_text = tokenizer.decode(output_ids, skip_special_tokens=False)
-                    
-                    # Get just the part after the delimiter
-                    after_delimiter = tokenizer.decode(output_ids[split_index+1:end_index], skip_special_tokens=True)
-                    
-                    # print("AFTER DELIMITER: ", after_delimiter, "\n\n")
-                except ValueError:
-                    # print(f"Warning: Could not find delimiter or EOS in generated output")
-                    full_text = tokenizer.decode(output_ids, skip_special_tokens=False)
-                    after_delimiter = ""
-                
-                output_texts_concat.append(full_text)
-                predictions_after_delimiter.append(after_delimiter)
-
-        return output_texts_concat, predictions_after_delimiter
-
-    def calculate_metrics(self, predictions, gts):
-        """Calculate token-level and exact match accuracy"""
-        token_accuracies = []
-        exact_matches = []
-        
-        for pred, gt in zip(predictions, gts):
-            # Tokenize prediction and ground truth
-            pred_tokens = self.tokenizer.encode(pred, add_special_tokens=False)
-            gt_tokens = self.tokenizer.encode(gt, add_special_tokens=False)
-            
-            # Calculate token-by-token accuracy
-            min_len = min(len(pred_tokens), len(gt_tokens))
-            matches = 0
-            for i in range(min_len):
-                if pred_tokens[i] == gt_tokens[i]:
-                    matches += 1
-                    
-            token_acc = matches / max(len(pred_tokens), len(gt_tokens)) if max(len(pred_tokens), len(gt_tokens)) > 0 else 1.0
-            token_accuracies.append(token_acc)
-            
-            # Calculate exact match
-            exact_match = 1.0 if pred == gt else 0.0
-            exact_matches.append(exact_match)
-        
-        metrics = {
-            "token_full_accuracy": np.mean(token_accuracies),
-            "exact_match_accuracy": np.mean(exact_matches)
-        }
-        
-        return metrics
+        if self.world_size > 1:
+            # Every rank gets all generated ids, so metrics agree across ranks
+            gathered = [None] * self.world_size
+            torch.distributed.all_gather_object(gathered, (indices, sequences, self.generation_stats))
+            sequences = [None] * len(self.prompt_set)
+            for shard_indices, shard_sequences, _ in gathered:
+                for i, output_ids in zip(shard_indices, shard_sequences):
+                    sequences[i] = output_ids
+            # Ranks generate at the same time, so time is the slowest rank's
+            per_rank = [stats for _, _, stats in gathered]
+            self.generation_stats = combine_stats(per_rank, parallel=True)
+            self.generation_stats["per_rank"] = per_rank
 
-    def save(self, full_predictions, predictions_after_delimiter, gts, metrics=None):
-        eval_dir = os.path.join(self.config.eval.results_dir, f"step_{self.step}")
-        os.makedirs(eval_dir, exist_ok=True)
-        results_file = os.path.join(eval_dir, f"results_{self.num_examples}.json")
-        
-        results = {
-            "full_predictions": full_predictions,
-            "predictions_after_delimiter": predictions_after_delimiter,
-            "ground_truths": gts
-        }
-        
+        if self.rank == 0:
+            if "tokens_per_sec" in self.generation_stats:
+                print(f"Generation throughput: {self.generation_stats['tokens_per_sec']:.0f} tokens/s")
+            if budgets is not None:
+                print(f"Sequences stopped by the generation budget: {self.generation_stats['budget_hits']}/{len(sequences)}")
+
+        # Process each generated sequence
+        answers = []
+        for output_ids in sequences:
+            # Find the delimiter token in the output
+            try:
+                split_index = output_ids.index(search_token_id)
+                # Find the EOS token
+                end_index = output_ids.index(tokenizer.eos_token_id) if tokenizer.eos_token_id in output_ids else len(output_ids)
+
+                # Get just the part after the delimiter
+                answers.append(output_ids[split_index+1:end_index])
+            except ValueError:
+                # print(f"Warning: Could not find delimiter or EOS in generated output")
+                answers.append([])
+
+        # Decode everything at once
+        predictions_after_delimiter = self.codec.decode_batch(answers, skip_special_tokens=True)
+        self.prediction_ids = answers
+
+        return sequences, predictions_after_delimiter
+
+    def calculate_metrics(self, prediction_ids):
+        """
+        Token-level and exact match accuracy, compared on ids with special tokens dropped.
+
+        Per-example results are kept in ``self.example_metrics``, per-position accuracy and
+        the first-error histogram in ``self.metric_curves``.
+        """
+        pred_flat, pred_lengths = flatten_rows(prediction_ids)
+        pred_flat, pred_lengths = drop_ids(pred_flat, pred_lengths, self.codec.is_special)
+        gt_flat, gt_lengths = drop_ids(self.prompt_set.gt_tokens, self.prompt_set.gt_lengths, self.codec.is_special)
+
+        self.example_metrics = sequence_metrics(pred_flat, pred_lengths, gt_flat, gt_lengths)
+        self.metric_curves = accuracy_curves(self.example_metrics)
+        return summarize(self.example_metrics)
+
+    def save(self, metrics=None):
+        """
+        Per-example results as Parquet shards (see ``utils/results_io.py``), aggregates in their ``summary.json``.
+        """
+        results_path = os.path.join(self.config.eval.results_dir, f"step_{self.step}", f"results_{self.num_examples}")
+        prompt_set = self.prompt_set
+        example_metrics = self.example_metrics
+
+        writer = ResultsWriter(results_path)
+        for start in range(0, len(prompt_set), self.batch_size):
+            end = min(start + self.batch_size, len(prompt_set))
+            prompt_tokens = prompt_set.prompt_tokens[prompt_set.prompt_offsets[start] : prompt_set.prompt_offsets[end]]
+            gt_tokens = prompt_set.gt_tokens[prompt_set.gt_offsets[start] : prompt_set.gt_offsets[end]]
+            writer.write_batch(
+                {
+                    "example": np.arange(start, end),
+                    "row": prompt_set.rows[start:end],
+                    "prompt_ids": id_lists(prompt_tokens, prompt_set.prompt_lengths[start:end]),
+                    "output_ids": id_lists(self.output_ids[start:end]),
+                    "prediction_ids": id_lists(self.prediction_ids[start:end]),
+                    "gt_ids": id_lists(gt_tokens, prompt_set.gt_lengths[start:end]),
+                    "token_accuracy": example_metrics["token_accuracy"][start:end],
+                    "exact_match": example_metrics["exact_match"][start:end],
+                    "first_error": example_metrics["first_error"][start:end],
+                }
+            )
+
+        summary = {"step": self.step, "num_examples": len(prompt_set)}
         if metrics:
-            results["metrics"] = metrics
-            
-        with open(results_file, "w") as f:
-            json.dump(results, f, indent=4)
+            summary["metrics"] = metrics
+
+        if self.metric_curves is not None:
+            summary["metric_curves"] = self.metric_curves
+
+        if self.generation_stats is not None:
+            summary["generation_stats"] = self.generation_stats
+
+        writer.close(summary)
 
     def evaluate(self):
         # Get predictions
-        full_preds, preds_after_delimiter = self.get_preds()
+        output_ids, preds_after_delimiter = self.get_preds()
         
         # Save predictions as attributes so they can be accessed later
-        self.full_predictions = full_preds
+        self.output_ids = output_ids
         self.predictions_after_delimiter = preds_after_delimiter
         
         # Calculate metrics
-        metrics = self.calculate_metrics(preds_after_delimiter, self.gts)
+        metrics = self.calculate_metrics(self.prediction_ids)
         
-        # Print metrics
-        print("\nEvaluation Metrics:")
-        for metric, value in metrics.items():
-            print(f"{metric}: {value:.4f}")
-        
-        # Save results
-        self.save(full_preds, preds_after_delimiter, self.gts, metrics)
+        # Print and save once, all ranks hold the same results
+        if self.rank == 0:
+            print("\nEvaluation Metrics:")
+            for metric, value in metrics.items():
+                print(f"{metric}: {value:.4f}")
+
+            self.save(metrics)
         
         # Clean up model to free memory
-        del self.hf_model
-        torch.cuda.empty_cache()
+        if self.hf_model is not None:
+            del self.hf_model
+            self.hf_model = None
+            torch.cuda.empty_cache()
 
         return metrics
\ No newline at end of file
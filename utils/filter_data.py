@@ -1,37 +1,39 @@
+import collections
+import itertools
 import json
 import os
+import textwrap
+import time
+from multiprocessing import Pool
+import numpy as np
+from tokenizers import Tokenizer
 from transformers import PreTrainedTokenizerFast
 import hydra
+from hydra.utils import to_absolute_path
 from omegaconf import DictConfig
 from tqdm import tqdm
-from data import get_tokenizer
+from data import expand_data_files, format_example, get_tokenizer, is_jsonl, iter_examples
+
+# Per-process tokenizer of the streaming filter's worker pool
+_worker_tokenizer = None
+_worker_template = None
 
 
 def filter_by_length(cfg, data: list, tokenizer: PreTrainedTokenizerFast, max_length: int) -> tuple:
-    """Filter examples that exceed max token length."""
+    """Filter examples that exceed max token length, tokenizing them in one batched call."""
     filtered_data = []
     removed_count = 0
     max_found_length = 0
 
     print(f"\nFiltering examples longer than {max_length} tokens...")
-    for example in tqdm(data):
-        input_text = example["input"]
-        output_text = example["output"]
-        
-        # Use the split_str as a delimiter between input and output
-        full_text = tokenizer.bos_token + " " + input_text + " " + cfg.data.split_str + " " + output_text + " " + tokenizer.eos_token
-        
-        # Tokenize the text
-        tokens = tokenizer(
-            full_text,
-            truncation=False,  # Don't truncate, we're checking the actual length
-            return_overflowing_tokens=False,
-        )["input_ids"]
-        
-        token_length = len(tokens)
+    # Use the split_str as a delimiter between input and output
+    texts = [format_example(tokenizer, cfg.data.split_str, example["input"], example["output"]) for example in data]
+    # Don't truncate, we're checking the actual length
+    lengths = [len(ids) for ids in tokenizer(texts, truncation=False)["input_ids"]] if texts else []
+    for example, token_length in zip(tqdm(data), lengths):
         max_found_length = max(max_found_length, token_length)
 
-        if token_length <= max_length:
+        if max_length is None or token_length <= max_length:
             filtered_data.append(example)
         else:
             removed_count += 1
@@ -40,16 +42,16 @@ def filter_by_length(cfg, data: list, tokenizer: PreTrainedTokenizerFast, max_le
 
 
 def process_and_save_file(file_path: str, cfg: DictConfig, tokenizer: PreTrainedTokenizerFast, max_length: int, sample_limit: int = None):
-    """Process a single JSON file and overwrite with filtered data."""
+    """Process a single JSON or JSONL file and overwrite with filtered data in the same format."""
     print(f"\nProcessing {file_path}")
 
     # Load data
-    with open(file_path, "r") as f:
-        data = json.load(f)
-    
+    jsonl = is_jsonl(file_path)
+    examples = iter_examples(file_path)
     # Apply sample limit if specified
     if sample_limit is not None:
-        data = data[:sample_limit]
+        examples = itertools.islice(examples, sample_limit)
+    data = list(examples)
         
     original_count = len(data)
     print(f"Original example count: {original_count}")
@@ -61,13 +63,139 @@ def process_and_save_file(file_path: str, cfg: DictConfig, tokenizer: PreTrained
 
     # Save filtered data back to original file (replacing it)
     with open(file_path, "w") as f:
-        json.dump(filtered_data, f, indent=2)
+        if jsonl:
+            for example in filtered_data:
+                f.write(json.dumps(example) + "\n")
+        else:
+            json.dump(filtered_data, f, indent=2)
 
     print(f"Results for {os.path.basename(file_path)}:")
     print(f"- Examples removed: {removed_count}")
     print(f"- Maximum token length found: {max_length_found}")
     print(f"- Final example count: {len(filtered_data)}")
-    print(f"- Removal percentage: {(removed_count/original_count)*100:.2f}%")
+    print(f"- Removal percentage: {(removed_count / max(1, original_count)) * 100:.2f}%")
+
+    return removed_count, max_length_found
+
+
+def _init_worker(tokenizer_path: str, template: str):
+    global _worker_tokenizer, _worker_template
+    _worker_tokenizer = Tokenizer.from_file(tokenizer_path)
+    _worker_template = template
+
+
+def _token_lengths(examples: list) -> np.ndarray:
+    """Untruncated token count of every example in a batch (runs in a worker)."""
+    texts = [_worker_template.format(input=example["input"], output=example["output"]) for example in examples]
+    encodings = _worker_tokenizer.encode_batch(texts)
+    return np.fromiter((len(encoding.ids) for encoding in encodings), dtype=np.int64, count=len(encodings))
+
+
+def _batched(iterable, batch_size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def print_length_histogram(lengths: np.ndarray, num_bins: int = 10, width: int = 50):
+    counts, edges = np.histogram(lengths, bins=num_bins)
+    print("Token length histogram:")
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        bar = "#" * int(round(width * count / max(1, counts.max())))
+        print(f"  {low:8.0f} - {high:8.0f} | {count:10d} {bar}")
+
+
+def stream_filter_file(file_path: str, cfg: DictConfig, tokenizer: PreTrainedTokenizerFast, max_length, sample_limit: int = None):
+    """
+    Filter a data file without loading it into memory.
+
+    Examples are read incrementally, tokenized in batches across a process
+    pool and the kept ones are streamed to a file that replaces the original
+    in the same format: JSONL stays JSONL, and a JSON array is written the
+    way ``process_and_save_file`` writes it.
+    """
+    print(f"\nProcessing {file_path} (streaming)")
+    filter_cfg = cfg.data.filter
+    # Same text as format_example, with the special tokens of the tokenizer
+    template = f"{tokenizer.bos_token} {{input}} {cfg.data.split_str} {{output}} {tokenizer.eos_token}"
+
+    examples = iter_examples(file_path)
+    if sample_limit is not None:
+        examples = itertools.islice(examples, sample_limit)
+    batches = _batched(examples, int(filter_cfg.batch_size))
+
+    jsonl = is_jsonl(file_path)
+    tmp_path = f"{file_path}.tmp-{os.getpid()}"
+    lengths = []
+    kept_count = 0
+    num_tokens = 0
+    max_length_found = 0
+    start = time.time()
+    num_proc = int(filter_cfg.num_proc)
+    with Pool(
+        num_proc,
+        initializer=_init_worker,
+        initargs=(to_absolute_path(cfg.data.tokenizer_path), template),
+    ) as pool, open(tmp_path, "w") as out, tqdm(unit="ex") as progress:
+        if not jsonl:
+            out.write("[")
+
+        def write_batch(batch, batch_lengths):
+            nonlocal kept_count, num_tokens, max_length_found
+            keep = batch_lengths <= max_length if max_length is not None else np.ones(len(batch), dtype=bool)
+            for example, kept in zip(batch, keep.tolist()):
+                if not kept:
+                    continue
+                if jsonl:
+                    out.write(json.dumps(example) + "\n")
+                else:
+                    # Same bytes as json.dump(examples, f, indent=2)
+                    out.write(("," if kept_count else "") + "\n" + textwrap.indent(json.dumps(example, indent=2), "  "))
+                kept_count += 1
+            num_tokens += int(batch_lengths.sum())
+            max_length_found = max(max_length_found, int(batch_lengths.max()))
+            lengths.append(batch_lengths)
+
+            progress.update(len(batch))
+            progress.set_postfix(
+                kept=kept_count,
+                removed=progress.n - kept_count,
+                max_len=max_length_found,
+                tok_per_s=f"{num_tokens / max(time.time() - start, 1e-9):.3g}",
+            )
+
+        # Keep a bounded number of batches in flight so the file is never read far ahead;
+        # batches are written in input order
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((batch, pool.apply_async(_token_lengths, (batch,))))
+            if len(pending) >= 2 * num_proc:
+                batch, result = pending.popleft()
+                write_batch(batch, result.get())
+        while pending:
+            batch, result = pending.popleft()
+            write_batch(batch, result.get())
+        if not jsonl:
+            out.write("\n]" if kept_count else "]")
+
+    os.replace(tmp_path, file_path)
+
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    original_count = len(lengths)
+    removed_count = original_count - kept_count
+    elapsed = max(time.time() - start, 1e-9)
+
+    print(f"Results for {os.path.basename(file_path)}:")
+    print(f"- Examples removed: {removed_count}")
+    print(f"- Maximum token length found: {max_length_found}")
+    print(f"- Final example count: {kept_count} (written as {'JSONL' if jsonl else 'a JSON array'})")
+    print(f"- Removal percentage: {(removed_count / max(1, original_count)) * 100:.2f}%")
+    print(f"- Throughput: {original_count / elapsed:.0f} examples/s, {num_tokens / elapsed:.0f} tokens/s")
+    if original_count:
+        print_length_histogram(lengths)
 
     return removed_count, max_length_found
 
@@ -87,6 +215,8 @@ def main(cfg: DictConfig):
     else:
         max_token_length = 2048
         sample_limit = None
+    if max_token_length in (None, "None"):
+        max_token_length = None  # only report lengths
     
     print(f"Using maximum token length: {max_token_length}")
     if sample_limit:
@@ -98,10 +228,11 @@ def main(cfg: DictConfig):
 
     # Only process train and test files (no val)
     files_to_process = []
+    # A glob of shards is filtered shard by shard
     if hasattr(cfg.data, 'train_file') and cfg.data.train_file:
-        files_to_process.append(cfg.data.train_file)
+        files_to_process.extend(expand_data_files(cfg.data.train_file))
     if hasattr(cfg.data, 'test_file') and cfg.data.test_file:
-        files_to_process.append(cfg.data.test_file)
+        files_to_process.extend(expand_data_files(cfg.data.test_file))
 
     if not files_to_process:
         print("No data files specified in configuration.")
@@ -112,9 +243,14 @@ def main(cfg: DictConfig):
             print(f"Warning: File {file_path} does not exist. Skipping.")
             continue
             
-        removed, max_length = process_and_save_file(
-            file_path, cfg, tokenizer, max_length=max_token_length, sample_limit=sample_limit
-        )
+        if cfg.data.filter.get('streaming', False):
+            removed, max_length = stream_filter_file(
+                file_path, cfg, tokenizer, max_length=max_token_length, sample_limit=sample_limit
+            )
+        else:
+            removed, max_length = process_and_save_file(
+                file_path, cfg, tokenizer, max_length=max_token_length, sample_limit=sample_limit
+            )
         total_removed += removed
         overall_max_length = max(overall_max_length, max_length)
 
@@ -0,0 +1,583 @@
+"""
+Greedy decoding on a LitGPT ``GPT`` with a KV cache.
+
+``generate_greedy`` decodes one left-padded batch like ``transformers``
+``generate``: every row gets the same KV cache columns, padding is masked out
+of attention and each row's rotary positions start at 0 at its first real
+token.
+
+``GenerationEngine`` does continuous batching: a fixed number of slots, each
+with its own preallocated KV cache row and position. A finished sequence
+frees its slot right away and the next prompt is prefilled into it, so short
+answers never wait for the longest one in their batch.
+"""
+import time
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+from litgpt.config import Config
+from litgpt.model import GPT, KVCache
+from tqdm import tqdm
+
+try:
+    from utils.modeling import gpt_forward
+    from utils.prefix_cache import PrefixKVCache
+except ImportError:
+    from modeling import gpt_forward
+    from prefix_cache import PrefixKVCache
+
+
+@torch.no_grad()
+def generate_greedy(
+    model: GPT,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    max_length: int,
+    eos_token_id: int,
+    pad_token_id: int,
+) -> torch.Tensor:
+    """
+    Greedily continue left-padded prompts until every row produced EOS or ``max_length`` is reached.
+
+    Args:
+        model: The LitGPT model, on the device of the inputs.
+        input_ids: Left-padded prompts, ``(B, T)``.
+        attention_mask: 1 for prompt tokens, 0 for padding, ``(B, T)``.
+        max_length: Length of prompt plus generated tokens, at most ``model.max_seq_length``.
+        eos_token_id: Rows stop after generating it.
+        pad_token_id: Filled in after a row stopped.
+
+    Returns:
+        Prompts followed by the generated tokens, ``(B, T + new tokens)``, like HF ``generate``.
+    """
+    B, T = input_ids.shape
+    device = input_ids.device
+    if max_length > model.max_seq_length:
+        raise ValueError(f"max_length {max_length} exceeds the model's max_seq_length {model.max_seq_length}")
+    if T >= max_length:
+        return input_ids
+
+    was_training = model.training
+    model.eval()
+    model.set_kv_cache(B, max_seq_length=max_length, device=device, dtype=next(model.parameters()).dtype)
+    try:
+        attention_mask = attention_mask.to(device=device, dtype=torch.bool)
+        # KV cache columns each row may attend to; grows by one column per step
+        kv_valid = torch.zeros(B, max_length, dtype=torch.bool, device=device)
+        kv_valid[:, :T] = attention_mask
+
+        # Prefill: causal over the prompt minus padding. Padding attends to itself
+        # only, so its rows stay finite and never leak into real tokens.
+        positions = (attention_mask.long().cumsum(dim=-1) - 1).clamp(min=0)
+        causal = torch.ones(T, max_length, dtype=torch.bool, device=device).tril()
+        mask = causal.unsqueeze(0) & kv_valid.unsqueeze(1)
+        mask |= torch.eye(T, max_length, dtype=torch.bool, device=device).unsqueeze(0)
+        input_pos = torch.arange(T, device=device)
+        logits = gpt_forward(model, input_ids, positions, mask.unsqueeze(1), input_pos)
+
+        next_positions = positions[:, -1] + 1
+        finished = torch.zeros(B, dtype=torch.bool, device=device)
+        generated = []
+        for step in range(max_length - T):
+            next_token = logits[:, -1].argmax(dim=-1)
+            next_token = torch.where(finished, torch.full_like(next_token, pad_token_id), next_token)
+            generated.append(next_token)
+            finished |= next_token == eos_token_id
+            if finished.all() or step == max_length - T - 1:
+                break
+
+            # Decode step: one new token per row in cache column T + step
+            column = T + step
+            kv_valid[:, column] = True
+            logits = gpt_forward(
+                model,
+                next_token.unsqueeze(1),
+                next_positions.unsqueeze(1),
+                kv_valid.view(B, 1, 1, max_length),
+                torch.tensor([column], device=device),
+            )
+            next_positions = next_positions + 1
+    finally:
+        model.clear_kv_cache()
+        model.train(was_training)
+
+    return torch.cat([input_ids, torch.stack(generated, dim=1)], dim=1)
+
+
+def generation_budgets(gt_lengths, mode: str, margin: int = 0):
+    """
+    Output-length budget (``max_new_tokens``) from the ground-truth answer lengths.
+
+    Args:
+        gt_lengths: Token count of every ground truth (without EOS).
+        mode: "none" for no budget, "dataset" for the longest ground truth plus
+            ``margin`` for every example, "example" for each example's own
+            ground truth plus ``margin``.
+        margin: Extra tokens on top of the ground truth length; one more is always added for EOS.
+
+    Returns:
+        None, one int, or a list with one int per example.
+    """
+    if mode == "none":
+        return None
+    gt_lengths = np.asarray(gt_lengths, dtype=np.int64)
+    if mode == "dataset":
+        return int(gt_lengths.max(initial=0)) + margin + 1
+    if mode == "example":
+        return (gt_lengths + margin + 1).tolist()
+    raise ValueError(f"Unknown generation budget mode {mode}, expected 'none', 'dataset' or 'example'")
+
+
+def trim_to_budget(sequences: List[List[int]], prompt_width: int, max_new_tokens, eos_token_id: int):
+    """
+    Cut the rows of one left-padded HF ``generate`` batch to their own budgets.
+
+    Returns:
+        The trimmed rows, and how many of them stopped at their budget without EOS.
+    """
+    if max_new_tokens is None:
+        return sequences, 0
+    if isinstance(max_new_tokens, int):
+        max_new_tokens = [max_new_tokens] * len(sequences)
+
+    trimmed = []
+    hits = 0
+    for sequence, budget in zip(sequences, max_new_tokens):
+        sequence = sequence[: prompt_width + budget]
+        if eos_token_id not in sequence[prompt_width:] and len(sequence) == prompt_width + budget:
+            hits += 1
+        trimmed.append(sequence)
+    return trimmed, hits
+
+
+def hf_generate(
+    hf_model,
+    input_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    max_length: int,
+    eos_token_id: int,
+    pad_token_id: int,
+    max_new_tokens=None,
+):
+    """
+    Greedy HF ``generate`` on one left-padded batch.
+
+    Args:
+        max_length: Cap on prompt plus generated tokens.
+        max_new_tokens: Optional budget, one int or one per row (see ``generation_budgets``).
+
+    Returns:
+        Output rows as lists (left padding included), and how many rows stopped at their budget.
+    """
+    width = input_ids.size(1)
+    length_kwargs = {"max_length": max_length}
+    if max_new_tokens is not None:
+        batch_budget = max_new_tokens if isinstance(max_new_tokens, int) else max(max_new_tokens)
+        length_kwargs = {"max_new_tokens": max(1, min(batch_budget, max_length - width))}
+
+    outputs = hf_model.generate(
+        input_ids=input_ids,
+        pad_token_id=pad_token_id,
+        attention_mask=attention_mask,
+        num_beams=1,
+        do_sample=False,
+        eos_token_id=eos_token_id,
+        **length_kwargs,
+    )
+    return trim_to_budget(outputs.tolist(), width, max_new_tokens, eos_token_id)
+
+
+def combine_stats(runs: Sequence[Dict], parallel: bool = False) -> Dict:
+    """
+    Stats of several generation calls (e.g. ``GenerationEngine.stats``) as if they were one call.
+
+    Counters are summed and the rates rebuilt from the sums. Seconds are summed
+    for consecutive calls, or the slowest call's for ``parallel`` ones (e.g. one
+    per rank).
+    """
+    if not runs:
+        return {}
+    combined = {key: sum(stats[key] for stats in runs) for key, value in runs[0].items() if isinstance(value, int)}
+    if "seconds" in runs[0]:
+        seconds = [stats["seconds"] for stats in runs]
+        combined["seconds"] = max(seconds) if parallel else sum(seconds)
+        combined["tokens_per_sec"] = combined["generated_tokens"] / combined["seconds"] if combined["seconds"] > 0 else 0.0
+    rates = {
+        "acceptance_rate": ("accepted_tokens", "drafted_tokens"),
+        "prefix_hit_rate": ("prefix_hit_tokens", "prompt_tokens"),
+        "tokens_per_decode_step": ("decode_tokens", "sequence_steps"),
+    }
+    for rate, (numerator, denominator) in rates.items():
+        if denominator in combined:
+            combined[rate] = combined[numerator] / combined[denominator] if combined[denominator] else 0.0
+    return combined
+
+
+def load_lit_model(checkpoint_dir: str, device=None, dtype: Optional[torch.dtype] = None) -> GPT:
+    """Load the ``GPT`` saved by ``LLM.save`` (``model_config.yaml`` + ``lit_model.pth``)."""
+    checkpoint_dir = Path(checkpoint_dir)
+    model = GPT(Config.from_file(checkpoint_dir / "model_config.yaml"))
+    model.load_state_dict(torch.load(checkpoint_dir / "lit_model.pth", map_location="cpu"))
+    return model.to(device=device, dtype=dtype).eval()
+
+
+class SlotKVCache(KVCache):
+    """
+    KV cache with one row per engine slot.
+
+    The engine sets ``rows`` to the slice of slots the next forward pass works
+    on and ``width`` to the number of leading columns it attends over.
+    ``input_pos`` is ``(len(rows), T)``, so every slot writes at its own
+    position. The engine keeps the slots of a pass contiguous, so the keys and
+    values returned are views of the cache rather than copies.
+    """
+
+    def __init__(self, k_shape, v_shape, device=None, dtype=None):
+        super().__init__(k_shape, v_shape, device=device, dtype=dtype)
+        self.rows = slice(None)
+        self.width = k_shape[2]
+
+    def forward(self, input_pos: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
+        self.k = self.k.to(k.dtype)
+        self.v = self.v.to(v.dtype)
+        k_rows = self.k[self.rows]
+        v_rows = self.v[self.rows]
+        batch = torch.arange(k_rows.size(0), device=k.device).unsqueeze(1)
+        # (B, T, n_query_groups, head_size) entries at (slot, :, position), written through the views
+        k_rows[batch, :, input_pos] = k.transpose(1, 2)
+        v_rows[batch, :, input_pos] = v.transpose(1, 2)
+        return k_rows[:, :, : self.width], v_rows[:, :, : self.width]
+
+    def move_row(self, source: int, target: int, length: int) -> None:
+        """Copy the first ``length`` columns of slot ``source`` into slot ``target``."""
+        self.k[target, :, :length] = self.k[source, :, :length]
+        self.v[target, :, :length] = self.v[source, :, :length]
+
+
+class GenerationEngine:
+    """
+    Continuous-batching greedy generation on a LitGPT model.
+
+    Every slot holds one sequence in KV cache columns ``0..length-1``, so a
+    token's rotary position is its column. Each iteration prefills waiting
+    prompts into the free slots, then runs one decode step over all busy
+    slots; sequences leave as soon as they emit EOS or reach their length limit.
+    Busy sequences are moved into the slots freed before them, so the busy
+    slots are always ``0..n-1`` and every pass attends over a slice of the
+    KV cache instead of gathering its rows.
+    Results are the same as ``generate_greedy`` (up to floating point
+    differences from different batch shapes in reduced precision).
+
+    With ``num_draft_tokens > 0`` decode steps use prompt-lookup speculative
+    decoding: the last ``n`` tokens of a sequence (``n = draft_ngram_size``
+    down to 1) are looked up in the sequence itself, the tokens that followed
+    their latest earlier occurrence are proposed as a draft, and one forward
+    pass over the last token plus the draft verifies it. The longest prefix of
+    the draft that matches the model's own greedy choices is kept, plus the
+    model's next token, so outputs stay exactly greedy while copy-heavy
+    answers advance several tokens per step.
+
+    Args:
+        model: The LitGPT model.
+        num_slots: Sequences decoded at the same time.
+        max_length: Maximum length of prompt plus generated tokens, like HF ``max_length``.
+        eos_token_id: Sequences stop after generating it.
+        pad_token_id: Fills the unused tail of prefill batches.
+        num_draft_tokens: Draft length for speculative decoding; 0 disables it.
+        draft_ngram_size: Longest n-gram matched to find a draft.
+        prefix_cache: Optional ``PrefixKVCache``; prompts then only prefill the part after
+            their longest cached prefix, and their whole pages are added to the cache.
+            Only valid while the model weights do not change.
+    """
+
+    def __init__(
+        self,
+        model: GPT,
+        num_slots: int,
+        max_length: int,
+        eos_token_id: int,
+        pad_token_id: int,
+        num_draft_tokens: int = 0,
+        draft_ngram_size: int = 3,
+        prefix_cache: Optional[PrefixKVCache] = None,
+    ):
+        if max_length > model.max_seq_length:
+            raise ValueError(f"max_length {max_length} exceeds the model's max_seq_length {model.max_seq_length}")
+        self.model = model
+        self.num_slots = num_slots
+        self.max_length = max_length
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.num_draft_tokens = num_draft_tokens
+        self.draft_ngram_size = draft_ngram_size
+        self.prefix_cache = prefix_cache
+        self.stats: Dict[str, float] = {}
+        self._caches: List[SlotKVCache] = []
+
+    def _set_cache(self) -> List[SlotKVCache]:
+        config = self.model.config
+        param = next(self.model.parameters())
+        # Verification rows are padded to the longest draft, so leave room for the padding behind
+        # max_length, plus one scratch column that padding is clamped into
+        columns = self.max_length + self.num_draft_tokens + 1
+        self._scratch = columns - 1
+        v_shape = (self.num_slots, config.n_query_groups, columns, config.head_size)
+        k_shape = v_shape[:3] + (self.model.cos.size(-1) + config.head_size - config.rope_n_elem,)
+        caches = []
+        for block in self.model.transformer.h:
+            block.attn.kv_cache = SlotKVCache(k_shape, v_shape, device=param.device, dtype=param.dtype)
+            caches.append(block.attn.kv_cache)
+        return caches
+
+    def _forward(self, rows: slice, idx: torch.Tensor, input_pos: torch.Tensor, width: int) -> torch.Tensor:
+        for cache in self._caches:
+            cache.rows = rows
+            cache.width = width
+        # A query at position p sees columns 0..p of its own slot
+        columns = torch.arange(width, device=idx.device)
+        mask = (columns.view(1, 1, width) <= input_pos.unsqueeze(-1)).unsqueeze(1)
+        # Padding behind a short draft may run past the rope cache; its outputs are never used
+        position_ids = input_pos.clamp(max=self.model.cos.size(0) - 1)
+        return gpt_forward(self.model, idx, position_ids, mask, input_pos)
+
+    def generate(self, prompts: Sequence[Sequence[int]], max_new_tokens=None) -> List[List[int]]:
+        """
+        Greedily continue every prompt.
+
+        Args:
+            prompts: Token ids of every prompt.
+            max_new_tokens: Generation budget, one int for all prompts or one per prompt.
+                None only stops at EOS or ``max_length``.
+
+        Returns:
+            Prompt followed by the generated tokens (up to and including EOS), per prompt.
+            Throughput, draft acceptance and how many sequences were cut off by
+            the budget or by ``max_length`` are stored in ``self.stats``.
+        """
+        device = next(self.model.parameters()).device
+        if max_new_tokens is None or isinstance(max_new_tokens, int):
+            max_new_tokens = [max_new_tokens] * len(prompts)
+
+        self._outputs: List[Optional[List[int]]] = [None] * len(prompts)
+        self._limits = []
+        queue = deque()
+        for i, prompt in enumerate(prompts):
+            budget = max_new_tokens[i]
+            limit = self.max_length if budget is None else min(self.max_length, len(prompt) + int(budget))
+            self._limits.append(limit)
+            if len(prompt) >= limit:
+                # No room left to generate
+                self._outputs[i] = list(prompt)
+            else:
+                queue.append(i)
+
+        self._slot_request = [-1] * self.num_slots
+        self._sequences: List[List[int]] = [[] for _ in range(self.num_slots)]
+        self._ngram_index: List[List[Dict]] = [[] for _ in range(self.num_slots)]
+        self._counts = {
+            "generated_tokens": 0,
+            "budget_hits": 0,
+            "max_length_hits": 0,
+            "drafted_tokens": 0,
+            "accepted_tokens": 0,
+            "prompt_tokens": sum(len(prompts[i]) for i in queue),
+            "prefix_hit_tokens": 0,
+        }
+        prefill_passes = 0
+        decode_passes = 0
+        admitted_total = 0
+        sequence_steps = 0
+
+        was_training = self.model.training
+        self.model.eval()
+        self._caches = self._set_cache()
+        start = time.perf_counter()
+        self._progress = tqdm(total=len(queue), desc="Generating")
+        try:
+            with torch.no_grad():
+                while queue or any(r >= 0 for r in self._slot_request):
+                    # Prefill waiting prompts into the free slots after the busy ones, right-padded, all at once
+                    num_busy = self._compact()
+                    admitted = []
+                    for slot in range(num_busy, min(self.num_slots, num_busy + len(queue))):
+                        request = queue.popleft()
+                        self._admit(slot, request, prompts[request])
+                        admitted.append(slot)
+                    if admitted:
+                        # Copy cached prompt prefixes into the slots, then prefill only the rest
+                        offsets = [self._load_prefix(slot) for slot in admitted]
+                        suffixes = [self._sequences[s][offset:] for s, offset in zip(admitted, offsets)]
+                        width = max(len(suffix) for suffix in suffixes)
+                        idx = torch.full((len(admitted), width), self.pad_token_id, dtype=torch.long)
+                        for row, suffix in enumerate(suffixes):
+                            idx[row, : len(suffix)] = torch.tensor(suffix)
+                        # Padding behind a suffix writes past the row's prompt, where decoding
+                        # overwrites it before it is ever attended; clamp it into the scratch column
+                        input_pos = (torch.tensor(offsets).unsqueeze(1) + torch.arange(width)).clamp(max=self._scratch)
+                        logits = self._forward(
+                            slice(admitted[0], admitted[-1] + 1),
+                            idx.to(device),
+                            input_pos.to(device),
+                            int(input_pos.max()) + 1,
+                        )
+                        last = torch.tensor([len(suffix) for suffix in suffixes], device=device) - 1
+                        next_tokens = logits[torch.arange(len(admitted), device=device), last].argmax(dim=-1)
+                        prefill_passes += 1
+                        admitted_total += len(admitted)
+                        if self.prefix_cache is not None:
+                            for slot in admitted:
+                                self._store_prefix(slot)
+                        for slot, token in zip(admitted, next_tokens.tolist()):
+                            self._push(slot, token)
+
+                    # One decode step over every busy slot: the last token plus an optional draft
+                    busy = list(range(self._compact()))
+                    if not busy:
+                        continue
+                    drafts = [self._draft(s) for s in busy]
+                    steps = 1 + max(len(d) for d in drafts)
+                    idx = torch.full((len(busy), steps), self.pad_token_id, dtype=torch.long)
+                    for row, (slot, draft) in enumerate(zip(busy, drafts)):
+                        idx[row, : 1 + len(draft)] = torch.tensor(self._sequences[slot][-1:] + draft)
+                    positions = torch.tensor([len(self._sequences[s]) - 1 for s in busy])
+                    input_pos = positions.unsqueeze(1) + torch.arange(steps)
+                    logits = self._forward(
+                        slice(0, len(busy)),
+                        idx.to(device),
+                        input_pos.to(device),
+                        int(positions.max()) + steps,
+                    )
+                    predictions = logits.argmax(dim=-1).tolist()
+                    decode_passes += 1
+                    sequence_steps += len(busy)
+
+                    for slot, draft, predicted in zip(busy, drafts, predictions):
+                        # Keep the draft up to the first token the model disagrees with, then the model's token
+                        accepted = 0
+                        while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+                            accepted += 1
+                        self._counts["drafted_tokens"] += len(draft)
+                        for j, token in enumerate(draft[:accepted] + [predicted[accepted]]):
+                            if j < accepted:
+                                self._counts["accepted_tokens"] += 1
+                            if self._push(slot, token):
+                                break
+        finally:
+            self._progress.close()
+            self.model.clear_kv_cache()
+            self._caches = []
+            self.model.train(was_training)
+
+        seconds = time.perf_counter() - start
+        counts = self._counts
+        # Every admitted prompt got its first token from the prefill
+        decode_tokens = counts["generated_tokens"] - admitted_total
+        self.stats = {
+            **counts,
+            "prefill_passes": prefill_passes,
+            "decode_passes": decode_passes,
+            "decode_tokens": decode_tokens,
+            "sequence_steps": sequence_steps,
+            "seconds": seconds,
+            "tokens_per_sec": counts["generated_tokens"] / seconds if seconds > 0 else 0.0,
+            "acceptance_rate": counts["accepted_tokens"] / counts["drafted_tokens"] if counts["drafted_tokens"] else 0.0,
+            "prefix_hit_rate": counts["prefix_hit_tokens"] / counts["prompt_tokens"] if counts["prompt_tokens"] else 0.0,
+            # Tokens a sequence gained per decode step; exactly 1 for plain greedy decoding
+            "tokens_per_decode_step": decode_tokens / sequence_steps if sequence_steps else 0.0,
+        }
+        return self._outputs
+
+    def _load_prefix(self, slot: int) -> int:
+        """Copy the cached pages of a slot's prompt into its KV cache row; returns the number of cached tokens."""
+        if self.prefix_cache is None:
+            return 0
+        nodes = self.prefix_cache.match(self._sequences[slot])
+        if not nodes:
+            return 0
+        cached = len(nodes) * self.prefix_cache.page_size
+        k = torch.cat([node.k for node in nodes], dim=2)
+        v = torch.cat([node.v for node in nodes], dim=2)
+        for layer, cache in enumerate(self._caches):
+            cache.k[slot, :, :cached] = k[layer]
+            cache.v[slot, :, :cached] = v[layer]
+        self._counts["prefix_hit_tokens"] += cached
+        return cached
+
+    def _store_prefix(self, slot: int) -> None:
+        """Add the whole pages of a freshly prefilled prompt to the prefix cache."""
+        page_size = self.prefix_cache.page_size
+
+        def read_page(start: int):
+            k = torch.stack([cache.k[slot, :, start : start + page_size] for cache in self._caches])
+            v = torch.stack([cache.v[slot, :, start : start + page_size] for cache in self._caches])
+            return k, v
+
+        self.prefix_cache.insert(self._sequences[slot], read_page)
+
+    def _compact(self) -> int:
+        """Move the last busy slots into free slots before them; returns the number of busy slots."""
+        busy = [s for s in range(self.num_slots) if self._slot_request[s] >= 0]
+        num_busy = len(busy)
+        holes = [s for s in range(num_busy) if self._slot_request[s] < 0]
+        movers = [s for s in busy if s >= num_busy]
+        for target, source in zip(holes, movers):
+            # Columns of every token but the last one are filled
+            length = len(self._sequences[source]) - 1
+            for cache in self._caches:
+                cache.move_row(source, target, length)
+            self._slot_request[target], self._slot_request[source] = self._slot_request[source], -1
+            self._sequences[target], self._sequences[source] = self._sequences[source], []
+            self._ngram_index[target], self._ngram_index[source] = self._ngram_index[source], []
+        return num_busy
+
+    def _admit(self, slot: int, request: int, prompt: Sequence[int]) -> None:
+        self._slot_request[slot] = request
+        self._sequences[slot] = list(prompt)
+        if self.num_draft_tokens > 0:
+            self._ngram_index[slot] = [{} for _ in range(self.draft_ngram_size)]
+            for follower in range(1, len(prompt)):
+                self._index(slot, follower)
+
+    def _index(self, slot: int, follower: int) -> None:
+        """Record that the n-grams ending right before position ``follower`` were followed by it."""
+        sequence = self._sequences[slot]
+        for n, index in enumerate(self._ngram_index[slot], start=1):
+            if follower >= n:
+                index[tuple(sequence[follower - n : follower])] = follower
+
+    def _draft(self, slot: int) -> List[int]:
+        """Tokens that followed the latest earlier occurrence of the sequence's last n-gram."""
+        if self.num_draft_tokens == 0:
+            return []
+        sequence = self._sequences[slot]
+        # Every drafted token plus the model's own next one has to fit into the length limit
+        room = min(self.num_draft_tokens, self._limits[self._slot_request[slot]] - len(sequence) - 1)
+        if room <= 0:
+            return []
+        for n in range(min(self.draft_ngram_size, len(sequence)), 0, -1):
+            follower = self._ngram_index[slot][n - 1].get(tuple(sequence[-n:]))
+            if follower is not None:
+                return sequence[follower : follower + room]
+        return []
+
+    def _push(self, slot: int, token: int) -> bool:
+        """Add a generated token to a slot; release the slot and return True if its sequence is done."""
+        sequence = self._sequences[slot]
+        request = self._slot_request[slot]
+        sequence.append(token)
+        self._counts["generated_tokens"] += 1
+        if self.num_draft_tokens > 0:
+            self._index(slot, len(sequence) - 1)
+
+        if token != self.eos_token_id and len(sequence) < self._limits[request]:
+            return False
+        if token != self.eos_token_id:
+            self._counts["max_length_hits" if len(sequence) >= self.max_length else "budget_hits"] += 1
+        self._outputs[request] = sequence
+        self._slot_request[slot] = -1
+        self._sequences[slot] = []
+        self._progress.update(1)
+        return True
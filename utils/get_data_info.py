@@ -9,6 +9,39 @@ import hydra
 from omegaconf import DictConfig, OmegaConf
 import numpy as np
 
+PERCENTILES = [10, 25, 50, 75, 90, 95, 99, 99.9]
+# Suggested block sizes are rounded up to a multiple of this, which keeps GPU kernels efficient
+BLOCK_SIZE_MULTIPLE = 64
+
+
+def suggest_block_size(length):
+    return int(math.ceil(max(length, 1) / BLOCK_SIZE_MULTIPLE) * BLOCK_SIZE_MULTIPLE)
+
+
+def length_stats(lengths, prompt_lengths):
+    """
+    Length statistics of a split from its row and prompt lengths, in one pass of array ops.
+
+    Rows are ``[BOS] input [OUT] output [EOS]`` without padding, so a row's length is its
+    token count up to and including EOS, and the answer is what follows the prompt.
+    """
+    answer_lengths = lengths - prompt_lengths
+    table = np.stack([lengths, prompt_lengths, answer_lengths])
+    percentiles = np.percentile(table, PERCENTILES, axis=1) if len(lengths) else np.zeros((len(PERCENTILES), 3))
+    return {
+        "num_samples": len(lengths),
+        "num_tokens": int(lengths.sum()),
+        "mean": table.mean(axis=1) if len(lengths) else np.zeros(3),
+        "max": table.max(axis=1, initial=0),
+        "min": table.min(axis=1, initial=0),
+        "max_idx": int(np.argmax(lengths)) if len(lengths) else 0,
+        "min_idx": int(np.argmin(lengths)) if len(lengths) else 0,
+        "percentiles": percentiles,
+        # Rows cut off at the truncation length are longer than what is counted here
+        "truncated": int((lengths >= INFO_MAX_LENGTH).sum()),
+    }
+
+
 @hydra.main(
     config_path="../config",
     config_name="base",
@@ -18,73 +51,46 @@ def main(cfg: DictConfig):
 
     tokenizer = get_tokenizer(cfg)
     tokenized_datasets = get_data(cfg, tokenizer, for_info=True)
-    
-    # Get the IDs of special tokens
-    eos_token_id = tokenizer.eos_token_id
-    pad_token_id = tokenizer.pad_token_id
-    
+
     # Analyze token counts for each split
     for split in tokenized_datasets.keys():
-        # Count tokens up to the EOS token or count non-padding tokens if no EOS token
-        token_counts = []
-        for sample in tokenized_datasets[split]:
-            input_ids = sample["input_ids"]
-            
-            # Find the position of the EOS token
-            if eos_token_id in input_ids:
-                # Count up to and including the EOS token
-                length = input_ids.index(eos_token_id) + 1
-            else:
-                # Count all non-padding tokens if the EOS token was truncated
-                length = sum(1 for token_id in input_ids if token_id != pad_token_id)
-            
-            token_counts.append(length)
-        
-        # Calculate statistics
-        avg_tokens = np.mean(token_counts)
-        max_tokens = np.max(token_counts)
-        min_tokens = np.min(token_counts)
-        
-        # Find the sequences with max and min tokens
-        max_idx = int(np.argmax(token_counts))  # Convert numpy.int64 to Python int
-        min_idx = int(np.argmin(token_counts))  # Convert numpy.int64 to Python int
-        
-        # Get the original text if needed (before tokenization)
-        max_sequence_tokens = tokenized_datasets[split][max_idx]["input_ids"]
-        min_sequence_tokens = tokenized_datasets[split][min_idx]["input_ids"]
-        
-        # Get the sequences up to the EOS token or without padding
-        if eos_token_id in max_sequence_tokens:
-            eos_pos = max_sequence_tokens.index(eos_token_id)
-            max_sequence_tokens_actual = max_sequence_tokens[:eos_pos+1]
-        else:
-            max_sequence_tokens_actual = [t for t in max_sequence_tokens if t != pad_token_id]
-            
-        if eos_token_id in min_sequence_tokens:
-            eos_pos = min_sequence_tokens.index(eos_token_id)
-            min_sequence_tokens_actual = min_sequence_tokens[:eos_pos+1]
-        else:
-            min_sequence_tokens_actual = [t for t in min_sequence_tokens if t != pad_token_id]
-        
+        # Lengths come from the stored length columns, the token ids are never read
+        lengths, prompt_lengths = split_lengths(tokenized_datasets[split])
+        stats = length_stats(lengths, prompt_lengths)
+        max_idx = stats["max_idx"]
+        min_idx = stats["min_idx"]
+
         # Print the statistics
         print(f"\n--- Token Statistics for {split} set (up to EOS token) ---")
-        print(f"Number of samples: {len(token_counts)}")
-        print(f"Average token count: {avg_tokens:.2f}")
-        print(f"Maximum token count: {max_tokens} (sample index: {max_idx})")
-        print(f"Minimum token count: {min_tokens} (sample index: {min_idx})")
-        
+        print(f"Number of samples: {stats['num_samples']}")
+        print(f"Number of tokens: {stats['num_tokens']}")
+        print(f"Average token count: {stats['mean'][0]:.2f}")
+        print(f"Maximum token count: {stats['max'][0]} (sample index: {max_idx})")
+        print(f"Minimum token count: {stats['min'][0]} (sample index: {min_idx})")
+        if stats["truncated"]:
+            print(f"Warning: {stats['truncated']} samples were truncated at {INFO_MAX_LENGTH} tokens")
+
         # Print token distribution
-        print("\nToken count distribution:")
-        percentiles = [10, 25, 50, 75, 90, 95, 99]
-        for p in percentiles:
-            print(f"{p}th percentile: {np.percentile(token_counts, p):.1f}")
-            
-        # Optional: Decode and print the max/min sequences (first 100 tokens)
+        print("\nToken count distribution (total / prompt / answer):")
+        print(f"{'mean':>16}: {stats['mean'][0]:8.1f} {stats['mean'][1]:8.1f} {stats['mean'][2]:8.1f}")
+        print(f"{'min':>16}: {stats['min'][0]:8d} {stats['min'][1]:8d} {stats['min'][2]:8d}")
+        for p, (total, prompt, answer) in zip(PERCENTILES, stats["percentiles"]):
+            print(f"{f'{p}th percentile':>16}: {total:8.1f} {prompt:8.1f} {answer:8.1f}")
+        print(f"{'max':>16}: {stats['max'][0]:8d} {stats['max'][1]:8d} {stats['max'][2]:8d}")
+
+        # Smallest block size that fits every sample, and one that fits all but the longest 0.1%
+        print(f"\nSuggested block_size: {suggest_block_size(stats['max'][0])} (fits all samples), "
+              f"{suggest_block_size(stats['percentiles'][-1][0])} (fits {PERCENTILES[-1]}%)")
+
+        if stats["num_samples"] == 0:
+            continue
+
+        # Only the two rows that are printed are read
         print("\nMax token sequence:")
-        print(tokenizer.decode(max_sequence_tokens_actual))
-        
+        print(tokenizer.decode(tokenized_datasets[split][max_idx]["input_ids"]))
+
         print("\nMin token sequence:")
-        print(tokenizer.decode(min_sequence_tokens_actual))
+        print(tokenizer.decode(tokenized_datasets[split][min_idx]["input_ids"]))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
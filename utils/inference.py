@@ -3,78 +3,20 @@ import glob
 import json
 import torch
 import numpy as np
-import pickle
 from pathlib import Path
-from tqdm import tqdm, trange
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import trange
 from transformers import AutoModelForCausalLM
 import hydra
 from omegaconf import DictConfig
-from data import get_data_for_inference, get_tokenizer, Datamodule
-
-def calculate_metrics(results_dict, tokenizer, delimiter_str):
-    """
-    Calculate token-level and exact match accuracy after the delimiter.
-    
-    Args:
-        results_dict: Dictionary containing predictions and ground truth
-        tokenizer: The tokenizer used
-        delimiter_str: The delimiter string from config (e.g., "OUT")
-    """
-    overall_metrics = {
-        'token_full_accuracy': [],
-        'exact_match_accuracy': []
-    }
-    
-    dataset_metrics = {}
-    
-    # Get token ID for the delimiter
-    delimiter_token_id = tokenizer.encode(delimiter_str, add_special_tokens=False)[0]
-    
-    for datapath, data in results_dict.items():
-        # Initialize metrics for this dataset
-        dataset_metrics[datapath] = {
-            'token_full_accuracy': [],
-            'exact_match_accuracy': []
-        }
-        
-        gt_solutions_ids = data['gt_solutions_ids']
-        predictions_ids = data['predictions_ids']
-        
-        for i in range(len(gt_solutions_ids)):
-            gt_ids = gt_solutions_ids[i]
-            pred_ids = predictions_ids[i]
-            
-            gt_post_delimiter = gt_ids
-            pred_post_delimiter = pred_ids
-            # Calculate token-by-token accuracy after delimiter
-            min_len = min(len(gt_post_delimiter), len(pred_post_delimiter))
-            matches = 0
-            for j in range(min_len):
-                if gt_post_delimiter[j] == pred_post_delimiter[j]:
-                    matches += 1
-            token_acc = matches / max(len(gt_post_delimiter), len(pred_post_delimiter)) if max(len(gt_post_delimiter), len(pred_post_delimiter)) > 0 else 1.0
-            
-            # Calculate exact match after delimiter
-            exact_match = 1.0 if gt_post_delimiter == pred_post_delimiter else 0.0
-            
-            # Add metrics for this example
-            dataset_metrics[datapath]['token_full_accuracy'].append(token_acc)
-            dataset_metrics[datapath]['exact_match_accuracy'].append(exact_match)
-            
-            # Add to overall metrics too
-            overall_metrics['token_full_accuracy'].append(token_acc)
-            overall_metrics['exact_match_accuracy'].append(exact_match)
-    
-    # Calculate averages for each dataset
-    for datapath in dataset_metrics:
-        for metric in dataset_metrics[datapath]:
-            dataset_metrics[datapath][metric] = np.mean(dataset_metrics[datapath][metric]) if dataset_metrics[datapath][metric] else 0
-    
-    # Calculate overall averages
-    for metric in overall_metrics:
-        overall_metrics[metric] = np.mean(overall_metrics[metric]) if overall_metrics[metric] else 0
-    
-    return overall_metrics, dataset_metrics
+from data import get_data_for_inference, get_tokenizer
+from codec import WordLevelCodec
+from generation import GenerationEngine, combine_stats, generation_budgets, hf_generate, load_lit_model
+from prefix_cache import PrefixKVCache
+from prompts import PromptSet
+from metrics import accuracy_curves, flatten_rows, merge_results, sequence_metrics, summarize
+from results_io import JOURNAL_FILE, ResultsJournal, ResultsWriter, id_lists
+from pipeline import StageTimer, run_pipeline
 
 @hydra.main(
     config_path="../config",
@@ -83,143 +25,281 @@ def calculate_metrics(results_dict, tokenizer, delimiter_str):
 )
 def main(cfg: DictConfig):
     batch_size = cfg.inference.batch_size
-    num_workers = cfg.data.num_workers
     delimiter_str = cfg.data.split_str
     
-    # Get HF model for batch inference
-    model_dir = Path(f"{cfg.inference.modelpath}")
-    state_dict = torch.load(model_dir / "model.pth")
-    
-    hf_model = AutoModelForCausalLM.from_pretrained(
-        model_dir,
-        torch_dtype=torch.bfloat16,
-        local_files_only=True,
-        # state_dict=state_dict,
-        attn_implementation="flash_attention_2",
-    )
-    
-    hf_model.cuda()
-    hf_model.eval()
-    
     tokenizer = get_tokenizer(cfg)
+    codec = WordLevelCodec.from_tokenizer(tokenizer)
+    
+    if cfg.inference.engine == "continuous":
+        # Continuous batching on the LitGPT checkpoint, with inference.batch_size slots
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        lit_model = load_lit_model(
+            cfg.inference.lit_modelpath,
+            device=device,
+            dtype=torch.bfloat16 if device == "cuda" else torch.float32,
+        )
+        prefix_cache = None
+        if cfg.inference.prefix_cache.enabled:
+            # One cache for all datasets, so headers shared across files are reused too
+            prefix_cache = PrefixKVCache(cfg.inference.prefix_cache.page_size, cfg.inference.prefix_cache.max_size_mb)
+        engine = GenerationEngine(
+            lit_model,
+            batch_size,
+            cfg.model.block_size,
+            tokenizer.eos_token_id,
+            tokenizer.pad_token_id,
+            num_draft_tokens=cfg.generation.num_draft_tokens,
+            draft_ngram_size=cfg.generation.draft_ngram_size,
+            prefix_cache=prefix_cache,
+        )
+        hf_model = None
+    else:
+        # Get HF model for batch inference
+        model_dir = Path(f"{cfg.inference.modelpath}")
+        state_dict = torch.load(model_dir / "model.pth")
+        
+        hf_model = AutoModelForCausalLM.from_pretrained(
+            model_dir,
+            torch_dtype=torch.bfloat16,
+            local_files_only=True,
+            # state_dict=state_dict,
+            attn_implementation="flash_attention_2",
+        )
+        
+        hf_model.cuda()
+        hf_model.eval()
+        engine = None
     
     # Load the data from a directory
-    datapaths = glob.glob(f"{cfg.inference.datapath}/*.json")
+    # Sorted, so chunks are the same in a resumed run
+    datapaths = sorted(glob.glob(f"{cfg.inference.datapath}/*.json"))
     
-    # Tokenize it
-    tokenized_datasets = get_data_for_inference(cfg, datapaths, tokenizer)
+    # Use ":" as the delimiter
+    delimiter_token_id = tokenizer.encode(delimiter_str, add_special_tokens=False)[0]
     
-    results_dict = {}
+    timer = StageTimer()
     
-    # For all tokenized datasets
-    for i, tok_dataset in tqdm(enumerate(tokenized_datasets)):
-        # Get the corresponding datapath
-        current_path = datapaths[i]
-        
-        data = Datamodule(tok_dataset, batch_size, num_workers, tokenizer)
-        data.connect(max_seq_length=cfg.model.block_size)
-        data.setup()
-        
-        test_set = data.test_dataset
-        
-        # Use ":" as the delimiter
-        delimiter_token_id = tokenizer.encode(delimiter_str, add_special_tokens=False)[0]
-        
-        # Initialize lists for this dataset
-        solutions_text = []
-        solutions_ids = []
-        prompts_text = []
-        prompts_ids = []
-        
-        for sample in tqdm(test_set, desc=f"Processing {os.path.basename(current_path)}"):
-            input_ids = sample["input_ids"]
-            
-            try:
-                # Find the colon delimiter
-                split_index = input_ids.index(delimiter_token_id)
-                # Find the EOS token
-                end_index = input_ids.index(tokenizer.eos_token_id) if tokenizer.eos_token_id in input_ids else len(input_ids)
-            except ValueError:
-                print(f"Warning: Could not find delimiter {delimiter_str} or EOS token in sample")
-                print(tokenizer.decode(input_ids, skip_special_tokens=True))
-                continue
-                
-            # Take everything up to ":" token (including it)
-            prompt_ids = input_ids[:split_index + 1]
-            
-            # Decode to text, add BOS token at start
-            prompt_text = tokenizer.decode(prompt_ids, skip_special_tokens=True)
-            full_prompt = tokenizer.bos_token + " " + prompt_text
-            # Solution is everything after ":" up to EOS
-            solution_text = tokenizer.decode(input_ids[split_index+1:end_index], skip_special_tokens=True)
-            solution_ids = input_ids[split_index+1:end_index]
+    def load(current_path):
+        # Tokenize it
+        with timer.time("load"):
+            test_dataset = get_data_for_inference(cfg, [current_path], tokenizer)[0]["test"]
             
-            # Re-encode prompt with BOS token
-            prompt_with_bos = tokenizer.encode(
-                full_prompt, add_special_tokens=False
+            # Slice every sample at the delimiter and EOS on token ids, all at once
+            prompt_set = PromptSet.from_dataset(
+                test_dataset, codec, delimiter_token_id, tokenizer.bos_token_id, tokenizer.eos_token_id
             )
             
-            prompts_ids.append(prompt_with_bos)
-            prompts_text.append(full_prompt)
-            solutions_text.append(solution_text)
-            solutions_ids.append(solution_ids)
-        
-        # Store the lists in the dictionary for this datapath
-        results_dict[current_path] = {
-            'prompts_ids': prompts_ids,
-            'prompts_text': prompts_text,
-            'gt_solutions_text': solutions_text,
-            'gt_solutions_ids': solutions_ids,
-            'predictions_text': [],
-            'predictions_ids': []
-        }
+            # Optional cap on new tokens, derived from this dataset's ground truth lengths
+            budgets = generation_budgets(prompt_set.gt_lengths, cfg.generation.budget, cfg.generation.budget_margin)
+            if budgets is not None:
+                budgets = np.broadcast_to(np.asarray(budgets, dtype=np.int64), (len(prompt_set),))
+            return prompt_set, budgets
+    
+    with ThreadPoolExecutor(max_workers=cfg.inference.pipeline.num_workers) as pool:
+        loaded = list(pool.map(load, datapaths))
+    prompt_sets = [prompt_set for prompt_set, _ in loaded]
+    
+    # One queue over all files, longest prompts first, cut into full batches across file
+    # boundaries: batches only mix similar prompt lengths and only the very last one is partial
+    queue = PromptSet.concat(prompt_sets)
+    file_sizes = np.array([len(prompt_set) for prompt_set in prompt_sets], dtype=np.int64)
+    file_offsets = np.concatenate([[0], np.cumsum(file_sizes)]).astype(np.int64)
+    file_of = np.repeat(np.arange(len(datapaths)), file_sizes)
+    budgets = None
+    if cfg.generation.budget != "none":
+        budgets = np.concatenate([file_budgets for _, file_budgets in loaded] + [np.zeros(0, dtype=np.int64)])
+    order = np.argsort(-queue.prompt_lengths, kind="stable")
+    chunk_size = batch_size * cfg.inference.pipeline.batches_per_chunk
+    chunks = [order[b:b + chunk_size] for b in range(0, len(order), chunk_size)]
+    print(f"{len(queue)} examples from {len(datapaths)} files in {len(chunks)} chunks of up to {chunk_size}")
+    
+    # Every generated chunk is journaled, so a run that times out or is preempted
+    # continues where it stopped as long as data, model and batching are unchanged
+    output_dir = Path("./temp/inference_results")
+    model_path = Path(cfg.inference.lit_modelpath if engine is not None else cfg.inference.modelpath)
+    journal = ResultsJournal(
+        output_dir / JOURNAL_FILE,
+        {
+            'datapaths': [os.path.abspath(path) for path in datapaths],
+            'data_bytes': [os.path.getsize(path) for path in datapaths],
+            'examples': file_sizes.tolist(),
+            'model': str(model_path.resolve()),
+            'model_mtime': max((path.stat().st_mtime for path in model_path.iterdir()), default=0),
+            'engine': cfg.inference.engine,
+            'chunk_size': chunk_size,
+            'block_size': cfg.model.block_size,
+            'budget': [cfg.generation.budget, cfg.generation.budget_margin],
+        },
+        resume=cfg.inference.resume,
+    )
+    if journal.completed:
+        print(f"Resuming from {journal.path}: {len(journal.completed)}/{len(chunks)} chunks already generated")
+    
+    # Per-example rows are written to Parquet shards as soon as their chunk is generated, in
+    # generation order (``datapath`` and ``example`` locate them); only the per-example metric
+    # arrays of every file are kept for the per-file and overall numbers
+    writer = ResultsWriter(output_dir / "results", rows_per_shard=cfg.inference.rows_per_shard)
+    file_results = [[] for _ in datapaths]
+    dataset_results = {}
+    dataset_metrics = {}
+    dataset_curves = {}
+    generation_stats = {current_path: {'generated_tokens': 0, 'budget_hits': 0} for current_path in datapaths}
+    chunk_stats = []
+    remaining = file_sizes.copy()
+    
+    def finish_file(f):
+        current_path = datapaths[f]
+        results = merge_results(file_results[f])
+        file_results[f] = None
+        dataset_results[current_path] = results
+        dataset_metrics[current_path] = summarize(results)
+        dataset_curves[current_path] = accuracy_curves(results)
+        if budgets is not None:
+            print(f"{os.path.basename(current_path)}: {generation_stats[current_path]['budget_hits']}/{file_sizes[f]} sequences stopped by the generation budget")
+    
+    # Slicing the next chunks and scoring the previous one run on CPU threads
+    # while the current one is generated, see pipeline.py
+    def prepare(chunk):
+        chunk_id, indices = chunk
+        chunk_budgets = budgets[indices].tolist() if budgets is not None else None
+        return chunk_id, indices, queue.select(indices), chunk_budgets
+    
+    def generate(prepared):
+        _, _, prompt_set, chunk_budgets = prepared
+        if engine is not None:
+            output_sequences = engine.generate(prompt_set, max_new_tokens=chunk_budgets)
+            # Copied, the engine resets its stats on the next call
+            return output_sequences, dict(engine.stats)
         
         # Process in batches for generation
-        for b in trange(0, len(prompts_ids), batch_size, desc=f"Generating predictions for {os.path.basename(current_path)}"):
-            batch = prompts_ids[b:min(b + batch_size, len(prompts_ids))]
-            batch_text = [tokenizer.decode(x, skip_special_tokens=False) for x in batch]
-            tokenizer.padding_side = "left"
-            inputs = tokenizer(batch_text, return_tensors="pt", padding=True).to("cuda")
+        output_sequences = []
+        budget_hits = 0
+        for b in trange(0, len(prompt_set), batch_size, desc="Generating predictions"):
+            end = min(b + batch_size, len(prompt_set))
+            input_ids, attention_mask = prompt_set.padded_batch(b, end, tokenizer.pad_token_id)
             
             with torch.no_grad():
-                outputs = hf_model.generate(
-                    input_ids=inputs["input_ids"],
-                    pad_token_id=tokenizer.pad_token_id,
-                    attention_mask=inputs["attention_mask"],
-                    max_length=cfg.model.block_size,
-                    num_beams=1,
-                    do_sample=False,
-                    eos_token_id=tokenizer.eos_token_id,
+                batch_sequences, batch_hits = hf_generate(
+                    hf_model,
+                    input_ids.to("cuda"),
+                    attention_mask.to("cuda"),
+                    cfg.model.block_size,
+                    tokenizer.eos_token_id,
+                    tokenizer.pad_token_id,
+                    max_new_tokens=chunk_budgets[b:end] if chunk_budgets is not None else None,
                 )
+            output_sequences.extend(batch_sequences)
+            budget_hits += batch_hits
+        return output_sequences, {'budget_hits': budget_hits}
+    
+    def record(indices, chunk_answers, chunk_eos, stats):
+        chunk_stats.append(stats)
+        chunk_eos = np.asarray(chunk_eos, dtype=bool)
+        
+        # Score and write the chunk file by file, every file's rows in one batch
+        chunk_files = file_of[indices]
+        for f in np.unique(chunk_files):
+            current_path = datapaths[f]
+            rows = np.flatnonzero(chunk_files == f)
+            examples = indices[rows]
+            prompt_set = queue.select(examples)
+            generated_sequences = [chunk_answers[i] for i in rows]
+            
+            # Token and exact match accuracy after the delimiter, on ids
+            pred_flat, pred_lengths = flatten_rows(generated_sequences)
+            results = sequence_metrics(pred_flat, pred_lengths, prompt_set.gt_tokens, prompt_set.gt_lengths)
+            file_results[f].append(results)
             
-            # Process each generated sequence
-            batch_outputs = outputs.tolist()
-            for j, output_ids in enumerate(batch_outputs):
-                # Find the delimiter token in the output
-                try:
-                    split_index = output_ids.index(delimiter_token_id)
-                    # Find the EOS token
-                    end_index = output_ids.index(tokenizer.eos_token_id) if tokenizer.eos_token_id in output_ids else len(output_ids)
-                    
-                    # Extract everything after the delim up to EOS
-                    generated_ids = output_ids[split_index+1:end_index]
-                    generated_text = tokenizer.decode(generated_ids, skip_special_tokens=True)
-                    
-                except ValueError:
-                    print(f"Warning: Could not find delimiter or EOS in generated output")
-                    # If no delimiter found, use empty list/string as prediction
-                    generated_ids = []
-                    generated_text = ""
+            # Sequences that ran into their budget: no EOS and exactly budget new tokens
+            eos = chunk_eos[rows]
+            stats = generation_stats[current_path]
+            stats['generated_tokens'] += int(pred_lengths.sum() + eos.sum())
+            if budgets is not None:
+                stats['budget_hits'] += int((~eos & (pred_lengths == budgets[examples])).sum())
+            
+            writer.write_batch({
+                'datapath': [current_path] * len(rows),
+                'example': examples - file_offsets[f],
+                'prompt_ids': id_lists(prompt_set.prompt_tokens, prompt_set.prompt_lengths),
+                'gt_ids': id_lists(prompt_set.gt_tokens, prompt_set.gt_lengths),
+                'prediction_ids': id_lists(pred_flat, pred_lengths),
+                'token_accuracy': results['token_accuracy'],
+                'exact_match': results['exact_match'],
+                'first_error': results['first_error'],
+            })
+            
+            remaining[f] -= len(rows)
+            if remaining[f] == 0:
+                finish_file(f)
+        # Every generated chunk is on disk even if a later one crashes
+        writer.flush()
+    
+    def finish(prepared, generated):
+        chunk_id, indices, _, _ = prepared
+        output_sequences, stats = generated
+        
+        # Process each generated sequence
+        chunk_answers = []
+        chunk_eos = []
+        for output_ids in output_sequences:
+            eos = False
+            # Find the delimiter token in the output
+            try:
+                split_index = output_ids.index(delimiter_token_id)
+                # Find the EOS token
+                eos = tokenizer.eos_token_id in output_ids[split_index+1:]
+                end_index = output_ids.index(tokenizer.eos_token_id, split_index+1) if eos else len(output_ids)
                 
-                results_dict[current_path]['predictions_text'].append(generated_text)
-                results_dict[current_path]['predictions_ids'].append(generated_ids)
+                # Extract everything after the delim up to EOS
+                generated_ids = output_ids[split_index+1:end_index]
+                
+            except ValueError:
+                print(f"Warning: Could not find delimiter or EOS in generated output")
+                # If no delimiter found, use empty list/string as prediction
+                generated_ids = []
+            
+            chunk_answers.append(generated_ids)
+            chunk_eos.append(eos)
+        
+        journal.append(chunk_id, {'answers': chunk_answers, 'eos': chunk_eos, 'stats': stats})
+        record(indices, chunk_answers, chunk_eos, stats)
+    
+    for f in np.flatnonzero(file_sizes == 0):
+        finish_file(f)
+    # Chunks of an earlier run are taken from the journal instead of generated again
+    pending = [(chunk_id, indices) for chunk_id, indices in enumerate(chunks) if chunk_id not in journal.completed]
+    for chunk_id in sorted(journal.completed):
+        done = journal.completed.pop(chunk_id)
+        record(chunks[chunk_id], done['answers'], done['eos'], done['stats'])
+    run_pipeline(
+        pending,
+        prepare,
+        generate,
+        finish,
+        num_workers=cfg.inference.pipeline.num_workers,
+        prefetch=cfg.inference.pipeline.prefetch,
+        timer=timer,
+    )
     
-    # Calculate metrics
-    overall_metrics, dataset_metrics = calculate_metrics(results_dict, tokenizer, cfg.data.split_str)
+    engine_stats = combine_stats(chunk_stats)
+    if engine is not None and engine_stats:
+        print(
+            f"{engine_stats['generated_tokens']} tokens in {engine_stats['seconds']:.1f}s "
+            f"({engine_stats['tokens_per_sec']:.0f} tokens/s)"
+        )
+        if engine.num_draft_tokens > 0:
+            print(
+                f"  speculative decoding: {engine_stats['acceptance_rate']:.1%} of drafted tokens accepted, "
+                f"{engine_stats['tokens_per_decode_step']:.2f} tokens per decode step"
+            )
+        if engine.prefix_cache is not None:
+            print(
+                f"  prefix cache: {engine_stats['prefix_hit_rate']:.1%} of prompt tokens reused, "
+                f"{engine.prefix_cache.num_pages} pages ({engine.prefix_cache.bytes / 1024**2:.0f} MB) cached"
+            )
     
-    # Add metrics to results_dict
-    results_dict['overall_metrics'] = overall_metrics
-    results_dict['dataset_metrics'] = dataset_metrics
+    # Overall averages are over all examples, not over datasets
+    overall_metrics = summarize(merge_results(list(dataset_results.values())))
     
     # Print metrics
     print("\nOverall Metrics:")
@@ -232,15 +312,21 @@ def main(cfg: DictConfig):
         for metric, value in metrics.items():
             print(f"  {metric}: {value:.4f}")
     
-    # Create output directory
-    output_dir = Path("./temp/inference_results")
-    output_dir.mkdir(parents=True, exist_ok=True)
+    print(f"\nPipeline stages:\n{timer.summary()}")
+    
+    writer.close({
+        'overall_metrics': overall_metrics,
+        'dataset_metrics': dataset_metrics,
+        'metric_curves': dataset_curves,
+        'generation_stats': generation_stats,
+        'engine_stats': engine_stats,
+        'stage_timings': timer.report(),
+    })
     
-    # Save the results dictionary as pickle
-    with open(output_dir / "results.pkl", 'wb') as f:
-        pickle.dump(results_dict, f)
+    # Everything is merged into the results, the journal is only needed by an unfinished run
+    journal.remove()
     
-    print(f"Results saved to {output_dir / 'results.pkl'}")
+    print(f"Results saved to {writer.path} ({writer.num_rows} examples in {writer.num_shards} shards)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,149 @@
+"""
+Accuracy metrics of generated answers, computed on token ids.
+
+Predictions and ground truths are ragged id sequences. They are compared in
+chunks of rows padded into 2D arrays, with different fill values so padding
+never matches. Every comparison happens in one array op per chunk instead of
+a Python loop per token, and ids are never decoded to strings.
+
+Besides token and exact-match accuracy, this gives the accuracy at every
+ground-truth position and a histogram of where the first wrong token of each
+answer is. Together they show whether errors pile up late in long outputs or
+start right after the delimiter.
+"""
+import itertools
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+
+
+def flatten_rows(rows: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Concatenated ids and lengths of ragged rows."""
+    lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    flat = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=int(lengths.sum()))
+    return flat, lengths
+
+
+def drop_ids(flat: np.ndarray, lengths: np.ndarray, drop: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Remove ids flagged in ``drop`` (indexed by id, e.g. ``WordLevelCodec.is_special``) from every row.
+
+    Ids outside of ``drop`` are removed too, matching a decode/encode round trip.
+    """
+    flat = np.asarray(flat, dtype=np.int64)
+    in_range = (flat >= 0) & (flat < len(drop))
+    keep = in_range.copy()
+    keep[in_range] = ~drop[flat[in_range]]
+    row_ids = np.repeat(np.arange(len(lengths)), lengths)
+    return flat[keep], np.bincount(row_ids[keep], minlength=len(lengths)).astype(np.int64)
+
+
+def _pad(flat: np.ndarray, offsets: np.ndarray, lengths: np.ndarray, start: int, end: int, width: int, fill: int):
+    rows = lengths[start:end]
+    padded = np.full((end - start, width), fill, dtype=np.int64)
+    cols = np.arange(width)[None, :]
+    mask = cols < rows[:, None]
+    padded[mask] = flat[offsets[start] : offsets[end]]
+    return padded
+
+
+def sequence_metrics(
+    pred_flat: np.ndarray,
+    pred_lengths: np.ndarray,
+    gt_flat: np.ndarray,
+    gt_lengths: np.ndarray,
+    chunk_size: int = 4096,
+) -> Dict[str, np.ndarray]:
+    """
+    Compare predictions with ground truths, row ``i`` of both being ``lengths[i]`` ids long.
+
+    Returns:
+        Per example: ``token_accuracy`` (matching positions / longer length, 1 if both
+        are empty), ``exact_match`` and ``first_error`` (position of the first wrong or
+        missing token, -1 for exact matches). Per ground-truth position:
+        ``position_correct`` and ``position_total`` (examples whose ground truth is that long).
+    """
+    pred_lengths = np.asarray(pred_lengths, dtype=np.int64)
+    gt_lengths = np.asarray(gt_lengths, dtype=np.int64)
+    pred_flat = np.asarray(pred_flat, dtype=np.int64)
+    gt_flat = np.asarray(gt_flat, dtype=np.int64)
+    pred_offsets = np.concatenate([[0], np.cumsum(pred_lengths)]).astype(np.int64)
+    gt_offsets = np.concatenate([[0], np.cumsum(gt_lengths)]).astype(np.int64)
+
+    n = len(gt_lengths)
+    longest_gt = int(gt_lengths.max()) if n > 0 else 0
+    token_accuracy = np.ones(n, dtype=np.float64)
+    exact_match = np.zeros(n, dtype=bool)
+    first_error = np.full(n, -1, dtype=np.int64)
+    position_correct = np.zeros(longest_gt, dtype=np.int64)
+    position_total = np.zeros(longest_gt, dtype=np.int64)
+
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        longest = np.maximum(pred_lengths[start:end], gt_lengths[start:end])
+        width = int(longest.max()) if end > start else 0
+        # Different fills, so a missing token never matches padding on the other side
+        pred = _pad(pred_flat, pred_offsets, pred_lengths, start, end, width, -1)
+        gt = _pad(gt_flat, gt_offsets, gt_lengths, start, end, width, -2)
+
+        equal = pred == gt
+        matches = equal.sum(axis=1)
+        token_accuracy[start:end] = np.where(longest > 0, matches / np.maximum(longest, 1), 1.0)
+        exact_match[start:end] = matches == longest
+
+        # Positions past the longer row are padding on both sides, so count them as equal
+        wrong = ~equal & (np.arange(width)[None, :] < longest[:, None])
+        has_error = wrong.any(axis=1)
+        first_error[start:end] = np.where(has_error, wrong.argmax(axis=1), -1)
+
+        in_gt = np.arange(width)[None, :] < gt_lengths[start:end, None]
+        position_correct[: min(width, longest_gt)] += (equal & in_gt).sum(axis=0)[:longest_gt]
+        position_total[: min(width, longest_gt)] += in_gt.sum(axis=0)[:longest_gt]
+
+    return {
+        "token_accuracy": token_accuracy,
+        "exact_match": exact_match,
+        "first_error": first_error,
+        "position_correct": position_correct,
+        "position_total": position_total,
+    }
+
+
+def summarize(results: Dict[str, np.ndarray]) -> Dict[str, float]:
+    """Token and exact-match accuracy averaged over examples."""
+    n = len(results["token_accuracy"])
+    return {
+        "token_full_accuracy": float(results["token_accuracy"].mean()) if n else 0.0,
+        "exact_match_accuracy": float(results["exact_match"].mean()) if n else 0.0,
+    }
+
+
+def accuracy_curves(results: Dict[str, np.ndarray]) -> Dict[str, list]:
+    """
+    Per-position accuracy and the first-error histogram, as lists for JSON.
+
+    ``first_error_histogram[j]`` counts the answers whose first wrong token is at position ``j``.
+    """
+    total = results["position_total"]
+    position_accuracy = np.divide(
+        results["position_correct"], total, out=np.zeros(len(total), dtype=np.float64), where=total > 0
+    )
+    first_error = results["first_error"]
+    return {
+        "position_accuracy": position_accuracy.tolist(),
+        "position_support": total.tolist(),
+        "first_error_histogram": np.bincount(first_error[first_error >= 0]).tolist(),
+    }
+
+
+def merge_results(results: Sequence[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Results of several ``sequence_metrics`` calls as if they were one."""
+    if not results:
+        return sequence_metrics([], [], [], [])
+    merged = {key: np.concatenate([r[key] for r in results]) for key in ("token_accuracy", "exact_match", "first_error")}
+    for key in ("position_correct", "position_total"):
+        width = max((len(r[key]) for r in results), default=0)
+        merged[key] = np.zeros(width, dtype=np.int64)
+        for r in results:
+            merged[key][: len(r[key])] += r[key]
+    return merged
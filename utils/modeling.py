@@ -0,0 +1,70 @@
+"""
+Forward passes over a LitGPT ``GPT`` with explicit positions and attention masks.
+
+``GPT.forward`` only knows plain causal attention over positions ``0..T-1``
+(or the KV cache). These helpers run the same modules but let the caller pick
+the rotary positions and the attention mask, e.g. to keep packed documents
+from attending to each other.
+"""
+import torch
+from litgpt.model import GPT, do_softcapping
+
+
+def document_mask(position_ids: torch.Tensor) -> torch.Tensor:
+    """
+    Causal attention mask that does not cross document boundaries.
+
+    A new document starts wherever the position id drops back to 0.
+
+    Args:
+        position_ids: Per-document positions, ``(B, T)``.
+
+    Returns:
+        Boolean mask ``(B, 1, T, T)``, True where attention is allowed.
+    """
+    T = position_ids.size(1)
+    documents = (position_ids == 0).cumsum(dim=1)
+    same_document = documents.unsqueeze(2) == documents.unsqueeze(1)
+    causal = torch.ones(T, T, dtype=torch.bool, device=position_ids.device).tril()
+    return (same_document & causal).unsqueeze(1)
+
+
+def gpt_forward(
+    model: GPT,
+    idx: torch.Tensor,
+    position_ids: torch.Tensor,
+    mask: torch.Tensor,
+    input_pos: torch.Tensor = None,
+) -> torch.Tensor:
+    """
+    Mirror of ``GPT.forward`` with caller-provided rotary positions and mask.
+
+    Args:
+        model: The LitGPT model.
+        idx: Token ids, ``(B, T)``.
+        position_ids: Rotary position of every token, ``(B, T)``.
+        mask: Boolean attention mask, ``(B, 1, T, T_kv)``.
+        input_pos: KV cache slots to write to; None runs without a KV cache.
+
+    Returns:
+        Logits, ``(B, T, padded_vocab_size)``.
+    """
+    cos = model.cos[position_ids]
+    sin = model.sin[position_ids]
+
+    x = model.transformer.wte(idx)
+    if model.config.scale_embeddings:
+        x = x * torch.tensor(model.config.n_embd**0.5, dtype=x.dtype)
+    for block in model.transformer.h:
+        x = block(x, cos, sin, mask, input_pos)
+    x = model.transformer.ln_f(x)
+
+    logits = model.lm_head(x)
+    if model.config.final_logit_softcapping is not None:
+        logits = do_softcapping(logits, model.config.final_logit_softcapping)
+    return logits
+
+
+def packed_forward(model: GPT, idx: torch.Tensor, position_ids: torch.Tensor) -> torch.Tensor:
+    """Forward packed rows; every document only attends to itself."""
+    return gpt_forward(model, idx, position_ids, document_mask(position_ids))
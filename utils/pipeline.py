@@ -0,0 +1,154 @@
+"""
+Producer/consumer pipeline that keeps the device generating.
+
+Inference work is a sequence of items (e.g. chunks of prompts) that each go
+through three stages:
+
+    prepare  - CPU: slice prompts, pad batches, compute budgets
+    generate - device: run the model
+    finish   - CPU: slice answers, compute metrics, write results
+
+``run_pipeline`` runs ``prepare`` on a thread pool up to ``prefetch`` items
+ahead of the device and ``finish`` on its own thread behind it, so the model
+only waits for CPU work when preparing an item takes longer than generating
+the previous one. ``generate`` stays on the calling thread, which owns the
+model and its CUDA context. Items are generated and finished in order.
+
+``StageTimer`` records where the time goes: busy time per stage, plus
+``wait_prepare`` (device idle, waiting for input) and ``wait_finish``
+(device idle, waiting for post-processing to catch up).
+"""
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class StageTimer:
+    """Thread-safe accumulated seconds and call counts per stage."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float, count: int = 1) -> None:
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.counts[stage] += count
+
+    def report(self) -> Dict[str, float]:
+        """Seconds per stage, wall time since creation and the share of it the device was generating."""
+        wall = time.perf_counter() - self._start
+        with self._lock:
+            report = {f"{stage}_seconds": seconds for stage, seconds in self.seconds.items()}
+            report.update({f"{stage}_count": count for stage, count in self.counts.items()})
+        report["wall_seconds"] = wall
+        report["device_busy"] = report.get("generate_seconds", 0.0) / wall if wall > 0 else 0.0
+        return report
+
+    def summary(self) -> str:
+        report = self.report()
+        lines = [f"Wall time {report['wall_seconds']:.1f}s, device generating {report['device_busy']:.1%} of it"]
+        for stage in self.seconds:
+            lines.append(f"  {stage:>12}: {report[f'{stage}_seconds']:8.1f}s over {report[f'{stage}_count']} calls")
+        return "\n".join(lines)
+
+
+def run_pipeline(
+    items: Iterable[Any],
+    prepare: Callable[[Any], Any],
+    generate: Callable[[Any], Any],
+    finish: Callable[[Any, Any], None],
+    num_workers: int = 4,
+    prefetch: int = 2,
+    timer: Optional[StageTimer] = None,
+) -> StageTimer:
+    """
+    Run ``finish(prepared, generate(prepared))`` with ``prepared = prepare(item)`` for every item.
+
+    Args:
+        items: Work items, consumed lazily.
+        prepare: CPU work, called from ``num_workers`` threads.
+        generate: Device work, called from the calling thread.
+        finish: CPU post-processing, called from one thread in item order.
+        num_workers: Threads for ``prepare``.
+        prefetch: Items prepared ahead of the one being generated, and
+            generated items that may wait for ``finish``. Bounds memory.
+        timer: Timer to record into; a new one by default.
+
+    Returns:
+        The timer with the per-stage timings.
+
+    The first exception of any stage stops the pipeline and is re-raised.
+    """
+    timer = timer if timer is not None else StageTimer()
+    finish_queue: "queue.Queue" = queue.Queue(maxsize=max(1, prefetch))
+    errors = []
+
+    def finisher():
+        while True:
+            job = finish_queue.get()
+            if job is None:
+                return
+            # After a failure keep draining, so the producer never blocks on a full queue
+            if errors:
+                continue
+            try:
+                with timer.time("finish"):
+                    finish(*job)
+            except BaseException as e:
+                errors.append(e)
+
+    def timed_prepare(item):
+        with timer.time("prepare"):
+            return prepare(item)
+
+    thread = threading.Thread(target=finisher, name="pipeline-finish", daemon=True)
+    thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="pipeline-prepare") as pool:
+            items = iter(items)
+            pending = deque()
+
+            def submit_ahead():
+                while len(pending) <= prefetch:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    pending.append(pool.submit(timed_prepare, item))
+
+            submit_ahead()
+            while pending:
+                with timer.time("wait_prepare"):
+                    prepared = pending.popleft().result()
+                submit_ahead()
+                with timer.time("generate"):
+                    generated = generate(prepared)
+                with timer.time("wait_finish"):
+                    finish_queue.put((prepared, generated))
+                if errors:
+                    break
+            else:
+                return timer
+            for future in pending:
+                future.cancel()
+    finally:
+        finish_queue.put(None)
+        thread.join()
+        if errors:
+            raise errors[0]
+    return timer
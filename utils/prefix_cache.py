@@ -0,0 +1,143 @@
+"""
+Shared-prefix KV cache for the generation engine.
+
+Prompts of templated eval suites often start with the same header (the same
+graph, the same instructions). The KV entries of a token only depend on the
+tokens before it and on its position, and every engine slot starts at
+position 0, so the keys and values computed for a shared prefix can be copied
+into a new slot instead of being prefilled again.
+
+The cache is a radix tree over token ids with fixed-size pages as edges: every
+node holds the keys and values of ``page_size`` tokens for all layers, and
+the path from the root spells out the prefix. Leaves are evicted least
+recently used first once the cache grows past its memory budget.
+"""
+import heapq
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+class PrefixNode:
+    __slots__ = ("parent", "key", "children", "k", "v", "last_used")
+
+    def __init__(self, parent: Optional["PrefixNode"], key: Optional[Tuple[int, ...]], k=None, v=None):
+        self.parent = parent
+        self.key = key
+        self.children: Dict[Tuple[int, ...], "PrefixNode"] = {}
+        # (n_layer, n_query_groups, page_size, head_size)
+        self.k = k
+        self.v = v
+        self.last_used = 0
+
+    @property
+    def nbytes(self) -> int:
+        if self.k is None:
+            return 0
+        return self.k.numel() * self.k.element_size() + self.v.numel() * self.v.element_size()
+
+
+class PrefixKVCache:
+    """
+    Args:
+        page_size: Tokens per KV block; only whole pages are cached and matched.
+        max_size_mb: Memory budget of all blocks.
+    """
+
+    def __init__(self, page_size: int = 16, max_size_mb: float = 1024):
+        self.page_size = page_size
+        self.max_bytes = int(float(max_size_mb) * 1024**2)
+        self.root = PrefixNode(None, None)
+        self.bytes = 0
+        self.num_pages = 0
+        self._clock = 0
+        self.counters = {
+            "lookups": 0,
+            "prompt_tokens": 0,
+            "hit_tokens": 0,
+            "inserted_pages": 0,
+            "evicted_pages": 0,
+        }
+
+    def match(self, tokens: Sequence[int]) -> List[PrefixNode]:
+        """
+        Cached pages at the start of ``tokens``, in order.
+
+        The last token is never covered, so there is always something left to
+        prefill to get the logits of the next token from.
+        """
+        self._clock += 1
+        nodes = []
+        node = self.root
+        for start in range(0, len(tokens) - self.page_size, self.page_size):
+            child = node.children.get(tuple(tokens[start : start + self.page_size]))
+            if child is None:
+                break
+            child.last_used = self._clock
+            nodes.append(child)
+            node = child
+
+        self.counters["lookups"] += 1
+        self.counters["prompt_tokens"] += len(tokens)
+        self.counters["hit_tokens"] += len(nodes) * self.page_size
+        return nodes
+
+    def insert(self, tokens: Sequence[int], read_page: Callable[[int], Tuple[torch.Tensor, torch.Tensor]]) -> None:
+        """
+        Add all whole pages of ``tokens`` that are not cached yet.
+
+        Args:
+            tokens: A prompt whose keys and values were just computed.
+            read_page: Returns the keys and values of the page starting at the given position,
+                ``(n_layer, n_query_groups, page_size, head_size)`` each.
+        """
+        self._clock += 1
+        node = self.root
+        for start in range(0, len(tokens) - self.page_size + 1, self.page_size):
+            key = tuple(tokens[start : start + self.page_size])
+            child = node.children.get(key)
+            if child is None:
+                k, v = read_page(start)
+                child = PrefixNode(node, key, k, v)
+                node.children[key] = child
+                self.bytes += child.nbytes
+                self.num_pages += 1
+                self.counters["inserted_pages"] += 1
+            child.last_used = self._clock
+            node = child
+        self._evict()
+
+    def _evict(self) -> None:
+        """Drop least recently used leaves until the cache fits into its budget."""
+        if self.bytes <= self.max_bytes:
+            return
+
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if not node.children and node is not self.root:
+                leaves.append((node.last_used, id(node), node))
+        heapq.heapify(leaves)
+
+        while self.bytes > self.max_bytes and leaves:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.key]
+            node.parent = None
+            self.bytes -= node.nbytes
+            self.num_pages -= 1
+            self.counters["evicted_pages"] += 1
+            # A parent whose last child went away is a leaf now
+            if parent is not self.root and not parent.children:
+                heapq.heappush(leaves, (parent.last_used, id(parent), parent))
+
+    def stats(self) -> Dict[str, float]:
+        counters = self.counters
+        return {
+            **counters,
+            "hit_rate": counters["hit_tokens"] / counters["prompt_tokens"] if counters["prompt_tokens"] else 0.0,
+            "pages": self.num_pages,
+            "size_mb": self.bytes / 1024**2,
+        }
@@ -0,0 +1,204 @@
+"""
+Prompts and ground truths of a tokenized split, extracted on token ids.
+
+Every row is ``[BOS] input [OUT] output [EOS]``. The prompt is the row up to
+and including the first ``[OUT]`` with special tokens dropped and ``[BOS]``
+put back in front; the ground truth is everything after ``[OUT]`` up to the
+first ``[EOS]``. Both are found with array ops over all rows at once instead
+of a decode/encode round trip per example, and the prompts are kept flat so
+batches are left-padded straight into tensors.
+"""
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import torch
+
+try:
+    from utils.token_store import TokenStore
+except ImportError:
+    from token_store import TokenStore
+
+
+def flatten_split(dataset) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Concatenated token ids and row lengths of a tokenized split (TokenStore or HF dataset).
+    """
+    if isinstance(dataset, TokenStore):
+        return dataset.flat()
+    rows = dataset["input_ids"]
+    lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+    flat = np.fromiter((i for row in rows for i in row), dtype=np.int64, count=int(lengths.sum()))
+    return flat, lengths
+
+
+def _starts(lengths: np.ndarray) -> np.ndarray:
+    return np.cumsum(lengths) - lengths
+
+
+def _first_index(match: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Position of the first True of every row in ``match``, or the row length if there is none."""
+    positions = np.flatnonzero(match)
+    rows = np.repeat(np.arange(len(lengths)), lengths)[positions]
+    first = lengths.copy()
+    # Positions are sorted, so the first hit of a row is where its row id first shows up
+    hit_rows, first_hits = np.unique(rows, return_index=True)
+    first[hit_rows] = positions[first_hits] - _starts(lengths)[hit_rows]
+    return first
+
+
+class PromptSet:
+    """
+    Generation prompts and ground truths of a test split.
+
+    Build it with ``from_dataset``. Indexing returns the prompt ids of an
+    example as a list, so the set can stand in for a list of prompts.
+
+    Args:
+        prompt_tokens: All prompts back to back, each starting with ``[BOS]``.
+        prompt_lengths: Length of every prompt.
+        gt_tokens: All ground truth ids back to back.
+        gt_lengths: Length of every ground truth.
+        gts: Decoded ground truths (special tokens skipped).
+        rows: Row of the source split every example comes from.
+    """
+
+    def __init__(
+        self,
+        prompt_tokens: np.ndarray,
+        prompt_lengths: np.ndarray,
+        gt_tokens: np.ndarray,
+        gt_lengths: np.ndarray,
+        gts: List[str],
+        rows: np.ndarray,
+    ):
+        self.prompt_tokens = prompt_tokens
+        self.prompt_lengths = prompt_lengths
+        self.prompt_offsets = np.concatenate([[0], np.cumsum(prompt_lengths)]).astype(np.int64)
+        self.gt_tokens = gt_tokens
+        self.gt_lengths = gt_lengths
+        self.gt_offsets = np.concatenate([[0], np.cumsum(gt_lengths)]).astype(np.int64)
+        self.gts = gts
+        self.rows = rows
+
+    @classmethod
+    def from_dataset(cls, dataset, codec, delimiter_token_id: int, bos_token_id: int, eos_token_id: int) -> "PromptSet":
+        """
+        Extract prompts and ground truths from a tokenized split.
+
+        Rows without the delimiter are skipped (and counted in a warning).
+
+        Args:
+            dataset: TokenStore or HF dataset with ``input_ids``.
+            codec: ``WordLevelCodec`` of the tokenizer, for special tokens and decoding.
+            delimiter_token_id: Id of ``split_str``.
+            bos_token_id: Id put in front of every prompt.
+            eos_token_id: Id that ends the ground truth.
+        """
+        flat, lengths = flatten_split(dataset)
+        row_ids = np.repeat(np.arange(len(lengths)), lengths)
+        local = np.arange(len(flat), dtype=np.int64) - np.repeat(_starts(lengths), lengths)
+
+        split_index = _first_index(flat == delimiter_token_id, lengths)
+        end_index = _first_index(flat == eos_token_id, lengths)
+        valid = split_index < lengths
+        if not valid.all():
+            print(f"Warning: skipping {int((~valid).sum())} examples without the delimiter token")
+
+        in_vocab = (flat >= 0) & (flat < len(codec.is_special))
+        special = ~in_vocab
+        special[in_vocab] = codec.is_special[flat[in_vocab]]
+
+        # Prompt: everything up to and including the delimiter, special tokens dropped, [BOS] in front
+        keep_prompt = valid[row_ids] & (local <= split_index[row_ids]) & ~special
+        prompt_lengths = np.bincount(row_ids[keep_prompt], minlength=len(lengths))[valid] + 1
+        prompt_tokens = np.empty(int(prompt_lengths.sum()), dtype=np.int64)
+        is_bos = np.zeros(len(prompt_tokens), dtype=bool)
+        is_bos[_starts(prompt_lengths)] = True
+        prompt_tokens[is_bos] = bos_token_id
+        prompt_tokens[~is_bos] = flat[keep_prompt]
+
+        # Ground truth: everything after the delimiter up to the first EOS
+        keep_gt = valid[row_ids] & (local > split_index[row_ids]) & (local < end_index[row_ids])
+        gt_tokens = flat[keep_gt]
+        gt_lengths = np.bincount(row_ids[keep_gt], minlength=len(lengths))[valid]
+        gts = codec.decode_flat(gt_tokens, gt_lengths, skip_special_tokens=True)
+
+        return cls(prompt_tokens, prompt_lengths, gt_tokens, gt_lengths, gts, np.flatnonzero(valid))
+
+    def __len__(self) -> int:
+        return len(self.prompt_lengths)
+
+    def __getitem__(self, idx: int) -> List[int]:
+        return self.prompt_tokens[self.prompt_offsets[idx] : self.prompt_offsets[idx + 1]].tolist()
+
+    def gt_ids(self, idx: int) -> List[int]:
+        return self.gt_tokens[self.gt_offsets[idx] : self.gt_offsets[idx + 1]].tolist()
+
+    def select(self, indices) -> "PromptSet":
+        """Examples ``indices`` of the set, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        prompt_lengths = self.prompt_lengths[indices]
+        gt_lengths = self.gt_lengths[indices]
+
+        def gather(tokens, offsets, lengths):
+            positions = np.repeat(offsets[indices] - _starts(lengths), lengths) + np.arange(int(lengths.sum()), dtype=np.int64)
+            return tokens[positions]
+
+        return PromptSet(
+            gather(self.prompt_tokens, self.prompt_offsets, prompt_lengths),
+            prompt_lengths,
+            gather(self.gt_tokens, self.gt_offsets, gt_lengths),
+            gt_lengths,
+            [self.gts[i] for i in indices],
+            self.rows[indices],
+        )
+
+    @classmethod
+    def concat(cls, sets: Sequence["PromptSet"]) -> "PromptSet":
+        """All examples of ``sets`` in one set, in order. ``rows`` stay relative to each source split."""
+        if not sets:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(empty, empty, empty, empty, [], empty)
+        return cls(
+            np.concatenate([s.prompt_tokens for s in sets]),
+            np.concatenate([s.prompt_lengths for s in sets]),
+            np.concatenate([s.gt_tokens for s in sets]),
+            np.concatenate([s.gt_lengths for s in sets]),
+            [gt for s in sets for gt in s.gts],
+            np.concatenate([s.rows for s in sets]),
+        )
+
+    def shard(self, rank: int, world_size: int) -> Tuple["PromptSet", np.ndarray]:
+        """
+        Every ``world_size``-th example starting at ``rank``, for rank-sharded generation.
+
+        Returns:
+            The shard and the indices of its examples in this set.
+        """
+        indices = np.arange(rank, len(self), world_size, dtype=np.int64)
+        return self.select(indices), indices
+
+    def prompt_texts(self, codec) -> List[str]:
+        """Decoded prompts, special tokens included."""
+        return codec.decode_flat(self.prompt_tokens, self.prompt_lengths)
+
+    def padded_batch(self, start: int, end: int, pad_token_id: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Left-padded prompts ``start:end`` for generation.
+
+        Returns:
+            ``input_ids`` and ``attention_mask``, both ``(B, longest prompt)``.
+        """
+        lengths = self.prompt_lengths[start:end]
+        width = int(lengths.max()) if len(lengths) > 0 else 0
+        tokens = self.prompt_tokens[self.prompt_offsets[start] : self.prompt_offsets[end]]
+
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        cols = np.arange(len(tokens), dtype=np.int64) - np.repeat(_starts(lengths), lengths)
+        cols += np.repeat(width - lengths, lengths)
+
+        input_ids = np.full((len(lengths), width), pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(lengths), width), dtype=np.int64)
+        input_ids[rows, cols] = tokens
+        attention_mask[rows, cols] = 1
+        return torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
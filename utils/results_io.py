@@ -0,0 +1,244 @@
+"""
+Columnar storage of per-example eval and inference results.
+
+``ResultsWriter`` appends batches of rows (prompt ids, generated ids, ground
+truth ids, per-example metrics, ...) and writes them out as Parquet shards of
+``rows_per_shard`` rows. Every shard is written to a temporary file and renamed
+when complete, so a crash only loses the rows that were not flushed yet, and
+memory never holds more than one shard. Aggregates (metrics, accuracy curves,
+generation stats) go to ``summary.json`` next to the shards.
+
+``ResultsReader`` opens the shards lazily as a ``pyarrow.dataset``: columns
+and rows are only read when asked for, and filters are pushed down to the
+files. Id columns are stored as lists of int32 and can be decoded with a
+``WordLevelCodec`` without going through Python lists::
+
+    reader = ResultsReader("data/eval_results/<model>/step_1000/results_512")
+    wrong = reader.to_pandas(["example", "token_accuracy"], filter=field("exact_match") == False)
+    texts = reader.texts("prediction_ids", codec)
+
+``ResultsJournal`` makes long runs resumable: every finished unit of work
+(e.g. a chunk of generated answers) is appended to a JSONL file and synced
+to disk right away, and a restarted run skips the units that are in it.
+"""
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SUMMARY_FILE = "summary.json"
+JOURNAL_FILE = "journal.jsonl"
+
+
+def id_lists(rows, lengths: Optional[np.ndarray] = None) -> pa.ListArray:
+    """
+    Arrow list<int32> column of token ids.
+
+    Args:
+        rows: Ragged rows of ids, or all rows back to back if ``lengths`` is given.
+        lengths: Length of every row of a flat ``rows``.
+    """
+    if lengths is None:
+        lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+        flat = np.concatenate([np.asarray(row, dtype=np.int32) for row in rows]) if len(rows) else np.zeros(0, np.int32)
+    else:
+        flat = np.asarray(rows, dtype=np.int32)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(flat, type=pa.int32()))
+
+
+def _write_json(path: Path, data: Dict) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+class ResultsWriter:
+    """
+    Args:
+        path: Directory of the shards. Shards of an earlier run in it are removed.
+        rows_per_shard: Rows buffered before a shard is written.
+    """
+
+    def __init__(self, path, rows_per_shard: int = 100_000):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        for old in self.path.glob("part-*.parquet"):
+            old.unlink()
+        self.rows_per_shard = rows_per_shard
+        self.num_shards = 0
+        self.num_rows = 0
+        self._tables: List[pa.Table] = []
+        self._buffered = 0
+
+    def write_batch(self, columns: Dict) -> None:
+        """
+        Append rows. Every column holds one value per row: an Arrow array (e.g. from
+        ``id_lists``), a numpy array or a list.
+        """
+        table = pa.table(
+            {name: values if isinstance(values, (pa.Array, pa.ChunkedArray)) else pa.array(values) for name, values in columns.items()}
+        )
+        if table.num_rows == 0:
+            return
+        self._tables.append(table)
+        self._buffered += table.num_rows
+        if self._buffered >= self.rows_per_shard:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered rows as a new shard."""
+        if not self._tables:
+            return
+        table = pa.concat_tables(self._tables)
+        shard = self.path / f"part-{self.num_shards:05d}.parquet"
+        tmp = shard.with_name(shard.name + ".tmp")
+        pq.write_table(table, tmp)
+        os.replace(tmp, shard)
+        self.num_shards += 1
+        self.num_rows += table.num_rows
+        self._tables = []
+        self._buffered = 0
+
+    def close(self, summary: Optional[Dict] = None) -> None:
+        """Flush the remaining rows and write ``summary.json``."""
+        self.flush()
+        if summary is not None:
+            _write_json(self.path / SUMMARY_FILE, summary)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Keep what was written so far, but no summary for a failed run
+        self.flush()
+
+
+class ResultsReader:
+    """Lazy view of the shards written by ``ResultsWriter``."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        shards = sorted(str(shard) for shard in self.path.glob("part-*.parquet"))
+        if not shards:
+            raise FileNotFoundError(f"No result shards in {self.path}")
+        self.dataset = ds.dataset(shards, format="parquet")
+
+    @property
+    def summary(self) -> Dict:
+        summary_path = self.path / SUMMARY_FILE
+        if not summary_path.exists():
+            return {}
+        with open(summary_path, "r") as f:
+            return json.load(f)
+
+    @property
+    def columns(self) -> List[str]:
+        return self.dataset.schema.names
+
+    def __len__(self) -> int:
+        return self.dataset.count_rows()
+
+    def iter_batches(
+        self, columns: Optional[Sequence[str]] = None, filter=None, batch_size: int = 65536
+    ) -> Iterator[pa.RecordBatch]:
+        """Record batches of ``columns`` (all by default), one shard at a time."""
+        return iter(self.dataset.to_batches(columns=columns, filter=filter, batch_size=batch_size))
+
+    def to_table(self, columns: Optional[Sequence[str]] = None, filter=None) -> pa.Table:
+        return self.dataset.to_table(columns=columns, filter=filter)
+
+    def to_pandas(self, columns: Optional[Sequence[str]] = None, filter=None):
+        return self.to_table(columns, filter).to_pandas()
+
+    def ids(self, column: str, filter=None) -> Tuple[np.ndarray, np.ndarray]:
+        """All ids of a list column back to back, and the length of every row."""
+        array = self.to_table([column], filter).column(column).combine_chunks()
+        offsets = array.offsets.to_numpy()
+        flat = array.values.to_numpy()[offsets[0] : offsets[-1]].astype(np.int64)
+        return flat, np.diff(offsets).astype(np.int64)
+
+    def texts(self, column: str, codec, filter=None, skip_special_tokens: bool = True) -> List[str]:
+        """Decode an id column with a ``WordLevelCodec``."""
+        flat, lengths = self.ids(column, filter)
+        return codec.decode_flat(flat, lengths, skip_special_tokens=skip_special_tokens)
+
+
+class ResultsJournal:
+    """
+    Append-only record of finished work units, to resume an interrupted run.
+
+    The first line is a fingerprint of the run (inputs, model, batching) and every
+    further line one finished unit. Lines are flushed and fsynced as they are
+    written, so a timeout or preemption loses at most the unit being written; a
+    torn last line is cut off when the journal is reopened.
+
+    Args:
+        path: The journal file.
+        fingerprint: JSON-serializable description of everything that decides the
+            units and their outputs. A journal with another fingerprint is discarded.
+        resume: Keep the units of a matching journal instead of starting over.
+
+    ``completed`` maps the units read back from an earlier run to their records.
+    """
+
+    def __init__(self, path, fingerprint: Dict, resume: bool = True):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Round trip, so tuples and lists compare equal to what was read back
+        self.fingerprint = json.loads(json.dumps(fingerprint))
+        self.completed: Dict[int, Dict] = {}
+        if resume and self.path.exists() and self._load():
+            self._file = open(self.path, "ab")
+        else:
+            self._file = open(self.path, "wb")
+            self._write_line({"fingerprint": self.fingerprint})
+
+    def _load(self) -> bool:
+        """Read the finished units of a matching journal and cut off a torn last line."""
+        end = 0
+        with open(self.path, "rb") as f:
+            header = f.readline()
+            try:
+                if json.loads(header).get("fingerprint") != self.fingerprint:
+                    print(f"{self.path} is from a different run, starting over")
+                    return False
+            except json.JSONDecodeError:
+                return False
+            end = f.tell()
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self.completed[record.pop("unit")] = record
+                end += len(line)
+        with open(self.path, "r+b") as f:
+            f.truncate(end)
+        return True
+
+    def _write_line(self, data: Dict) -> None:
+        self._file.write((json.dumps(data) + "\n").encode())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, unit: int, record: Dict) -> None:
+        """Record ``unit`` as finished, with whatever is needed to rebuild its results."""
+        self._write_line({"unit": unit, **record})
+
+    def close(self) -> None:
+        self._file.close()
+
+    def remove(self) -> None:
+        """Close and delete the journal, once its results are merged."""
+        self.close()
+        self.path.unlink(missing_ok=True)
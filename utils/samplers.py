@@ -0,0 +1,150 @@
+"""
+Length-aware batch samplers for the training dataloader.
+"""
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthGroupedBatchSampler(Sampler[List[int]]):
+    """
+    "Sortish" batch sampler that groups examples of similar length.
+
+    Every epoch the examples are shuffled, cut into chunks of ``bucket_size``
+    batches, each chunk is sorted by length and split into batches, and the
+    order of the batches is shuffled again. Batches are either a fixed number
+    of examples (``batch_size``) or as many examples as fit into a token
+    budget (``max_tokens``, counted as rows * longest row, i.e. after padding).
+
+    Args:
+        lengths: Token count of every example.
+        batch_size: Examples per batch. Ignored when ``max_tokens`` is set.
+        max_tokens: Padded tokens per batch.
+        bucket_size: Number of batches sorted together.
+        shuffle: Shuffle examples and batches every epoch.
+        seed: Base seed; the epoch is added to it so every epoch differs but runs are reproducible.
+        num_replicas: Number of distributed ranks the batches are split across.
+        rank: This process's rank. Every rank builds the same batches from the
+            same seed and keeps every ``num_replicas``-th one, so all ranks run
+            the same number of steps.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        bucket_size: int = 100,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("Either batch_size or max_tokens must be set")
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._cache = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _chunk_size(self) -> int:
+        if self.max_tokens is None:
+            rows_per_batch = self.batch_size
+        else:
+            rows_per_batch = max(1, int(self.max_tokens // max(1.0, self.lengths.mean())))
+        return max(1, self.bucket_size * rows_per_batch)
+
+    def _split_sorted(self, indices: np.ndarray) -> List[List[int]]:
+        if self.max_tokens is None:
+            return [indices[i : i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+
+        # Indices are sorted by length, so the newest example is always the longest one
+        batches = []
+        start = 0
+        for end, length in enumerate(self.lengths[indices].tolist()):
+            if end > start and (end - start + 1) * length > self.max_tokens:
+                batches.append(indices[start:end].tolist())
+                start = end
+        if start < len(indices):
+            batches.append(indices[start:].tolist())
+        return batches
+
+    def batches(self, epoch: Optional[int] = None) -> List[List[int]]:
+        """The batches of an epoch (the current one by default) of this rank."""
+        epoch = self.epoch if epoch is None else epoch
+        if self._cache is not None and self._cache[0] == epoch:
+            return self._cache[1]
+
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        chunk_size = self._chunk_size()
+        for start in range(0, len(order), chunk_size):
+            chunk = order[start : start + chunk_size]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind="stable")]
+            batches.extend(self._split_sorted(chunk))
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        if self.num_replicas > 1:
+            # Repeat the first batches so every rank gets the same number of batches
+            padding = -len(batches) % self.num_replicas
+            batches = (batches + batches[:padding])[self.rank :: self.num_replicas]
+
+        self._cache = (epoch, batches)
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches())
+
+    def __len__(self) -> int:
+        return len(self.batches())
+
+
+def padding_efficiency(lengths, batches: List[List[int]]) -> float:
+    """Fraction of the padded batch tensors that is real tokens."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    real = 0
+    padded = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += int(batch_lengths.sum())
+        padded += len(batch) * int(batch_lengths.max())
+    return real / padded if padded > 0 else 1.0
+
+
+def padding_report(lengths, batches: List[List[int]], batch_size: int, seed: int = 0) -> Dict[str, float]:
+    """
+    Compare the padding of ``batches`` to plain shuffled batches of ``batch_size``.
+
+    Returns:
+        Padding efficiency of both, and the padded tokens per epoch of both.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.random.default_rng(seed).permutation(len(lengths))
+    random_batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+    def padded_tokens(batches):
+        return sum(len(batch) * int(lengths[batch].max()) for batch in batches)
+
+    sampler_tokens = padded_tokens(batches)
+    random_tokens = padded_tokens(random_batches)
+    return {
+        "padding_efficiency": padding_efficiency(lengths, batches),
+        "padding_efficiency_random": padding_efficiency(lengths, random_batches),
+        "padded_tokens": sampler_tokens,
+        "padded_tokens_random": random_tokens,
+        "padded_tokens_saved": 1.0 - sampler_tokens / random_tokens if random_tokens > 0 else 0.0,
+    }
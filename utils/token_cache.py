@@ -0,0 +1,159 @@
+"""
+Content-addressed cache of token stores.
+
+Entries are token stores (see ``token_store.py``) named after a hash of
+everything the tokenized result depends on: the bytes of the data file, the
+bytes of tokenizer.json, ``split_str`` and the truncation length. Any script
+that tokenizes the same file the same way finds the finished store instead of
+tokenizing again, and an edited file or tokenizer simply gets a new entry.
+
+The cache is capped in size; when it grows past ``max_size_gb`` the least
+recently used entries are deleted. Entries in use are never deleted: keys
+this process opened, entries used in the last ``min_idle_hours``, and
+entries a live ``TokenStore`` in any process holds a lock on.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set
+
+try:
+    from utils.token_store import lock_store
+except ImportError:
+    from token_store import lock_store
+
+
+DIGESTS_FILE = "digests.json"
+
+# How often processes waiting for another process's digest or store look again
+POLL_SECONDS = 5
+
+# Keys opened by this process; its own eviction never deletes them
+_OPENED_KEYS: Set[str] = set()
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class TokenCache:
+    """
+    Args:
+        root: Cache directory, e.g. on a shared scratch filesystem.
+        max_size_gb: Size cap of all entries; None disables eviction.
+        min_idle_hours: Entries used more recently than this are never evicted.
+    """
+
+    def __init__(self, root: str, max_size_gb: Optional[float] = None, min_idle_hours: float = 1.0):
+        self.root = root
+        self.max_bytes = None if max_size_gb is None else int(float(max_size_gb) * 1024**3)
+        self.min_idle_seconds = float(min_idle_hours) * 3600
+        os.makedirs(root, exist_ok=True)
+
+    def file_digest(self, path: str, wait: bool = False) -> str:
+        """
+        SHA-256 of a file's content.
+
+        Digests are remembered per (path, size, mtime) in ``digests.json``,
+        so unchanged multi-GB files are only read once. With ``wait`` the
+        file is never read: the call waits until another process (e.g. global
+        rank 0) has recorded its digest.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        digests_path = os.path.join(self.root, DIGESTS_FILE)
+        while True:
+            known = self._read_digests(digests_path).get(path)
+            if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                return known["sha256"]
+            if not wait:
+                break
+            time.sleep(POLL_SECONDS)
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                sha.update(chunk)
+
+        # Re-read before writing so concurrent jobs do not drop each other's entries
+        digests = self._read_digests(digests_path)
+        digests[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha.hexdigest()}
+        tmp_path = f"{digests_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(digests, f, indent=2)
+        os.replace(tmp_path, digests_path)
+        return sha.hexdigest()
+
+    @staticmethod
+    def _read_digests(digests_path: str) -> Dict:
+        try:
+            with open(digests_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(**parts) -> str:
+        """Cache key of a set of JSON-serializable parts."""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:32]
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def touch(self, key: str) -> None:
+        """Mark an entry as just used, and as opened by this process."""
+        _OPENED_KEYS.add(key)
+        now = time.time()
+        os.utime(self.entry_path(key), (now, now))
+
+    def entries(self) -> Iterable[str]:
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path) and ".tmp-" not in name:
+                yield name
+
+    def evict(self, keep: Iterable[str] = ()) -> None:
+        """
+        Delete least recently used entries until the cache fits into its size cap.
+
+        Skips ``keep``, every key this process opened, entries used in the last
+        ``min_idle_hours`` and entries any process has an open ``TokenStore`` on,
+        so the cache can stay over its cap while its entries are in use.
+        """
+        if self.max_bytes is None:
+            return
+        keep = set(keep) | _OPENED_KEYS
+        now = time.time()
+
+        entries = []
+        for key in self.entries():
+            path = self.entry_path(key)
+            try:
+                entries.append((os.path.getmtime(path), _dir_size(path), key))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key in keep or now - mtime < self.min_idle_seconds:
+                continue
+            # Not granted while a TokenStore anywhere has the entry open; held until it is deleted
+            lock = lock_store(self.entry_path(key), exclusive=True)
+            if lock is None:
+                continue
+            with lock:
+                print(f"Evicting token cache entry {key} ({size / 1024**2:.1f} MB)")
+                shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
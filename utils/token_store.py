@@ -0,0 +1,279 @@
+"""
+Memory-mapped token store.
+
+A store is a directory holding one tokenized split as a flat token file plus
+an offsets index:
+
+    tokens.bin          all token ids back to back (uint16, or uint32 for big vocabs)
+    offsets.npy         int64 array of length N + 1, row i is tokens[offsets[i]:offsets[i + 1]]
+    prompt_lengths.npy  int32 array of length N, tokens of each row up to and including [OUT]
+    meta.json           dtype, row/token counts and whatever the builder wants to record
+    lock                empty; every open ``TokenStore`` holds a shared ``flock`` on it
+
+Stores are written once and then opened read-only through ``np.memmap``, so
+opening one costs the same no matter how many examples it holds and every
+DataLoader worker shares the same pages through the OS page cache.
+"""
+import fcntl
+import json
+import os
+import shutil
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+STORE_VERSION = 2
+
+TOKENS_FILE = "tokens.bin"
+OFFSETS_FILE = "offsets.npy"
+PROMPT_LENGTHS_FILE = "prompt_lengths.npy"
+META_FILE = "meta.json"
+LOCK_FILE = "lock"
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    """Smallest unsigned dtype that can hold every id of the vocabulary."""
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.uint32)
+
+
+def read_meta(path: str) -> Optional[Dict]:
+    """Return the metadata of a finished store, or None if there is no store at ``path``."""
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+def lock_store(path: str, exclusive: bool = False):
+    """
+    Lock a store through its lock file; the lock is held until the returned file is closed.
+
+    Every open ``TokenStore`` holds a shared lock, and the OS drops it when
+    its process exits, so an exclusive lock is only granted (without
+    blocking) while no process anywhere uses the store. Returns None if the
+    store is gone or the lock is not available.
+    """
+    try:
+        f = open(os.path.join(path, LOCK_FILE), "a")
+    except OSError:
+        return None
+    try:
+        fcntl.flock(f, (fcntl.LOCK_EX | fcntl.LOCK_NB) if exclusive else fcntl.LOCK_SH)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class TokenStoreWriter:
+    """
+    Append tokenized rows to a new store.
+
+    Rows are streamed to a temporary directory which is renamed into place on
+    ``close()``, so readers never see a half written store. If another
+    process finished the same store first, that one is kept and this copy is
+    dropped, so a store is never replaced under its readers.
+
+    Args:
+        path: Directory of the store to create (replaced if it exists).
+        vocab_size: Vocabulary size, used to pick the token dtype.
+        metadata: Extra JSON-serializable entries saved in ``meta.json``.
+    """
+
+    def __init__(self, path: str, vocab_size: int, metadata: Optional[Dict] = None):
+        self.path = path
+        # Unique per process and thread, inference prepares several files at once
+        self.tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        self.dtype = token_dtype(vocab_size)
+        self.metadata = dict(metadata or {})
+
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self._tokens_file = open(os.path.join(self.tmp_path, TOKENS_FILE), "wb")
+        self._lengths: List[np.ndarray] = []
+        self._prompt_lengths: List[np.ndarray] = []
+        self._num_tokens = 0
+
+    def add_batch(self, batch_ids: Sequence[Sequence[int]], prompt_lengths: Sequence[int]) -> None:
+        """Append a batch of rows (lists of token ids) and the prompt length of each row."""
+        if len(batch_ids) == 0:
+            return
+        lengths = np.fromiter((len(ids) for ids in batch_ids), dtype=np.int64, count=len(batch_ids))
+        flat = np.fromiter(
+            (token for ids in batch_ids for token in ids), dtype=self.dtype, count=int(lengths.sum())
+        )
+        flat.tofile(self._tokens_file)
+        self._lengths.append(lengths)
+        self._prompt_lengths.append(np.asarray(prompt_lengths, dtype=np.int32))
+        self._num_tokens += len(flat)
+
+    def close(self) -> None:
+        self._tokens_file.close()
+
+        lengths = np.concatenate(self._lengths) if self._lengths else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(self.tmp_path, OFFSETS_FILE), offsets)
+        prompt_lengths = (
+            np.concatenate(self._prompt_lengths) if self._prompt_lengths else np.zeros(0, dtype=np.int32)
+        )
+        np.save(os.path.join(self.tmp_path, PROMPT_LENGTHS_FILE), prompt_lengths)
+
+        meta = {
+            "version": STORE_VERSION,
+            "dtype": self.dtype.name,
+            "num_rows": int(len(lengths)),
+            "num_tokens": int(self._num_tokens),
+            **self.metadata,
+        }
+        with open(os.path.join(self.tmp_path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        open(os.path.join(self.tmp_path, LOCK_FILE), "w").close()
+
+        if read_meta(self.path) is not None:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            return
+        # Leftovers of an unfinished store
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self._tokens_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TokenStore:
+    """
+    Read-only, map-style view over a token store.
+
+    Items look like rows of the tokenized HF dataset
+    (``{"input_ids": [...], "length": n, "prompt_length": p}``)
+    so the store can be dropped into ``Datamodule`` and the ``Evaluator``.
+    The memmaps are opened lazily and are not pickled, so each DataLoader
+    worker maps the files itself instead of receiving a copy of the data.
+    While the view is alive it holds a shared lock on the store, which keeps
+    the token cache from evicting it.
+
+    Args:
+        path: Directory of an existing store.
+        indices: Optional subset of row indices this view exposes.
+    """
+
+    def __init__(self, path: str, indices: Optional[Iterable[int]] = None):
+        self.path = path
+        # Taken before reading the metadata, so the store cannot be evicted in between
+        self._lock = lock_store(path)
+        self.meta = read_meta(path)
+        if self.meta is None:
+            if self._lock is not None:
+                self._lock.close()
+            raise FileNotFoundError(f"No token store found at {path}")
+        self.indices = None if indices is None else np.asarray(indices, dtype=np.int64)
+        self._tokens = None
+        self._offsets = None
+        self._prompt_lengths = None
+
+    @property
+    def tokens(self) -> np.ndarray:
+        if self._tokens is None:
+            if self.meta["num_tokens"] == 0:
+                self._tokens = np.zeros(0, dtype=self.meta["dtype"])
+            else:
+                self._tokens = np.memmap(
+                    os.path.join(self.path, TOKENS_FILE), dtype=self.meta["dtype"], mode="r"
+                )
+        return self._tokens
+
+    @property
+    def offsets(self) -> np.ndarray:
+        if self._offsets is None:
+            self._offsets = np.load(os.path.join(self.path, OFFSETS_FILE), mmap_mode="r")
+        return self._offsets
+
+    def _all_prompt_lengths(self) -> np.ndarray:
+        if self._prompt_lengths is None:
+            self._prompt_lengths = np.load(os.path.join(self.path, PROMPT_LENGTHS_FILE), mmap_mode="r")
+        return self._prompt_lengths
+
+    @property
+    def prompt_lengths(self) -> np.ndarray:
+        """Prompt length (up to and including the delimiter) of every row in this view."""
+        prompt_lengths = self._all_prompt_lengths()
+        return prompt_lengths if self.indices is None else prompt_lengths[self.indices]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Token count of every row in this view."""
+        lengths = np.diff(self.offsets)
+        return lengths if self.indices is None else lengths[self.indices]
+
+    def select(self, indices: Iterable[int]) -> "TokenStore":
+        """Return a view over a subset of rows, like ``datasets.Dataset.select``."""
+        indices = np.asarray(indices if isinstance(indices, np.ndarray) else list(indices), dtype=np.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return TokenStore(self.path, indices)
+
+    def row(self, idx: int) -> np.ndarray:
+        """Token ids of a row as a (memory-mapped) numpy array."""
+        if self.indices is not None:
+            idx = self.indices[idx]
+        return self.tokens[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def flat(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        All rows of this view back to back.
+
+        Returns:
+            The concatenated token ids (int64) and the length of every row.
+        """
+        lengths = self.lengths.astype(np.int64)
+        if self.indices is None:
+            return np.asarray(self.tokens, dtype=np.int64), lengths
+
+        # Gather index: start of the row in the store plus the position within the row
+        starts = np.asarray(self.offsets, dtype=np.int64)[self.indices]
+        row_starts = np.cumsum(lengths) - lengths
+        gather = np.arange(int(lengths.sum()), dtype=np.int64) + np.repeat(starts - row_starts, lengths)
+        return self.tokens[gather].astype(np.int64), lengths
+
+    def __len__(self) -> int:
+        return self.meta["num_rows"] if self.indices is None else len(self.indices)
+
+    def __getitem__(self, idx: int) -> Dict:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Index {idx} out of range for store of length {len(self)}")
+        row = self.row(idx)
+        row_idx = idx if self.indices is None else self.indices[idx]
+        return {
+            "input_ids": row.tolist(),
+            "length": len(row),
+            "prompt_length": int(self._all_prompt_lengths()[row_idx]),
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        state["_offsets"] = None
+        state["_prompt_lengths"] = None
+        # Workers run while the main process's view, and with it the lock, is alive
+        state["_lock"] = None
+        return state